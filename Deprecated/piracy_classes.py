@@ -45,11 +45,13 @@ class Coord:
     def __repr__(self):
         return "Coord(%f,%f)" % (self.lat, self.lon)
 
-    def deg2rad(self, degrees):
+    @staticmethod
+    def deg2rad(degrees):
         """Converts degrees (in decimal) to radians."""
         return (math.pi / 180) * degrees
 
-    def rad2nm(self, radians):
+    @staticmethod
+    def rad2nm(radians):
         """Converts a distance in radians to a distance in nautical miles."""
         return ((180 * 60) / math.pi) * radians
 # end of class Coord
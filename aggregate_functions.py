@@ -0,0 +1,145 @@
+"""
+This file contains the count cube behind the crosstabs in the analysis notebook and dashboard.
+The cube counts incidents over a set of dimensions (region, vessel category, weapons, flag, severity, month, ...)
+once; any crosstab, slice or total is then a roll-up of its non-empty cells instead of a groupby over the
+incidents. New incidents are added to the counts as they arrive.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import numpy as np
+import pandas as pd
+
+from instrument_functions import timed
+
+# Dimensions for the clean (data.world) and dirty (IMO) data; 'month' is derived from the date column
+CLEAN_DIMENSIONS = ['region', 'Vessel Category', 'Weapons Used', 'Ship Flag', 'Consequences to Crew', 'severity',
+                    'month']
+DIRTY_DIMENSIONS = ['region', 'Vessel_Type', 'country', 'severity', 'month']
+
+
+class CountCube:
+    """
+    Sparse count cube: one row of dimension codes per non-empty cell, plus its count.
+    Missing values are counted under None and left out of roll-ups unless dropna=False.
+    """
+
+    def __init__(self, dimensions=CLEAN_DIMENSIONS, date_column='Incident Date'):
+        """
+        :param dimensions: Column names to count over ('month' is taken from date_column)
+        :param date_column: Date column the month dimension comes from ('Date' in the dirty data)
+        """
+        self.dimensions = list(dimensions)
+        self.date_column = date_column
+        self.labels = {dim: [] for dim in self.dimensions}  # code -> label
+        self._codes = {dim: {} for dim in self.dimensions}  # label -> code
+        self.orders = {}  # category order of categorical dimensions (e.g. severity), used to sort roll-ups
+        self.cells = np.empty((0, len(self.dimensions)), dtype=np.int32)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    @classmethod
+    def from_frame(cls, data_df, dimensions=CLEAN_DIMENSIONS, date_column='Incident Date'):
+        """ Build a cube from a dataframe of incidents. """
+        cube = cls(dimensions, date_column)
+        cube.update(data_df)
+        return cube
+
+    def _values(self, data_df, dim):
+        """ Values of one dimension for each incident. """
+        if dim == 'month' and dim not in data_df:
+            return pd.to_datetime(data_df[self.date_column]).dt.to_period('M')
+        return data_df[dim]
+
+    def _encode(self, dim, values):
+        """ Codes of the values of one dimension, adding codes for labels the cube hasn't seen yet. """
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            order = self.orders.setdefault(dim, [])
+            order += [label for label in values.cat.categories if label not in order]
+        codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        labels, known = self.labels[dim], self._codes[dim]
+        remap = np.empty(len(uniques), dtype=np.int32)
+        for i, label in enumerate(uniques):
+            label = None if pd.isna(label) else label
+            if label not in known:
+                known[label] = len(labels)
+                labels.append(label)
+            remap[i] = known[label]
+        return remap[codes]
+
+    @timed('cube_update')
+    def update(self, data_df):
+        """
+        Add a batch of incidents to the counts.
+        :param data_df: Dataframe with a column for every dimension
+        :return: The cube
+        """
+        if not len(data_df):
+            return self
+        new = np.column_stack([self._encode(dim, self._values(data_df, dim)) for dim in self.dimensions])
+
+        # Merge the new incidents into the cells through one integer key per cell
+        shape = tuple(max(len(self.labels[dim]), 1) for dim in self.dimensions)
+        keys = np.concatenate([np.ravel_multi_index(self.cells.T, shape), np.ravel_multi_index(new.T, shape)])
+        weights = np.concatenate([self.counts, np.ones(len(new), dtype=np.int64)])
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+
+        self.counts = np.bincount(inverse.ravel(), weights=weights, minlength=len(unique_keys)).astype(np.int64)
+        self.cells = np.column_stack(np.unravel_index(unique_keys, shape)).astype(np.int32)
+        return self
+
+    def _mask(self, filters):
+        """ Cells matching the filters (dimension -> value or list of values). """
+        mask = np.ones(len(self.cells), dtype=bool)
+        for dim, wanted in (filters or {}).items():
+            if isinstance(wanted, (list, tuple, set)):
+                codes = [self._codes[dim][label] for label in wanted if label in self._codes[dim]]
+            else:
+                codes = [self._codes[dim][wanted]] if wanted in self._codes[dim] else []
+            mask &= np.isin(self.cells[:, self.dimensions.index(dim)], codes)
+        return mask
+
+    def counts_by(self, dims, filters=None, dropna=True):
+        """
+        Roll the cube up to some of its dimensions.
+        :param dims: Dimension name or list of names to keep
+        :param filters: Dictionary of dimension -> value (or list of values) to keep, e.g. {'region': 'Gulf of Aden'}
+        :param dropna: Leave out cells where a kept dimension is missing, like groupby
+        :return: Series of counts indexed by the kept dimensions, sorted
+        """
+        dims = [dims] if isinstance(dims, str) else list(dims)
+        mask = self._mask(filters)
+        cells, counts = self.cells[mask], self.counts[mask]
+        columns = {}
+        for dim in dims:
+            values = np.array(self.labels[dim], dtype=object)[cells[:, self.dimensions.index(dim)]]
+            if dim in self.orders:
+                values = pd.Categorical(values, categories=self.orders[dim], ordered=True)
+            columns[dim] = values
+        frame = pd.DataFrame(columns).assign(count=counts)
+        return frame.groupby(dims, dropna=dropna, observed=True)['count'].sum()
+
+    def crosstab(self, index, columns, filters=None, dropna=True):
+        """
+        Two-way table of counts, the equivalent of data_df.groupby([index, columns]).size().unstack(fill_value=0).
+        :param index: Dimension for the rows
+        :param columns: Dimension for the columns
+        :param filters: Dictionary of dimension -> value (or list of values) to keep
+        :param dropna: Leave out cells where index or columns is missing
+        :return: Dataframe of counts
+        """
+        return self.counts_by([index, columns], filters, dropna).unstack(fill_value=0)
+
+    def total(self, filters=None):
+        """ Number of incidents matching the filters. """
+        return int(self.counts[self._mask(filters)].sum())
+
+    def to_frame(self):
+        """ The non-empty cells as a long dataframe with one column per dimension and a count column. """
+        data = {dim: np.array(self.labels[dim], dtype=object)[self.cells[:, i]]
+                for i, dim in enumerate(self.dimensions)}
+        return pd.DataFrame(data).assign(count=self.counts)
+# end of class CountCube
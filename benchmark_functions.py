@@ -0,0 +1,328 @@
+"""
+This file contains the benchmark and accuracy-regression harness for the NLP labeling paths.
+Each labeling engine (the SpanCat model, the rule-based matcher, the screened matcher, ...) is run over the hand
+labeled training data and the held-out test docs. The harness reports throughput, per-stage latency percentiles
+and peak memory, and checks the per-label precision/recall against a stored baseline, so a speedup to the labeling
+path comes with a number and a proof that the labels did not change. Everything runs offline.
+
+The gate fails when there is no baseline, so a fresh checkout has to be bootstrapped first: run with
+--update-baseline on a known-good revision (the scores depend on the trained model and the base language model) and
+commit Results/label_baseline.json, so later runs and other machines check against it.
+
+Usage:
+    python benchmark_functions.py --update-baseline    # bootstrap: store the scores of this run as the baseline
+    python benchmark_functions.py                      # run and check against the baseline
+    python benchmark_functions.py --update-baseline    # after a deliberate change, accept the new scores
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from instrument_functions import max_rss_mb
+from label_cache import unpack_labels
+
+TRAINING_DATA_PATH = Path('Data_Files/training_data.csv')
+TEST_DOCS_PATH = Path('Spacy_Files/test.spacy')
+MODEL_PATH = Path('Spacy_Files/model/model-best')
+BASELINE_PATH = Path('Results/label_baseline.json')
+
+# Label -> gold column of the training data
+GOLD_COLUMNS = {'BOARDED': 'Boarded_label', 'HIJACKED': 'Hijacked_label', 'HOSTAGES_TAKEN': 'Hostages_taken_label',
+                'CREW_ASSAULTED': 'Crew_assaulted_label'}
+LABELS = list(GOLD_COLUMNS)
+
+# Engines that must give exactly the same labels as a reference engine (fast path -> reference)
+SAME_LABELS = {'matcher_screened': 'matcher'}
+
+PERCENTILES = (50, 90, 99)
+
+
+def load_training_set(path=TRAINING_DATA_PATH):
+    """
+    Texts and gold labels of the hand labeled training data.
+    :param path: Path to training_data.csv
+    :return: Tuple of (list of texts, float array of shape (n, len(LABELS)), NaN where a label wasn't assigned)
+    """
+    data_df = pd.read_csv(path)
+    gold = data_df[list(GOLD_COLUMNS.values())].to_numpy(dtype=np.float64)
+    return data_df['Incident_details'].fillna('').astype(str).tolist(), gold
+
+
+def load_test_set(path=TEST_DOCS_PATH, spans_key='sc'):
+    """
+    Texts and gold labels of the held-out test docs (a doc has a label if it has a span with it).
+    :param path: Path to the .spacy DocBin
+    :param spans_key: Span group holding the gold spans
+    :return: Tuple of (list of texts, float array of shape (n, len(LABELS)))
+    """
+    import spacy
+    from spacy.tokens import DocBin
+
+    docs = list(DocBin().from_disk(path).get_docs(spacy.blank('en').vocab))
+    gold = np.zeros((len(docs), len(LABELS)))
+    for row, doc in enumerate(docs):
+        for span in doc.spans.get(spans_key, []):
+            if span.label_ in GOLD_COLUMNS:
+                gold[row, LABELS.index(span.label_)] = 1
+    return [doc.text for doc in docs], gold
+
+
+def label_scores(labels, gold):
+    """
+    Precision, recall and F1 of each label, over the rows where the gold label is known.
+    :param labels: Array of shape (n, len(LABELS)) of predicted 0/1 labels
+    :param gold: Array of the same shape of gold labels, NaN where unknown
+    :return: Dictionary of label -> {'precision', 'recall', 'f1', 'support'}
+    """
+    scores = {}
+    for col, label in enumerate(LABELS):
+        known = ~np.isnan(gold[:, col])
+        pred, true = labels[known, col].astype(bool), gold[known, col].astype(bool)
+        tp, fp, fn = int((pred & true).sum()), int((pred & ~true).sum()), int((~pred & true).sum())
+        precision = tp / (tp + fp) if tp + fp else 0.0
+        recall = tp / (tp + fn) if tp + fn else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        scores[label] = {'precision': round(precision, 6), 'recall': round(recall, 6), 'f1': round(f1, 6),
+                         'support': int(true.sum())}
+    return scores
+
+
+@contextmanager
+def _stage(stages, name, n_docs):
+    """ Time a stage over one batch and record (seconds, number of docs). """
+    start = time.perf_counter()
+    yield
+    stages.setdefault(name, []).append((time.perf_counter() - start, n_docs))
+
+
+def model_engine(nlp):
+    """
+    Labeling engine for the SpanCat model (the model_interpreter path).
+    :param nlp: Trained NLP with a spancat component
+    :return: Engine function (batch of texts, stage timings) -> labels
+    """
+    from spacy_functions import _span_labels, spancat_disable
+
+    disable = spancat_disable(nlp)
+
+    def engine(texts, stages):
+        labels = np.zeros((len(texts), len(LABELS)), dtype=np.int8)
+        with _stage(stages, 'spancat', len(texts)):
+            docs = list(nlp.pipe(texts, disable=disable))
+        with _stage(stages, 'labels', len(texts)):
+            for row, doc in enumerate(docs):
+                _span_labels(doc, labels[row])
+        return labels
+
+    return engine
+
+
+def matcher_engine(nlp, screen=None):
+    """
+    Labeling engine for the rule-based matcher (the custom_matcher path), optionally behind a MatcherScreen.
+    :param nlp: Language model the matcher runs on
+    :param screen: Optional MatcherScreen
+    :return: Engine function (batch of texts, stage timings) -> labels
+    """
+    from spacy_functions import generate_matcher, match_masks
+
+    matcher = generate_matcher(nlp)
+
+    def engine(texts, stages):
+        labels = np.zeros((len(texts), len(LABELS)), dtype=np.int8)
+        rows = np.arange(len(texts))
+        if screen is not None:
+            with _stage(stages, 'screen', len(texts)):
+                rows = np.flatnonzero(screen(texts))
+        with _stage(stages, 'parse', len(texts)):
+            docs = list(nlp.pipe([texts[row] for row in rows]))
+        with _stage(stages, 'match', len(texts)):
+            labels[rows] = unpack_labels(match_masks(docs, matcher), len(LABELS))
+        return labels
+
+    return engine
+
+
+def stage_summary(timings):
+    """
+    Latency summary of a stage.
+    :param timings: List of (seconds, number of docs) per batch
+    :return: Dictionary with the total seconds and the percentiles of the milliseconds per doc over the batches
+    """
+    seconds, n_docs = np.array(timings, dtype=np.float64).T
+    per_doc_ms = seconds / np.maximum(n_docs, 1) * 1000
+    return {'total_s': round(float(seconds.sum()), 3),
+            **{f'p{q}_ms_per_doc': round(float(np.percentile(per_doc_ms, q)), 3) for q in PERCENTILES}}
+
+
+def run_engine(engine, texts, batch_size=256, trace_memory=True):
+    """
+    Label texts with an engine and measure it.
+    :param engine: Engine function from model_engine, matcher_engine, ...
+    :param texts: List of strings
+    :param batch_size: Number of texts per batch (each stage is timed per batch)
+    :param trace_memory: Track the peak of Python allocations with tracemalloc (slows the run a little)
+    :return: Tuple of (labels array, report dictionary)
+    """
+    stages = {}
+    batches = []
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    for first in range(0, len(texts), batch_size):
+        batches.append(engine(texts[first:first + batch_size], stages))
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+    rss = max_rss_mb()
+
+    report = {'docs': len(texts), 'seconds': round(elapsed, 3),
+              'docs_per_sec': round(len(texts) / elapsed, 1) if elapsed else None,
+              'stages': {name: stage_summary(timings) for name, timings in stages.items()},
+              'peak_traced_mb': round(peak / 2 ** 20, 1) if peak is not None else None,
+              'max_rss_mb': round(rss, 1) if rss is not None else None}
+    labels = np.concatenate(batches) if batches else np.zeros((0, len(LABELS)), dtype=np.int8)
+    return labels, report
+
+
+def run_benchmark(engines, datasets, batch_size=256, trace_memory=True):
+    """
+    Run every engine over every dataset.
+    :param engines: Dictionary of engine name -> engine function
+    :param datasets: Dictionary of dataset name -> (texts, gold)
+    :param batch_size: Number of texts per batch
+    :param trace_memory: Track peak memory with tracemalloc
+    :return: Tuple of (results dictionary of dataset -> engine -> report with 'scores', labels dictionary of
+        (dataset, engine) -> labels array)
+    """
+    results, labels = {}, {}
+    for dataset, (texts, gold) in datasets.items():
+        for name, engine in engines.items():
+            labels[dataset, name], report = run_engine(engine, texts, batch_size, trace_memory)
+            report['scores'] = label_scores(labels[dataset, name], gold)
+            results.setdefault(dataset, {})[name] = report
+    return results, labels
+
+
+def check_results(results, labels, baseline=None, tolerance=1e-6):
+    """
+    The correctness gate: scores must match the baseline and fast engines must match their reference labels.
+    :param results: Results from run_benchmark
+    :param labels: Labels from run_benchmark
+    :param baseline: Baseline dictionary of dataset -> engine -> label -> scores; a missing baseline, or an engine
+        run without a baseline entry, is a failure
+    :param tolerance: Largest allowed difference in a score
+    :return: List of failure messages (empty if everything passed)
+    """
+    failures = []
+    if baseline is None:
+        failures.append('no baseline to check the scores against (bootstrap it with --update-baseline)')
+    else:
+        failures.extend(f'{dataset}/{name}: no baseline scores (add them with --update-baseline)' for dataset, engines in results.items()
+                        for name in engines if name not in baseline.get(dataset, {}))
+    for (dataset, name), engine_labels in labels.items():
+        reference = SAME_LABELS.get(name)
+        if reference is not None and (dataset, reference) in labels:
+            differ = np.flatnonzero((engine_labels != labels[dataset, reference]).any(axis=1))
+            if len(differ):
+                failures.append(f'{dataset}/{name}: labels differ from {reference} on {len(differ)} docs '
+                                f'(first rows {differ[:5].tolist()})')
+
+    for dataset, engines in (baseline or {}).items():
+        for name, label_scores_ in engines.items():
+            if name not in results.get(dataset, {}):
+                continue
+            scores = results[dataset][name]['scores']
+            for label, expected in label_scores_.items():
+                for metric in ('precision', 'recall'):
+                    got = scores[label][metric]
+                    if abs(got - expected[metric]) > tolerance:
+                        failures.append(f'{dataset}/{name}/{label}: {metric} {got} != baseline {expected[metric]}')
+    return failures
+
+
+def load_baseline(path=BASELINE_PATH):
+    """ Stored baseline scores, or None if there is none yet. """
+    path = Path(path)
+    return json.loads(path.read_text()) if path.exists() else None
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    """
+    Store the scores of a run in the baseline (dataset -> engine -> label -> scores). Only the engines that were run
+    are replaced, so engines that need different machines (e.g. a GPU) can be baselined separately.
+    """
+    baseline = load_baseline(path) or {}
+    for dataset, engines in results.items():
+        baseline.setdefault(dataset, {}).update({name: report['scores'] for name, report in engines.items()})
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+
+
+def main(argv=None):
+    """ Command line entry point; returns the exit status (1 if the correctness gate failed). """
+    parser = argparse.ArgumentParser(description='Benchmark the NLP labeling engines and check their accuracy.')
+    parser.add_argument('--engines', nargs='+', default=['model', 'matcher', 'matcher_screened'],
+                        choices=['model', 'matcher', 'matcher_screened'])
+    parser.add_argument('--model', type=Path, default=MODEL_PATH, help='Trained SpanCat model')
+    parser.add_argument('--base-model', default='en_core_web_md', help='Language model the matcher runs on')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--baseline', type=Path, default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true', help='Store this run as the new baseline')
+    parser.add_argument('--no-memory', action='store_true', help="Don't trace memory (faster, no peak_traced_mb)")
+    parser.add_argument('--output', type=Path, help='Also write the report to this JSON file')
+    args = parser.parse_args(argv)
+
+    import spacy
+    from spacy_functions import MatcherScreen
+
+    engines = {}
+    if 'model' in args.engines:
+        engines['model'] = model_engine(spacy.load(args.model))
+    if {'matcher', 'matcher_screened'} & set(args.engines):
+        base = spacy.load(args.base_model, disable=['ner'])
+        if 'matcher' in args.engines:
+            engines['matcher'] = matcher_engine(base)
+        if 'matcher_screened' in args.engines:
+            engines['matcher_screened'] = matcher_engine(base, MatcherScreen())
+
+    datasets = {'training_data': load_training_set(), 'test': load_test_set()}
+    results, labels = run_benchmark(engines, datasets, args.batch_size, not args.no_memory)
+
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        args.output.write_text(report + '\n')
+
+    if args.update_baseline:
+        save_baseline(results, args.baseline)
+        print(f'Baseline written to {args.baseline}')
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        print(f'No baseline at {args.baseline}; bootstrap one on a known-good revision with '
+              f'"python benchmark_functions.py --update-baseline" and commit it', file=sys.stderr)
+
+    failures = check_results(results, labels, baseline)
+    for failure in failures:
+        print('FAIL', failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,284 @@
+"""
+This file contains the functions to convert the coordinate strings in the IMO data into decimal degrees, and to
+compute great-circle distances and nearest-incident queries on the converted coordinates.
+The functions below are used in the 2_data_analysis_plotting.ipynb notebook and the ingest pipeline.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import re
+
+import numpy as np
+import pandas as pd
+
+from instrument_functions import timed
+
+
+def dms_to_decimal(loc_string):
+    """
+    Converts coordinates in dms to decimals.
+    :param loc_string: Coordinate string from the IMO data, e.g. "4° 11.00' N"
+    :return: Coordinate in decimal degrees, negative for S and W
+    """
+    pattern = r'[\d]+[.]*[\d]*'
+    direction = loc_string[-1:]
+    matches = re.findall(pattern, loc_string)
+    degrees = int(matches[0])
+    minutes = float(matches[1])
+
+    if direction in ['S', 'W']:
+        direction = -1
+    else:
+        direction = 1
+
+    return (degrees + minutes / 60) * direction
+
+
+# Degrees, optional minutes and seconds, hemisphere letter before or after (or a sign instead),
+# e.g. "4° 11.00' N", "104° 52' 30\" E", "N 4° 11'", "-4.18", "3° S"
+_DMS_REGEX = re.compile(r'\s*(?P<pre>[NSEW])?\s*(?P<sign>[-+])?\s*'
+                        r'(?P<deg>\d+(?:\.\d*)?)\s*(?:°|º|˚)?\s*'
+                        r'(?:(?P<min>\d+(?:\.\d*)?)\s*(?:\'|′|’)?\s*)?'
+                        r'(?:(?P<sec>\d+(?:\.\d*)?)\s*(?:"|″|\'\'|”)?\s*)?'
+                        r'(?P<hem>[NSEW])?\s*')
+
+# Hemisphere letters and largest absolute value for each axis
+_AXES = {'lat': ('NS', 90.0), 'lon': ('EW', 180.0)}
+
+
+def _parse_dms(text, hemispheres, limit):
+    """
+    Parse one coordinate string.
+    :return: Tuple of (decimal degrees, reject reason or '')
+    """
+    match = _DMS_REGEX.fullmatch(text.upper())
+    if match is None:
+        return np.nan, 'unparseable'
+    pre, sign, deg, mins, secs, hem = match.group('pre', 'sign', 'deg', 'min', 'sec', 'hem')
+
+    if (pre and hem) or ((pre or hem) and sign):
+        return np.nan, 'conflicting hemisphere/sign'
+    hem = hem or pre
+    if hem and hem not in hemispheres:
+        return np.nan, f'hemisphere is not one of {hemispheres}'
+
+    mins = float(mins) if mins else 0.0
+    secs = float(secs) if secs else 0.0
+    if mins >= 60 or secs >= 60:
+        return np.nan, 'minutes or seconds out of range'
+
+    value = float(deg) + mins / 60 + secs / 3600
+    if value > limit:
+        return np.nan, f'beyond +-{limit:g} degrees'
+    if hem in ('S', 'W') or sign == '-':
+        value = -value
+    return value, ''
+
+
+def parse_coordinates(loc_series, axis='lat', dtype=np.float64):
+    """
+    Vectorized dms_to_decimal for a whole column of coordinate strings.
+    Each distinct string is only parsed once, then the results are spread back over the column by index.
+    Null entries come back as NaN. Entries that are present but can't be converted (no match, minutes or seconds
+    of 60 or more, the other axis' hemisphere, beyond +-90/180) also come back as NaN and are listed in the
+    rejection table.
+    :param loc_series: Series of coordinate strings
+    :param axis: 'lat' or 'lon'
+    :param dtype: Float dtype of the result
+    :return: Tuple of (array of decimal degrees, dataframe of rejected rows with 'value' and 'reason' columns)
+    """
+    hemispheres, limit = _AXES[axis]
+
+    # codes is -1 for nulls
+    codes, uniques = pd.factorize(loc_series)
+    parsed = [_parse_dms(str(text).strip(), hemispheres, limit) if str(text).strip() else (np.nan, '')
+              for text in uniques]
+    unique_values = np.array([value for value, reason in parsed] + [np.nan], dtype=dtype)
+    unique_reasons = np.array([reason for value, reason in parsed] + [''], dtype=object)
+
+    values = unique_values[codes]
+    reasons = unique_reasons[codes]
+    rejected = reasons != ''
+
+    rejects = pd.DataFrame({'value': loc_series[rejected], 'reason': reasons[rejected]})
+    return values, rejects
+
+
+@timed(rows=lambda result: len(result[0]))
+def add_decimal_coordinates(data_df, lat_column='Latitude', lon_column='Longitude', dtype=np.float64):
+    """
+    Adds Lat_Dec and Lon_Dec columns converted from the Latitude/Longitude strings.
+    :param data_df: Dataframe with coordinate string columns
+    :param lat_column: Name of the latitude column
+    :param lon_column: Name of the longitude column
+    :param dtype: Float dtype of the new columns
+    :return: Tuple of (dataframe, rejected rows with 'column', 'value' and 'reason' columns)
+    """
+    data_df['Lat_Dec'], lat_rejects = parse_coordinates(data_df[lat_column], 'lat', dtype)
+    data_df['Lon_Dec'], lon_rejects = parse_coordinates(data_df[lon_column], 'lon', dtype)
+
+    rejects = pd.concat([lat_rejects.assign(column=lat_column), lon_rejects.assign(column=lon_column)])
+    return data_df, rejects[['column', 'value', 'reason']]
+
+
+# Nautical miles per radian of great-circle arc (one minute of arc is one nautical mile)
+NM_PER_RADIAN = (180 * 60) / np.pi
+
+
+def haversine_nm(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in nautical miles (haversine formula, Aviation Formulary v1.46), vectorized.
+    The arguments are broadcast against each other, so one position can be compared to an array of positions,
+    or two arrays element by element.
+    :param lat1: Latitude(s) of the first position(s) in decimal degrees
+    :param lon1: Longitude(s) of the first position(s)
+    :param lat2: Latitude(s) of the second position(s)
+    :param lon2: Longitude(s) of the second position(s)
+    :return: Distance(s) in nautical miles, NaN where a coordinate is missing
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2))
+    # Haversine form, less subject to numerical error for short distances
+    h = np.sin((lat1 - lat2) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon1 - lon2) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(np.clip(h, 0, 1))) * NM_PER_RADIAN
+
+
+def pairwise_nm(lat1, lon1, lat2=None, lon2=None):
+    """
+    Matrix of great-circle distances between two sets of positions.
+    :param lat1: Array of latitudes of the first set
+    :param lon1: Array of longitudes of the first set
+    :param lat2: Array of latitudes of the second set (the first set if None)
+    :param lon2: Array of longitudes of the second set
+    :return: Array of shape (len(lat1), len(lat2)) in nautical miles
+    """
+    if lat2 is None:
+        lat2, lon2 = lat1, lon1
+    lat1, lon1 = np.asarray(lat1, dtype=np.float64), np.asarray(lon1, dtype=np.float64)
+    return haversine_nm(lat1[:, None], lon1[:, None], np.asarray(lat2)[None, :], np.asarray(lon2)[None, :])
+
+
+def sphere_cells(lat, lon, radius_nm):
+    """
+    Cells of a 3D grid over the unit sphere whose side is the chord of radius_nm, so two positions within radius_nm
+    of each other are always in the same or neighbouring cells (at any latitude and across the antimeridian).
+    :param lat: Array of latitudes in decimal degrees (no NaN)
+    :param lon: Array of longitudes
+    :param radius_nm: Neighbourhood radius in nautical miles
+    :return: int64 array of shape (n, 3) of cell coordinates
+    """
+    lat, lon = np.radians(np.asarray(lat, dtype=np.float64)), np.radians(np.asarray(lon, dtype=np.float64))
+    xyz = np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+    side = 2 * np.sin(radius_nm / NM_PER_RADIAN / 2)
+    return np.floor(xyz / side).astype(np.int64)
+
+
+class IncidentIndex:
+    """
+    Ball tree (haversine metric) over the positions of a set of incidents for fast distance queries.
+    Results are positions into the indexed incidents; labels maps them back to the dataframe index.
+    """
+
+    def __init__(self, lat, lon, labels=None, leaf_size=40):
+        """
+        :param lat: Array of incident latitudes in decimal degrees (no NaN)
+        :param lon: Array of incident longitudes
+        :param labels: Optional array of labels (e.g. the dataframe index) for each incident
+        :param leaf_size: Ball tree leaf size
+        """
+        from sklearn.neighbors import BallTree
+
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.labels = np.arange(len(self.lat)) if labels is None else np.asarray(labels)
+        self.tree = BallTree(np.radians(np.column_stack([self.lat, self.lon])), leaf_size=leaf_size,
+                             metric='haversine')
+
+    @classmethod
+    def from_frame(cls, data_df, lat_column='Lat_Dec', lon_column='Lon_Dec', **kwargs):
+        """
+        Index the incidents of a dataframe that have both coordinates.
+        :param data_df: Dataframe of incidents
+        :param lat_column: Column with decimal latitudes ('Latitude' in the clean data)
+        :param lon_column: Column with decimal longitudes ('Longitude' in the clean data)
+        :return: IncidentIndex whose labels are the dataframe index
+        """
+        located = data_df[[lat_column, lon_column]].dropna()
+        return cls(located[lat_column], located[lon_column], labels=located.index, **kwargs)
+
+    def __len__(self):
+        return len(self.lat)
+
+    @staticmethod
+    def _query_points(lat, lon):
+        return np.radians(np.column_stack([np.atleast_1d(lat).astype(np.float64),
+                                           np.atleast_1d(lon).astype(np.float64)]))
+
+    def within(self, lat, lon, radius_nm):
+        """
+        Incidents within radius_nm of one position, nearest first.
+        :param lat: Latitude of the position
+        :param lon: Longitude of the position
+        :param radius_nm: Search radius in nautical miles
+        :return: Tuple of (positions, distances in nautical miles)
+        """
+        ind, dist = self.tree.query_radius(self._query_points(lat, lon), r=radius_nm / NM_PER_RADIAN,
+                                           return_distance=True, sort_results=True)
+        return ind[0], dist[0] * NM_PER_RADIAN
+
+    def count_within(self, lat, lon, radius_nm):
+        """
+        Number of incidents within radius_nm of each of an array of positions.
+        :param lat: Array of latitudes
+        :param lon: Array of longitudes
+        :param radius_nm: Search radius in nautical miles
+        :return: Integer array of counts
+        """
+        return self.tree.query_radius(self._query_points(lat, lon), r=radius_nm / NM_PER_RADIAN, count_only=True)
+
+    def nearest(self, lat, lon, k=1):
+        """
+        The k nearest incidents to each of an array of positions.
+        :param lat: Array of latitudes
+        :param lon: Array of longitudes
+        :param k: Number of neighbours
+        :return: Tuple of (positions, distances in nautical miles), each of shape (n, k), nearest first
+        """
+        dist, ind = self.tree.query(self._query_points(lat, lon), k=min(k, len(self)))
+        return ind, dist * NM_PER_RADIAN
+
+    def nearest_to_track(self, track_lat, track_lon, k=5):
+        """
+        The k incidents closest to any point of a vessel track.
+        An incident's distance to the track is its distance to the nearest track point, so the result is exact
+        for the given points; densify the track first if the points are far apart.
+        :param track_lat: Array of track latitudes
+        :param track_lon: Array of track longitudes
+        :param k: Number of incidents
+        :return: Tuple of (positions, distances to the track in nautical miles), nearest first
+        """
+        # Every incident in the overall k nearest is among the k nearest of the track point closest to it
+        ind, dist = self.nearest(track_lat, track_lon, k)
+        ind, dist = ind.ravel(), dist.ravel()
+
+        order = np.lexsort((dist, ind))
+        ind, dist = ind[order], dist[order]
+        first = np.r_[True, ind[1:] != ind[:-1]]
+        ind, dist = ind[first], dist[first]
+
+        best = np.argsort(dist, kind='stable')[:k]
+        return ind[best], dist[best]
+
+    def distance_matrix(self, positions=None):
+        """
+        Pairwise distances between indexed incidents.
+        :param positions: Positions of the incidents to compare (all if None)
+        :return: Square array in nautical miles
+        """
+        if positions is None:
+            return pairwise_nm(self.lat, self.lon)
+        return pairwise_nm(self.lat[positions], self.lon[positions])
+# end of class IncidentIndex
@@ -0,0 +1,179 @@
+"""
+This file contains the functions to attribute a ship flag (country) to each incident from its IMO number.
+IMO numbers are looked up in imo-vessel-codes.csv, and the ISO2 flag codes are turned into countries with
+cocom_countries.csv. The merged table is kept as a FlagIndex (sorted integer IMO numbers plus codes into the list of
+countries and COCOMs) and saved to disk, so attributing flags is a binary search instead of a dataframe merge.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from instrument_functions import timed
+
+IMO_CODES_PATH = Path('Data_Files/imo-vessel-codes.csv')
+COCOM_PATH = Path('Data_Files/cocom_countries.csv')
+FLAG_INDEX_PATH = Path('Data_Files/flag_index.npz')
+
+
+def load_flag_table(imo_path=IMO_CODES_PATH, cocom_path=COCOM_PATH):
+    """
+    Build the IMO number -> country/COCOM table.
+    :param imo_path: Path to imo-vessel-codes.csv
+    :param cocom_path: Path to cocom_countries.csv
+    :return: Dataframe indexed by integer IMO number with 'country' and 'COCOM' columns
+    """
+    # 'NA' is Namibia's ISO2 code, so only empty cells count as missing flags
+    imos_df = pd.read_csv(imo_path, usecols=['imo', 'flag'], keep_default_na=False, na_values=[''])
+    iso2_df = pd.read_csv(cocom_path, encoding='utf-8-sig', keep_default_na=False, na_values=[''])
+
+    # rename column in iso df to merge with the imos_df, adds 'country' and 'COCOM' columns
+    iso2_df = iso2_df.rename(columns={'iso_2': 'flag'})
+    iso_flag_df = imos_df.merge(iso2_df[['flag', 'country', 'COCOM']], on='flag', how='left')
+
+    # Vessels can be listed more than once (one row per MMSI), keep the first row that has a flag
+    iso_flag_df = (iso_flag_df.sort_values('country', key=lambda c: c.isna(), kind='stable')
+                              .drop_duplicates('imo')
+                              .rename(columns={'imo': 'IMO No.'})
+                              .set_index('IMO No.')
+                              .sort_index())
+
+    return iso_flag_df[['country', 'COCOM']]
+
+
+def imo_numbers(imo_series):
+    """
+    Convert an 'IMO No.' column (strings, floats or ints) to nullable integers. Entries that aren't numbers,
+    e.g. 'UNKNOWN', become <NA>.
+    :param imo_series: Series of IMO numbers
+    :return: Int64 series with the same index
+    """
+    return pd.to_numeric(imo_series, errors='coerce').astype('Int64')
+
+
+class FlagIndex:
+    """
+    IMO number -> (country, COCOM) lookup over a sorted array of integer IMO numbers.
+    Countries and COCOMs are stored once each; every IMO number keeps small integer codes into those lists.
+    """
+
+    def __init__(self, imo, country_codes, cocom_codes, countries, cocoms):
+        """
+        :param imo: Sorted int32 array of IMO numbers
+        :param country_codes: Code into countries for each IMO number (-1 if unknown)
+        :param cocom_codes: Code into cocoms for each IMO number (-1 if unknown)
+        :param countries: Array of country names
+        :param cocoms: Array of COCOM names
+        """
+        self.imo = imo
+        self.country_codes = country_codes
+        self.cocom_codes = cocom_codes
+        # Code -1 indexes the None at the end
+        self.countries = np.array([*countries, None], dtype=object)
+        self.cocoms = np.array([*cocoms, None], dtype=object)
+
+    @classmethod
+    def from_table(cls, flag_table):
+        """
+        Build the index from the table returned by load_flag_table.
+        :param flag_table: Dataframe indexed by integer IMO number with 'country' and 'COCOM' columns
+        :return: FlagIndex
+        """
+        flag_table = flag_table.sort_index()
+        country_codes, countries = pd.factorize(flag_table['country'])
+        cocom_codes, cocoms = pd.factorize(flag_table['COCOM'])
+        return cls(flag_table.index.to_numpy(dtype=np.int32), country_codes.astype(np.int16),
+                   cocom_codes.astype(np.int16), list(countries), list(cocoms))
+
+    def save(self, path=FLAG_INDEX_PATH):
+        """ Save the index as an .npz file. """
+        np.savez(path, imo=self.imo, country_codes=self.country_codes, cocom_codes=self.cocom_codes,
+                 countries=self.countries[:-1].astype(str), cocoms=self.cocoms[:-1].astype(str))
+
+    @classmethod
+    def load(cls, path=FLAG_INDEX_PATH):
+        """ Load an index saved with save. """
+        with np.load(path) as arrays:
+            return cls(arrays['imo'], arrays['country_codes'], arrays['cocom_codes'], arrays['countries'].tolist(),
+                       arrays['cocoms'].tolist())
+
+    def __len__(self):
+        return len(self.imo)
+
+    def positions(self, imos):
+        """
+        Position of each IMO number in the index.
+        :param imos: Integer array of IMO numbers
+        :return: Array of positions, -1 where the IMO number isn't in the index
+        """
+        imos = np.asarray(imos, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.imo, imos), len(self.imo) - 1)
+        return np.where(self.imo[pos] == imos, pos, -1)
+
+    def lookup(self, imos):
+        """
+        Bulk lookup.
+        :param imos: IMO numbers (integers, or a series of strings/floats as in the IMO data)
+        :return: Tuple of (country array, COCOM array), None where the IMO number is unknown
+        """
+        if isinstance(imos, pd.Series) or not np.issubdtype(np.asarray(imos).dtype, np.integer):
+            # Anything that isn't a number, e.g. 'UNKNOWN', gets an IMO number no vessel has
+            imos = imo_numbers(pd.Series(imos)).fillna(0).to_numpy(dtype=np.int64)
+        pos = self.positions(imos)
+        country_codes = np.where(pos >= 0, self.country_codes[pos], -1)
+        cocom_codes = np.where(pos >= 0, self.cocom_codes[pos], -1)
+        return self.countries[country_codes], self.cocoms[cocom_codes]
+
+    def get(self, imo):
+        """
+        Single-key lookup for streaming ingest.
+        :param imo: IMO number
+        :return: Tuple of (country, COCOM), (None, None) if the IMO number is unknown
+        """
+        try:
+            imo = int(imo)
+        except (TypeError, ValueError):
+            return None, None
+        pos = int(np.searchsorted(self.imo, imo))
+        if pos == len(self.imo) or self.imo[pos] != imo:
+            return None, None
+        return self.countries[self.country_codes[pos]], self.cocoms[self.cocom_codes[pos]]
+# end of class FlagIndex
+
+
+def load_flag_index(path=FLAG_INDEX_PATH, imo_path=IMO_CODES_PATH, cocom_path=COCOM_PATH):
+    """
+    Load the saved FlagIndex, rebuilding and saving it first if it is missing or older than either csv.
+    :param path: Path to the saved index
+    :param imo_path: Path to imo-vessel-codes.csv
+    :param cocom_path: Path to cocom_countries.csv
+    :return: FlagIndex
+    """
+    path = Path(path)
+    sources = [Path(imo_path), Path(cocom_path)]
+    if path.exists() and all(path.stat().st_mtime >= source.stat().st_mtime for source in sources):
+        return FlagIndex.load(path)
+
+    flag_index = FlagIndex.from_table(load_flag_table(imo_path, cocom_path))
+    flag_index.save(path)
+    return flag_index
+
+
+@timed(rows=len)
+def add_flags(data_df, flag_index, imo_column='IMO No.'):
+    """
+    Adds a 'country' column to the dataframe based on each incident's IMO number.
+    :param data_df: Dataframe with an IMO number column
+    :param flag_index: FlagIndex (see load_flag_index)
+    :param imo_column: Name of the IMO number column
+    :return: Dataframe with the 'country' column added
+    """
+    data_df['country'], _ = flag_index.lookup(data_df[imo_column])
+    return data_df
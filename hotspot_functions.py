@@ -0,0 +1,363 @@
+"""
+This file contains the hotspot detection over the incident history.
+Hotspots are DBSCAN-style clusters in space and time: an incident is a core incident when at least min_samples
+incidents (itself included) happened within eps_nm and eps_days of it, and core incidents within reach of each other
+form one hotspot. The HotspotIndex keeps the neighbour counts, a grid index (sphere cells x date bins) and a
+union-find over the core incidents, so new incidents are added in time proportional to their neighbourhoods instead
+of reclustering the whole history. Its state is saved to disk between the daily refreshes.
+
+Hotspots come out ranked, with their time window, bounding box and convex hull, and can be registered as regions
+(see region_functions.RegionRegistry) or passed as boxes to the maps. Hex-binned incident density is also here.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import itertools
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from coord_functions import haversine_nm, sphere_cells
+from instrument_functions import timed
+
+HOTSPOT_STATE_PATH = Path('Data_Files/hotspot_state.npz')
+
+# Decimal places of the coordinates that go into the incident keys (about 11 m)
+KEY_DECIMALS = 4
+
+# Bumped whenever incident_keys changes, so saved indexes with old keys are rebuilt instead of double counting
+KEY_VERSION = 2
+
+# Cell offsets of a neighbourhood in the (date bin, x, y, z) grid
+_NEIGHBOUR_OFFSETS = [(d, *cell) for d in (-1, 0, 1) for cell in itertools.product((-1, 0, 1), repeat=3)]
+
+
+def incident_keys(data_df, date_column='Date', lat_column='Lat_Dec', lon_column='Lon_Dec', name_column='Ship Name'):
+    """
+    Stable 64-bit key of each incident, so adding the same incidents again changes nothing.
+    The columns are normalized before hashing (dates to days, coordinates rounded to KEY_DECIMALS, names stripped),
+    so the same incidents read from csv or from Parquet get the same keys.
+    :param data_df: Dataframe of incidents
+    :return: uint64 array
+    """
+    key_df = pd.DataFrame(index=data_df.index)
+    if date_column in data_df:
+        days = pd.to_datetime(data_df[date_column], format='mixed').to_numpy(dtype='datetime64[D]')
+        key_df[date_column] = np.where(np.isnat(days), np.iinfo(np.int64).min, days.astype(np.int64))
+    for column in (lat_column, lon_column):
+        if column in data_df:
+            # + 0.0 turns -0.0 into 0.0, which hashes differently
+            coords = pd.to_numeric(data_df[column], errors='coerce').round(KEY_DECIMALS) + 0.0
+            key_df[column] = coords.fillna(np.inf).to_numpy(dtype=np.float64)
+    if name_column in data_df:
+        key_df[name_column] = data_df[name_column].astype(object).fillna('').astype(str).str.strip().to_numpy()
+    return pd.util.hash_pandas_object(key_df, index=False).to_numpy(dtype=np.uint64)
+
+
+class HotspotIndex:
+    """
+    Incremental DBSCAN over (position, date) with a grid index and a union-find over the core incidents.
+    Incidents are only ever added, so clusters only grow and merge and the result is the same as clustering the
+    whole history at once (up to which cluster a border incident between two clusters is given to).
+    """
+
+    def __init__(self, eps_nm=50.0, eps_days=30, min_samples=5):
+        """
+        :param eps_nm: Neighbourhood radius in nautical miles
+        :param eps_days: Neighbourhood half-width in days
+        :param min_samples: Number of incidents (itself included) within the neighbourhood of a core incident
+        """
+        self.eps_nm = float(eps_nm)
+        self.eps_days = int(eps_days)
+        self.min_samples = int(min_samples)
+        self.key_version = KEY_VERSION
+        self.lat = np.empty(0)
+        self.lon = np.empty(0)
+        self.day = np.empty(0, dtype=np.int64)
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.counts = np.empty(0, dtype=np.int64)  # neighbours within eps, itself included
+        self.parent = np.empty(0, dtype=np.int64)  # union-find parent of each core incident (itself if a root)
+        self.border_of = np.empty(0, dtype=np.int64)  # a core neighbour of each non-core incident, -1 if noise
+        self._size = 0
+        self._cells = {}
+        self._known = set()
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def core(self):
+        """ Boolean array telling which incidents are core incidents. """
+        return self.counts[:self._size] >= self.min_samples
+
+    def _grow(self, n):
+        """ Make room for n more incidents. """
+        capacity = len(self.lat)
+        if self._size + n <= capacity:
+            return
+        capacity = max(self._size + n, 2 * capacity, 1024)
+        for name, fill in (('lat', np.nan), ('lon', np.nan), ('day', 0), ('keys', 0), ('counts', 0), ('parent', -1),
+                           ('border_of', -1)):
+            old = getattr(self, name)
+            new = np.full(capacity, fill, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def _cell(self, lat, lon, day):
+        """ Grid cell of a position and day. """
+        x, y, z = sphere_cells([lat], [lon], self.eps_nm)[0]
+        return day // (self.eps_days + 1), x, y, z
+
+    def _neighbours(self, i, cell):
+        """ Incidents within eps_nm and eps_days of incident i (itself excluded). """
+        candidates = [self._cells.get((cell[0] + d, cell[1] + x, cell[2] + y, cell[3] + z), ())
+                      for d, x, y, z in _NEIGHBOUR_OFFSETS]
+        candidates = np.fromiter(itertools.chain.from_iterable(candidates), dtype=np.int64)
+        candidates = candidates[candidates != i]
+        if not len(candidates):
+            return candidates
+        close = np.abs(self.day[candidates] - self.day[i]) <= self.eps_days
+        candidates = candidates[close]
+        distance = haversine_nm(self.lat[i], self.lon[i], self.lat[candidates], self.lon[candidates])
+        return candidates[distance <= self.eps_nm]
+
+    def _find(self, i):
+        """ Root of a core incident, with path halving. """
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def _union(self, i, j):
+        """ Merge the clusters of two core incidents. """
+        root_i, root_j = self._find(i), self._find(j)
+        if root_i != root_j:
+            self.parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    def _insert(self, i, cell):
+        """ Add incident i to the index and update the counts, cores and clusters around it. """
+        neighbours = self._neighbours(i, cell)
+        self._cells.setdefault(cell, []).append(i)
+        self.counts[i] = len(neighbours) + 1
+        self.counts[neighbours] += 1
+
+        # Incidents that just became core: i itself, and neighbours whose count just reached min_samples
+        new_cores = [j for j in neighbours if self.counts[j] == self.min_samples]
+        if self.counts[i] >= self.min_samples:
+            new_cores.append(i)
+        for j in new_cores:
+            self.parent[j] = j
+        for j in new_cores:
+            around = neighbours if j == i else self._neighbours(j, self._cell(self.lat[j], self.lon[j], self.day[j]))
+            for k in around:
+                if self.counts[k] >= self.min_samples:
+                    self._union(j, k)
+                elif self.border_of[k] < 0:
+                    self.border_of[k] = j
+
+        if self.counts[i] < self.min_samples and self.border_of[i] < 0:
+            core_neighbours = neighbours[self.counts[neighbours] >= self.min_samples]
+            if len(core_neighbours):
+                self.border_of[i] = core_neighbours[0]
+
+    @timed('hotspot_update', rows=len)
+    def update(self, data_df, date_column='Date', lat_column='Lat_Dec', lon_column='Lon_Dec'):
+        """
+        Add incidents to the index. Incidents without a date or position, or already in the index, are skipped.
+        :param data_df: Dataframe of incidents
+        :param date_column: Column with the incident dates
+        :param lat_column: Column with decimal latitudes
+        :param lon_column: Column with decimal longitudes
+        :return: Dataframe of the incidents that were added, in the order they were added
+        """
+        dates = pd.to_datetime(data_df[date_column], errors='coerce')
+        lat = pd.to_numeric(data_df[lat_column], errors='coerce').to_numpy(dtype=np.float64)
+        lon = pd.to_numeric(data_df[lon_column], errors='coerce').to_numpy(dtype=np.float64)
+        keys = incident_keys(data_df, date_column, lat_column, lon_column)
+        usable = dates.notna().to_numpy() & ~np.isnan(lat) & ~np.isnan(lon)
+        usable &= ~np.isin(keys, np.fromiter(self._known, dtype=np.uint64, count=len(self._known)))
+        _, first = np.unique(keys, return_index=True)
+        unique = np.zeros(len(keys), dtype=bool)
+        unique[first] = True
+        rows = np.flatnonzero(usable & unique)
+        rows = rows[np.argsort(dates.to_numpy()[rows], kind='stable')]
+
+        self._grow(len(rows))
+        days = dates.to_numpy(dtype='datetime64[D]').astype(np.int64)
+        for row in rows:
+            i = self._size
+            self.lat[i], self.lon[i], self.day[i], self.keys[i] = lat[row], lon[row], days[row], keys[row]
+            self._size += 1
+            self._known.add(keys[row])
+            self._insert(i, self._cell(lat[row], lon[row], days[row]))
+        return data_df.iloc[rows]
+
+    def labels(self):
+        """
+        Hotspot of each incident in the index, in the order they were added.
+        :return: int64 array of cluster ids (0, 1, ... by first incident), -1 for noise
+        """
+        n = self._size
+        roots = np.full(n, -1, dtype=np.int64)
+        core = self.core
+        for i in np.flatnonzero(core):
+            roots[i] = self._find(i)
+        border = ~core & (self.border_of[:n] >= 0)
+        roots[border] = roots[self.border_of[:n][border]]
+        clustered = roots >= 0
+        labels = np.full(n, -1, dtype=np.int64)
+        labels[clustered] = pd.factorize(roots[clustered])[0]
+        return labels
+
+    @timed()
+    def hotspots(self, min_incidents=None, recent_days=365, rank_by='recent'):
+        """
+        Ranked hotspots with their time window, extent and hull.
+        :param min_incidents: Smallest hotspot to report, min_samples if None
+        :param recent_days: Length of the 'recent' window, ending at the latest incident in the index
+        :param rank_by: 'recent' (incidents in the recent window, then all incidents) or 'incidents'
+        :return: Dataframe with rank, hotspot, incidents, recent, start, end, center_lat, center_lon, min_lat,
+            max_lat, min_lon, max_lon, area_nm2, density (incidents per 1000 nm2) and polygon (shapely, lon/lat)
+        """
+        import shapely
+
+        labels = self.labels()
+        n = self._size
+        latest = self.day[:n].max() if n else 0
+        rows = []
+        for hotspot in range(labels.max() + 1 if n else 0):
+            members = np.flatnonzero(labels == hotspot)
+            if len(members) < (min_incidents or self.min_samples):
+                continue
+            lat, lon, day = self.lat[members], self.lon[members], self.day[members]
+            hull = shapely.convex_hull(shapely.multipoints(np.column_stack([lon, lat])))
+            # Hull area on a local equirectangular projection, in square nautical miles
+            scale = np.cos(np.radians(lat.mean()))
+            area = shapely.convex_hull(shapely.multipoints(np.column_stack([lon * 60 * scale, lat * 60]))).area
+            rows.append({'hotspot': hotspot, 'incidents': len(members),
+                         'recent': int((day > latest - recent_days).sum()),
+                         'start': np.datetime64(int(day.min()), 'D'), 'end': np.datetime64(int(day.max()), 'D'),
+                         'center_lat': lat.mean(), 'center_lon': lon.mean(), 'min_lat': lat.min(),
+                         'max_lat': lat.max(), 'min_lon': lon.min(), 'max_lon': lon.max(), 'area_nm2': area,
+                         'density': 1000 * len(members) / area if area else np.nan, 'polygon': hull})
+
+        columns = ['hotspot', 'incidents', 'recent', 'start', 'end', 'center_lat', 'center_lon', 'min_lat', 'max_lat',
+                   'min_lon', 'max_lon', 'area_nm2', 'density', 'polygon']
+        table = pd.DataFrame(rows, columns=columns)
+        order = ['recent', 'incidents'] if rank_by == 'recent' else ['incidents', 'recent']
+        table = table.sort_values(order, ascending=False, kind='stable').reset_index(drop=True)
+        table.insert(0, 'rank', np.arange(1, len(table) + 1))
+        return table
+
+    def save(self, path=HOTSPOT_STATE_PATH):
+        """ Save the index (parameters, incidents, counts and clusters) to a .npz file. """
+        n = self._size
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(path, params=np.array([self.eps_nm, self.eps_days, self.min_samples]),
+                            key_version=np.array(KEY_VERSION),
+                            lat=self.lat[:n], lon=self.lon[:n], day=self.day[:n], keys=self.keys[:n],
+                            counts=self.counts[:n], parent=self.parent[:n], border_of=self.border_of[:n])
+
+    @classmethod
+    def load(cls, path=HOTSPOT_STATE_PATH):
+        """ Load an index saved with save; the grid index is rebuilt from the positions. """
+        with np.load(path) as data:
+            eps_nm, eps_days, min_samples = data['params']
+            index = cls(eps_nm, int(eps_days), int(min_samples))
+            key_version = int(data['key_version']) if 'key_version' in data.files else 1
+            n = len(data['lat'])
+            index._grow(n)
+            for name in ('lat', 'lon', 'day', 'keys', 'counts', 'parent', 'border_of'):
+                getattr(index, name)[:n] = data[name]
+        index.key_version = key_version
+        index._size = n
+        index._known = set(index.keys[:n].tolist())
+        for i in range(n):
+            index._cells.setdefault(index._cell(index.lat[i], index.lon[i], index.day[i]), []).append(i)
+        return index
+# end of class HotspotIndex
+
+
+def load_hotspot_index(path=HOTSPOT_STATE_PATH, eps_nm=50.0, eps_days=30, min_samples=5):
+    """
+    The saved hotspot index, or a new empty one if there is none or it was built with other parameters or keys.
+    :param path: Path to the saved index
+    :param eps_nm: Neighbourhood radius in nautical miles
+    :param eps_days: Neighbourhood half-width in days
+    :param min_samples: Number of incidents within the neighbourhood of a core incident
+    :return: HotspotIndex
+    """
+    if Path(path).exists():
+        index = HotspotIndex.load(path)
+        if (index.eps_nm, index.eps_days, index.min_samples, index.key_version) == \
+                (float(eps_nm), int(eps_days), int(min_samples), KEY_VERSION):
+            return index
+    return HotspotIndex(eps_nm, eps_days, min_samples)
+
+
+def hotspot_boxes(hotspots, top=None, prefix='Hotspot'):
+    """
+    Hotspots as (min_lat, max_lat, min_lon, max_lon) boxes, the form of region_functions.REGION_BOXES.
+    :param hotspots: Dataframe from HotspotIndex.hotspots
+    :param top: Only the top ranked hotspots, all if None
+    :param prefix: Region name prefix, followed by the rank
+    :return: Dictionary of name -> box
+    """
+    hotspots = hotspots if top is None else hotspots.head(top)
+    return {f'{prefix} {rank}': (min_lat, max_lat, min_lon, max_lon) for rank, min_lat, max_lat, min_lon, max_lon
+            in hotspots[['rank', 'min_lat', 'max_lat', 'min_lon', 'max_lon']].itertuples(index=False)}
+
+
+def hotspot_registry(hotspots, registry=None, top=None, prefix='Hotspot', buffer_deg=0.05):
+    """
+    Register the hotspot hulls as regions, e.g. to filter or label incidents by hotspot.
+    :param hotspots: Dataframe from HotspotIndex.hotspots
+    :param registry: RegionRegistry to add to, a new one if None
+    :param top: Only the top ranked hotspots, all if None
+    :param prefix: Region name prefix, followed by the rank
+    :param buffer_deg: Margin around each hull, so incidents on its edge (and hulls of collinear incidents) count
+    :return: RegionRegistry
+    """
+    from region_functions import RegionRegistry
+
+    registry = registry if registry is not None else RegionRegistry()
+    hotspots = hotspots if top is None else hotspots.head(top)
+    for rank, polygon in hotspots[['rank', 'polygon']].itertuples(index=False):
+        registry.add(f'{prefix} {rank}', polygon.buffer(buffer_deg))
+    return registry
+
+
+def hex_density(lat, lon, size_nm=30.0):
+    """
+    Number of incidents in each cell of a hexagonal grid (pointy-top hexagons on an equirectangular projection,
+    so the cells are size_nm across at the equator and narrower in longitude away from it).
+    :param lat: Array of latitudes
+    :param lon: Array of longitudes
+    :param size_nm: Hexagon circumradius in nautical miles (at the equator)
+    :return: Dataframe of the non-empty cells with q, r (axial coordinates), center_lat, center_lon and incidents,
+        densest first
+    """
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    keep = ~(np.isnan(lat) | np.isnan(lon))
+    x, y = lon[keep] * 60 / size_nm, lat[keep] * 60 / size_nm
+
+    # Fractional axial coordinates, rounded to the nearest hexagon in cube coordinates
+    q, r = np.sqrt(3) / 3 * x - y / 3, 2 / 3 * y
+    cube = np.column_stack([q, r, -q - r])
+    rounded = np.round(cube)
+    error = np.abs(rounded - cube)
+    worst = np.argmax(error, axis=1)
+    rows = np.arange(len(cube))
+    rounded[rows, worst] = -(rounded.sum(axis=1) - rounded[rows, worst])
+    cells, counts = np.unique(rounded[:, :2].astype(np.int64), axis=0, return_counts=True)
+
+    q, r = cells[:, 0], cells[:, 1]
+    table = pd.DataFrame({'q': q, 'r': r, 'center_lat': 1.5 * r * size_nm / 60,
+                          'center_lon': np.sqrt(3) * (q + r / 2) * size_nm / 60, 'incidents': counts})
+    return table.sort_values('incidents', ascending=False, kind='stable').reset_index(drop=True)
@@ -0,0 +1,281 @@
+"""
+This file contains a compact, in-memory store of piracy incidents grouped by vessel.
+It replaces the Vessel/Incident object graph from Deprecated/piracy_classes.py: every attribute is one numpy column
+(text as codes into a shared table of unique values, the crew flags packed into one byte), rows are sorted by
+vessel and date, and an offsets array gives each vessel's incident history as one contiguous slice. Vessel and
+Incident objects are only created on access, as small __slots__ views onto a row.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+CLEAN_DATA_PATH = Path('Data_Files/[Clean] IMO Piracy - 2000 to 2022 (PDV 01-2023).csv')
+
+# Attribute name -> column in the clean data, for the text attributes stored as codes
+CATEGORY_FIELDS = {
+    'flag': 'Ship Flag',
+    'type': 'Ship Type',
+    'area': 'Area',
+    'consequence': 'Consequences to Crew',
+    'part': 'Part of Ship Raided',
+    'ship_status': 'Ship Status',
+    'weapon': 'Weapons Used',
+}
+
+# Attribute name -> column in the clean data, for the crew flags packed into one bitmask (bit i is flag i)
+CREW_FIELDS = {
+    'crew_inj': 'Flag - Crew Injuries',
+    'crew_hostage': 'Flag - Crew Held Hostage',
+    'crew_missing': 'Flag - Crew Missing',
+    'crew_death': 'Flag - Crew Deaths',
+    'crew_assaulted': 'Flag - Crew Assaulted',
+}
+
+
+def _category_property(field):
+    """ Property decoding a text attribute of an IncidentView. """
+    def get(self):
+        return self._store.categories[field][self._store.codes[field][self._row]]
+    return property(get, doc=f'{CATEGORY_FIELDS[field]} (None if missing)')
+
+
+def _crew_property(bit, field):
+    """ Property decoding one crew flag of an IncidentView. """
+    def get(self):
+        return bool(self._store.crew[self._row] >> bit & 1)
+    return property(get, doc=CREW_FIELDS[field])
+
+
+class IncidentView:
+    """
+    One incident: a lightweight view onto a row of an IncidentStore.
+    Has the same attributes as the old Incident class, plus date, vessel, lat and lon.
+    """
+
+    __slots__ = ('_store', '_row')
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    @property
+    def date(self):
+        return pd.Timestamp(self._store.dates[self._row])
+
+    @property
+    def vessel(self):
+        return self._store.vessel_names[self._store.vessel_codes[self._row]]
+
+    @property
+    def lat(self):
+        return float(self._store.lat[self._row])
+
+    @property
+    def lon(self):
+        return float(self._store.lon[self._row])
+
+    @property
+    def coord(self):
+        """ (lat, lon) tuple, or None if the position wasn't reported. """
+        lat, lon = self.lat, self.lon
+        return None if np.isnan(lat) or np.isnan(lon) else (lat, lon)
+
+    def __str__(self):
+        return (f'Incident Summary: date={self.date:%m/%d/%Y}, vessel={self.vessel}, coord={self.coord}, '
+                f'area={self.area}, consequence={self.consequence}, part={self.part}, '
+                f'ship_status={self.ship_status}, weapon={self.weapon}, crew_inj={self.crew_inj}, '
+                f'crew_hostage={self.crew_hostage}, crew_missing={self.crew_missing}, crew_death={self.crew_death}'
+                f', crew_assaulted={self.crew_assaulted}')
+
+
+for _field in CATEGORY_FIELDS:
+    setattr(IncidentView, _field, _category_property(_field))
+for _bit, _field in enumerate(CREW_FIELDS):
+    setattr(IncidentView, _field, _crew_property(_bit, _field))
+# end of class IncidentView
+
+
+class VesselView:
+    """
+    One vessel and its incident history: a lightweight view onto a slice of an IncidentStore.
+    Flag and type are taken from the vessel's first incident, like the old Vessel class.
+    """
+
+    __slots__ = ('_store', '_id')
+
+    def __init__(self, store, vessel_id):
+        self._store = store
+        self._id = vessel_id
+
+    @property
+    def name(self):
+        return self._store.vessel_names[self._id]
+
+    @property
+    def rows(self):
+        """ Slice of the store's rows holding this vessel's incidents, oldest first. """
+        return slice(self._store.offsets[self._id], self._store.offsets[self._id + 1])
+
+    @property
+    def flag(self):
+        return self._store[self.rows.start].flag
+
+    @property
+    def type(self):
+        return self._store[self.rows.start].type
+
+    def num_incidents(self):
+        """ Returns the number of incidents recorded for the ship. """
+        return self.rows.stop - self.rows.start
+
+    def get_incidents(self):
+        """ Returns the list of incidents for the ship, oldest first. """
+        return [IncidentView(self._store, row) for row in range(self.rows.start, self.rows.stop)]
+
+    def incidents_on(self, date):
+        """ Returns the list of the ship's incidents on one date (there can be several). """
+        rows = self.rows
+        dates = self._store.dates[rows]
+        day = np.datetime64(pd.Timestamp(date), 'D')
+        start, stop = np.searchsorted(dates, day, side='left'), np.searchsorted(dates, day, side='right')
+        return [IncidentView(self._store, rows.start + row) for row in range(start, stop)]
+
+    def __str__(self):
+        retval = str(self.name)
+        retval += '('
+        if self.name:
+            retval += "name='" + self.name + "'"
+            retval += ',type=' + str(self.type)
+            if self.flag:
+                retval += ',flag=' + str(self.flag)
+        retval += ',%d incidents' % self.num_incidents()
+        retval += ')'
+        return retval
+# end of class VesselView
+
+
+class IncidentStore:
+    """
+    Struct-of-arrays store of incidents, sorted by vessel then date.
+    Column access (e.g. store.lat[store.vessel('X').rows]) is vectorized; indexing and vessel() return views.
+    """
+
+    def __init__(self, dates, vessel_codes, vessel_names, lat, lon, codes, categories, crew):
+        self.dates = dates
+        self.vessel_codes = vessel_codes
+        self.vessel_names = vessel_names
+        self.lat = lat
+        self.lon = lon
+        self.codes = codes
+        self.categories = categories
+        self.crew = crew
+
+        # offsets[v]:offsets[v + 1] are the rows of vessel v
+        self.offsets = np.searchsorted(vessel_codes, np.arange(len(vessel_names) + 1)).astype(np.int64)
+        self.vessel_ids = {name: i for i, name in enumerate(vessel_names)}
+
+    @classmethod
+    def from_frame(cls, data_df):
+        """
+        Build a store from a dataframe with the columns of the clean data set.
+        :param data_df: Dataframe of incidents
+        :return: IncidentStore
+        """
+        vessel_codes, vessel_names = pd.factorize(data_df['Ship Name'].fillna(''), sort=True)
+        dates = pd.to_datetime(data_df['Incident Date']).to_numpy().astype('datetime64[D]')
+
+        # Sort by vessel, then date; stable so incidents on the same day keep their order in the file
+        order = np.lexsort((dates, vessel_codes))
+
+        codes, categories = {}, {}
+        for field, column in CATEGORY_FIELDS.items():
+            field_codes, uniques = pd.factorize(data_df[column])
+            dtype = np.int16 if len(uniques) < 2 ** 15 else np.int32
+            codes[field] = field_codes[order].astype(dtype)
+            # Code -1 (missing) indexes the None at the end
+            categories[field] = np.array([*(str(x) for x in uniques), None], dtype=object)
+
+        crew = np.zeros(len(data_df), dtype=np.uint8)
+        for bit, column in enumerate(CREW_FIELDS.values()):
+            crew |= data_df[column].fillna(False).to_numpy(dtype=bool).astype(np.uint8) << bit
+
+        return cls(dates=dates[order],
+                   vessel_codes=vessel_codes[order].astype(np.int32),
+                   vessel_names=np.array([str(name) for name in vessel_names], dtype=object),
+                   lat=data_df['Latitude'].to_numpy(dtype=np.float32)[order],
+                   lon=data_df['Longitude'].to_numpy(dtype=np.float32)[order],
+                   codes=codes, categories=categories, crew=crew[order])
+
+    @classmethod
+    def from_csv(cls, csvfile=CLEAN_DATA_PATH):
+        """
+        Build a store from the clean data csv (replaces build_vessel_dict).
+        :param csvfile: Path to the csv
+        :return: IncidentStore
+        """
+        # Only empty cells are missing; 'NA' and 'N/A' appear as ship names
+        return cls.from_frame(pd.read_csv(csvfile, keep_default_na=False, na_values=['']))
+
+    def to_frame(self):
+        """ The store as a dataframe with the columns of the clean data set, sorted by vessel and date. """
+        data = {'Incident Date': self.dates.astype('datetime64[ns]'),
+                'Ship Name': self.vessel_names[self.vessel_codes]}
+        for field, column in CATEGORY_FIELDS.items():
+            data[column] = self.categories[field][self.codes[field]]
+        data['Latitude'] = self.lat.astype(np.float64)
+        data['Longitude'] = self.lon.astype(np.float64)
+        for bit, column in enumerate(CREW_FIELDS.values()):
+            data[column] = (self.crew >> bit & 1).astype(bool)
+        return pd.DataFrame(data)
+
+    def extend(self, data_df):
+        """
+        New store holding these incidents plus the ones in data_df (the arrays are rebuilt, the store is immutable).
+        :param data_df: Dataframe of new incidents with the columns of the clean data set
+        :return: IncidentStore
+        """
+        return IncidentStore.from_frame(pd.concat([self.to_frame(), data_df], ignore_index=True))
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, row):
+        if not -len(self) <= row < len(self):
+            raise IndexError(row)
+        return IncidentView(self, row % len(self))
+
+    def __iter__(self):
+        return (IncidentView(self, row) for row in range(len(self)))
+
+    def __contains__(self, ship_name):
+        return ship_name in self.vessel_ids
+
+    def vessel(self, ship_name):
+        """
+        Look up a vessel by name.
+        :param ship_name: Ship name
+        :return: VesselView
+        """
+        return VesselView(self, self.vessel_ids[ship_name])
+
+    def vessels(self):
+        """ Generator of a VesselView for every vessel, in name order. """
+        return (VesselView(self, vessel_id) for vessel_id in range(len(self.vessel_names)))
+
+    def num_vessels(self):
+        return len(self.vessel_names)
+
+    def nbytes(self):
+        """ Memory used by the column arrays in bytes (not counting the shared strings). """
+        arrays = [self.dates, self.vessel_codes, self.vessel_names, self.lat, self.lon, self.crew, self.offsets,
+                  *self.codes.values(), *self.categories.values()]
+        return sum(array.nbytes for array in arrays)
+# end of class IncidentStore
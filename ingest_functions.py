@@ -0,0 +1,315 @@
+"""
+This file contains the streaming ingest pipeline for the dirty IMO incident list.
+Each stage is a generator that takes and yields dataframe chunks, so the file is read, cleaned, converted,
+labeled and written a bounded number of rows at a time and memory stays flat no matter how big the input is.
+It writes the columns of the dirty csv (less DROP_COLUMNS), plus Vessel_Type, Lat_Dec and Lon_Dec, the NLP label
+columns and severity when a model is given (the columns of Data_Files/Model_Output.csv), region when a region
+registry is given and country when a flag index is given.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import collections
+import itertools
+import queue
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+from coord_functions import add_decimal_coordinates
+from flag_functions import add_flags
+from instrument_functions import count, stage, timed_iter
+from label_cache import pack_labels, text_key, unpack_labels
+from severity_functions import NLP_RULES, add_severity
+from vessel_functions import add_vessel_category
+
+DIRTY_DATA_PATH = Path('Data_Files/[Dirty]_ListOfIncidents_IMO.csv')
+MODEL_OUTPUT_PATH = Path('Data_Files/Model_Output.csv')
+
+# Columns from the IMO website we don't need
+DROP_COLUMNS = ['Boarded?', 'MSC/Circ', 'Coastal State Action Taken']
+
+# Marks the end of the stream in the prefetch queue
+_DONE = object()
+
+# Text pushed through the labeling stream to flush it when no chunk has texts to label
+_PLACEHOLDER_TEXT = '.'
+
+
+def read_chunks(path=DIRTY_DATA_PATH, chunksize=1000):
+    """
+    Read the dirty IMO csv a chunk at a time. The index keeps counting across chunks, so every row keeps
+    its position in the original file.
+    :param path: Path to the csv
+    :param chunksize: Number of rows per chunk
+    :return: Generator of dataframe chunks
+    """
+    # Keep IMO numbers as text, some of them are entries like 'UNKNOWN'
+    yield from timed_iter(pd.read_csv(path, chunksize=chunksize, dtype={'IMO No.': str}), 'read_csv')
+
+
+def prefetch(chunks, maxsize=2):
+    """
+    Pull chunks from the previous stage on a background thread so reading overlaps with the later stages.
+    The queue holds at most maxsize chunks; once it is full the reader blocks until the pipeline catches up.
+    :param chunks: Iterable of dataframe chunks
+    :param maxsize: Number of chunks allowed to wait in the queue
+    :return: Generator of dataframe chunks
+    """
+    buffer = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        # Wait for room in the queue, unless the consumer has gone away
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+            put(_DONE)
+        except BaseException as err:  # hand reader errors to the consumer
+            put(err)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def clean_chunks(chunks):
+    """
+    Drop the columns and rows we can't use and convert the dates.
+    :param chunks: Iterable of raw dataframe chunks
+    :return: Generator of cleaned dataframe chunks
+    """
+    for chunk in chunks:
+        # Drop columns we don't need
+        chunk = chunk.drop(columns=DROP_COLUMNS, errors='ignore')
+
+        # Ensure no NaNs in Incident details column
+        chunk = chunk[chunk['Incident details'].notna()].copy()
+
+        # Convert Date column to DateTime Objects
+        chunk['Date'] = pd.to_datetime(chunk['Date'], format='%m/%d/%y')
+        yield chunk
+
+
+def coordinate_chunks(chunks, rejects=None):
+    """
+    Convert the Latitude/Longitude strings to decimal degrees in Lat_Dec/Lon_Dec.
+    :param chunks: Iterable of cleaned dataframe chunks
+    :param rejects: Optional list to collect each chunk's table of unparseable coordinates in
+    :return: Generator of dataframe chunks with Lat_Dec and Lon_Dec columns
+    """
+    for chunk in chunks:
+        chunk, chunk_rejects = add_decimal_coordinates(chunk)
+        if rejects is not None and len(chunk_rejects):
+            rejects.append(chunk_rejects)
+        yield chunk
+
+
+def vessel_chunks(chunks, normalizer=None):
+    """
+    Normalize the free-text ship types into vessel categories.
+    :param chunks: Iterable of cleaned dataframe chunks
+    :param normalizer: VesselTypeNormalizer, the shared default one if None
+    :return: Generator of dataframe chunks with a Vessel_Type column
+    """
+    for chunk in chunks:
+        yield add_vessel_category(chunk, column='Vessel_Type', normalizer=normalizer)
+
+
+def label_chunks(chunks, nlp, batch_size=256, n_process=1, cache=None, max_pending=4):
+    """
+    Label the incident details of each chunk with the SpanCat model.
+    The texts of all the chunks go through one nlp.pipe stream, so with n_process > 1 the worker pool (and the copy
+    of the model each worker gets) is started once for the whole feed rather than once per chunk. A chunk is passed
+    on as soon as the docs of all its texts have come back.
+    :param chunks: Iterable of cleaned dataframe chunks
+    :param nlp: Trained NLP to categorize the data
+    :param batch_size: Number of texts spaCy buffers per batch
+    :param n_process: Number of processes to label with (-1 uses every core)
+    :param cache: Optional LabelCache (see label_cache.py); only texts it hasn't seen are labeled
+    :param max_pending: Most chunks read ahead of the ones passed on
+    :return: Generator of dataframe chunks with the label columns and severity
+    """
+    # Imported here so the pipeline can run without spaCy when the labeling stage is skipped
+    from spacy_functions import LABELS, model_label_stream
+
+    # Chunks read but not passed on yet, oldest first. Only a sequence number travels with each text (the context
+    # is pickled to the worker processes), it is looked up in in_flight when the doc comes back.
+    pending = collections.deque()
+    in_flight = {}
+    sequence = itertools.count()
+
+    def texts():
+        for chunk in chunks:
+            chunk_texts = chunk['Incident details'].fillna('').astype(str).tolist()
+            if cache is None:
+                keys, masks = list(range(len(chunk_texts))), {}
+            else:
+                keys = [text_key(text) for text in chunk_texts]
+                masks = cache.get_many(set(keys))
+            # Label each missing text once
+            missing = {}
+            for key, text in zip(keys, chunk_texts):
+                if key not in masks and key not in missing:
+                    missing[key] = text
+            if cache is not None:
+                count('label_cache_hits', len(keys) - len(missing))
+                count('label_cache_misses', len(missing))
+            entry = {'chunk': chunk, 'keys': keys, 'masks': masks, 'labels': {}, 'remaining': len(missing)}
+            pending.append(entry)
+            for key, text in missing.items():
+                number = next(sequence)
+                in_flight[number] = (entry, key)
+                yield text, number
+
+            # Chunks only leave when a doc comes back from the stream, so before reading on, push placeholder texts
+            # through it until the finished chunks (e.g. all cache hits) have left and few enough are waiting.
+            # Without this a warm cache would buffer the whole feed.
+            while pending and (pending[0]['remaining'] == 0 or len(pending) >= max_pending):
+                yield _PLACEHOLDER_TEXT, None
+
+    def finish(entry):
+        chunk, keys, masks, new_labels = entry['chunk'], entry['keys'], entry['masks'], entry['labels']
+        with stage('label_chunk') as open_stage:
+            if new_labels:
+                new_masks = dict(zip(new_labels, pack_labels(list(new_labels.values())).tolist()))
+                if cache is not None:
+                    cache.put_many(new_masks)
+                masks.update(new_masks)
+            labels = unpack_labels([masks[key] for key in keys], len(LABELS)).reshape(len(keys), len(LABELS))
+            for col, label in enumerate(LABELS):
+                chunk[label] = labels[:, col]
+            open_stage.add_rows(len(chunk))
+        return add_severity(chunk, NLP_RULES)
+
+    for labels, number in model_label_stream(texts(), nlp, batch_size=batch_size, n_process=n_process):
+        if number is not None:
+            entry, key = in_flight.pop(number)
+            entry['labels'][key] = labels
+            entry['remaining'] -= 1
+        # Docs come back in order, so the oldest chunks are the first to be complete
+        while pending and pending[0]['remaining'] == 0:
+            yield finish(pending.popleft())
+    while pending:
+        yield finish(pending.popleft())
+
+
+def region_chunks(chunks, registry):
+    """
+    Label each incident with the first region it falls in.
+    :param chunks: Iterable of dataframe chunks with Lat_Dec and Lon_Dec columns
+    :param registry: RegionRegistry (see region_functions.default_registry)
+    :return: Generator of dataframe chunks with a 'region' column
+    """
+    for chunk in chunks:
+        yield registry.label(chunk)
+
+
+def cube_chunks(chunks, cube):
+    """
+    Count the chunks into an aggregate cube as they pass through.
+    :param chunks: Iterable of dataframe chunks with a column for every dimension of the cube
+    :param cube: CountCube (see aggregate_functions.py), updated in place
+    :return: Generator of the same dataframe chunks
+    """
+    for chunk in chunks:
+        cube.update(chunk)
+        yield chunk
+
+
+def flag_chunks(chunks, flag_index):
+    """
+    Attribute a ship flag (country) to each incident from its IMO number.
+    :param chunks: Iterable of dataframe chunks
+    :param flag_index: FlagIndex from flag_functions.load_flag_index
+    :return: Generator of dataframe chunks with a 'country' column
+    """
+    for chunk in chunks:
+        yield add_flags(chunk, flag_index)
+
+
+def write_chunks(chunks, out_path=MODEL_OUTPUT_PATH):
+    """
+    Write the chunks to one csv, header first, then appending each chunk as it arrives.
+    :param chunks: Iterable of dataframe chunks
+    :param out_path: Path to the output csv
+    :return: Number of rows written
+    """
+    out_path = Path(out_path)
+    rows = 0
+    with out_path.open('w', newline='', encoding='utf-8') as f:
+        for i, chunk in enumerate(chunks):
+            with stage('write_csv') as open_stage:
+                chunk.to_csv(f, header=(i == 0))
+                open_stage.add_rows(len(chunk))
+            rows += len(chunk)
+    return rows
+
+
+def run_ingest(in_path=DIRTY_DATA_PATH, out_path=MODEL_OUTPUT_PATH, nlp=None, flag_index=None, chunksize=1000,
+               batch_size=256, n_process=1, cache=None, prefetch_chunks=2, rejects=None, registry=None, cube=None,
+               vessel_types=None):
+    """
+    Run the full ingest pipeline: read -> clean -> vessel types -> NLP labels -> coordinates -> regions -> flags
+    -> cube -> write.
+    :param in_path: Path to the dirty IMO csv
+    :param out_path: Path to the output csv, or a .parquet path for typed Parquet output
+    :param nlp: Trained SpanCat NLP, labeling is skipped if None
+    :param flag_index: FlagIndex from flag_functions.load_flag_index, flags are skipped if None
+    :param chunksize: Number of rows per chunk
+    :param batch_size: Number of texts spaCy buffers per batch
+    :param n_process: Number of processes to label with (-1 uses every core)
+    :param cache: Optional LabelCache (see label_cache.py)
+    :param prefetch_chunks: Number of chunks to read ahead on a background thread (0 reads inline)
+    :param rejects: Optional list to collect the tables of unparseable coordinates in
+    :param registry: RegionRegistry to label regions with, skipped if None
+    :param cube: CountCube to count the incidents into (e.g. over aggregate_functions.DIRTY_DIMENSIONS, which
+        needs nlp, registry and flag_index), skipped if None
+    :param vessel_types: VesselTypeNormalizer for the Vessel_Type column, the shared default one if None
+    :return: Number of rows written
+    """
+    chunks = read_chunks(in_path, chunksize=chunksize)
+    if prefetch_chunks:
+        chunks = prefetch(chunks, maxsize=prefetch_chunks)
+    chunks = clean_chunks(chunks)
+    chunks = vessel_chunks(chunks, vessel_types)
+    if nlp is not None:
+        chunks = label_chunks(chunks, nlp, batch_size=batch_size, n_process=n_process, cache=cache)
+    chunks = coordinate_chunks(chunks, rejects)
+    if registry is not None:
+        chunks = region_chunks(chunks, registry)
+    if flag_index is not None:
+        chunks = flag_chunks(chunks, flag_index)
+    if cube is not None:
+        chunks = cube_chunks(chunks, cube)
+
+    # Typed Parquet output when asked for, csv otherwise
+    if Path(out_path).suffix == '.parquet':
+        from storage_functions import write_parquet_chunks
+        return write_parquet_chunks(chunks, out_path)
+    return write_chunks(chunks, out_path)
@@ -0,0 +1,385 @@
+"""
+This file contains the lightweight instrumentation layer for the pipeline stages.
+Stages are timed with the stage context manager or the timed decorator, and counters are bumped with count. They
+only record while a run is open (see run); outside a run they cost one global lookup, so the library functions can
+stay decorated. When a run closes, one JSON line is appended to the run log with its stage timings, row counts,
+memory high-water marks and counters. Comparing runs in that log (see stage_regressions) shows which stage got
+slower, without re-running the notebooks by hand.
+
+Chosen stages can also be run under cProfile (profile argument of run, or the PIRATES_PROFILE environment variable,
+a comma separated list of stage names), one .prof file per stage per run. For sampling profilers such as py-spy,
+the run log keeps the pid and the wall-clock start of every run, so an external `py-spy record --pid <pid>` can be
+lined up with the stages.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows has no getrusage
+    resource = None
+
+RUN_LOG_PATH = Path('Results/run_log.jsonl')
+PROFILE_DIR = Path('Results/profiles')
+PROFILE_ENV = 'PIRATES_PROFILE'
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_RSS_TO_MB = 1 / 2 ** 20 if sys.platform == 'darwin' else 1 / 2 ** 10
+
+# The open run, if any
+_active = None
+
+
+def max_rss_mb():
+    """ High-water mark of the resident memory of this process, in MB, or None where getrusage is unavailable. """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_TO_MB
+
+
+def _round(value, digits):
+    """ Round a measurement that may be missing (None). """
+    return round(value, digits) if value is not None else None
+
+
+@contextmanager
+def _profiling(profiler):
+    """ Run the block under a cProfile profiler, or plainly if another profiler is already active. """
+    try:
+        profiler.enable()
+    except ValueError:
+        # Only one profiler can be active at a time (e.g. nested profiled stages)
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+
+
+class StageRecord:
+    """
+    Totals of one stage over a run. A stage entered several times (e.g. once per chunk) adds up; nested stages
+    each count their own inclusive time.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.max_rss_mb = None
+        self.rss_growth_mb = None
+        self.peak_traced_mb = None
+
+    def to_dict(self):
+        """ JSON-ready dictionary of the totals. """
+        record = {'calls': self.calls, 'seconds': round(self.seconds, 4), 'rows': self.rows,
+                  'rows_per_sec': round(self.rows / self.seconds, 1) if self.rows and self.seconds else None,
+                  'max_rss_mb': _round(self.max_rss_mb, 1), 'rss_growth_mb': _round(self.rss_growth_mb, 1)}
+        if self.peak_traced_mb is not None:
+            record['peak_traced_mb'] = round(self.peak_traced_mb, 2)
+        return record
+# end of class StageRecord
+
+
+class _OpenStage:
+    """ One pass through a stage; the caller can add the rows it handled with add_rows. """
+
+    def __init__(self):
+        self.rows = 0
+        self.peak_traced = 0
+
+    def add_rows(self, n):
+        """ Add n to the rows handled. """
+        self.rows += int(n)
+# end of class _OpenStage
+
+
+class Run:
+    """
+    Stage timings and counters of one pipeline run.
+    """
+
+    def __init__(self, name, profile=(), profile_dir=PROFILE_DIR, trace_memory=False):
+        """
+        :param name: Name of the run (e.g. 'ingest'), runs of the same name are compared with each other
+        :param profile: Stage names to run under cProfile
+        :param profile_dir: Folder for the .prof files
+        :param trace_memory: Also record the peak of Python allocations per stage with tracemalloc (slower)
+        """
+        self.name = name
+        self.run_id = f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:6]}"
+        self.started = datetime.now(timezone.utc)
+        self.profile = set(profile)
+        self.profile_dir = Path(profile_dir)
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.counters = {}
+        self.profiles = {}
+        self._profilers = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = time.perf_counter()
+        self.seconds = None
+        self.status = 'running'
+
+    def _open_stages(self):
+        """ Stages open on the current thread, outermost first. """
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _fold_traced_peak(self, stack):
+        """ Credit the tracemalloc peak since the last reset to every open stage, then reset it. """
+        peak = tracemalloc.get_traced_memory()[1]
+        for open_stage in stack:
+            open_stage.peak_traced = max(open_stage.peak_traced, peak)
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage.
+        :param name: Stage name
+        :return: Context manager yielding an object with add_rows(n)
+        """
+        stack = self._open_stages()
+        if self.trace_memory:
+            self._fold_traced_peak(stack)
+        open_stage = _OpenStage()
+        stack.append(open_stage)
+
+        profiler = None
+        if name in self.profile:
+            with self._lock:
+                profiler = self._profilers.setdefault(name, cProfile.Profile())
+        rss_before = max_rss_mb()
+        start = time.perf_counter()
+        try:
+            with (_profiling(profiler) if profiler is not None else nullcontext()):
+                yield open_stage
+        finally:
+            seconds = time.perf_counter() - start
+            rss_after = max_rss_mb()
+            if self.trace_memory:
+                self._fold_traced_peak(stack)
+            stack.pop()
+            with self._lock:
+                record = self.stages.setdefault(name, StageRecord())
+                record.calls += 1
+                record.seconds += seconds
+                record.rows += open_stage.rows
+                if rss_after is not None:
+                    record.max_rss_mb = max(record.max_rss_mb or 0.0, rss_after)
+                    record.rss_growth_mb = (record.rss_growth_mb or 0.0) + rss_after - rss_before
+                if self.trace_memory:
+                    record.peak_traced_mb = max(record.peak_traced_mb or 0.0, open_stage.peak_traced / 2 ** 20)
+
+    def count(self, name, n=1):
+        """ Add n to a counter. """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def close(self, status='ok'):
+        """ Stop the clock and write out the profiles. """
+        self.seconds = time.perf_counter() - self._start
+        self.status = status
+        if self._profilers:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+        for name, profiler in self._profilers.items():
+            path = self.profile_dir / f'{self.name}-{self.run_id}-{name}.prof'
+            profiler.dump_stats(path)
+            self.profiles[name] = str(path)
+
+    def to_dict(self):
+        """ JSON-ready summary of the run, one line of the run log. """
+        return {'run': self.name, 'run_id': self.run_id, 'started': self.started.isoformat(timespec='seconds'),
+                'pid': os.getpid(), 'status': self.status,
+                'seconds': round(self.seconds, 4) if self.seconds is not None else None,
+                'max_rss_mb': _round(max_rss_mb(), 1),
+                'stages': {name: record.to_dict() for name, record in self.stages.items()},
+                'counters': dict(self.counters), 'profiles': dict(self.profiles)}
+# end of class Run
+
+
+def profiled_stages():
+    """ Stage names listed in the PIRATES_PROFILE environment variable. """
+    return {name.strip() for name in os.environ.get(PROFILE_ENV, '').split(',') if name.strip()}
+
+
+@contextmanager
+def run(name, log_path=RUN_LOG_PATH, profile=None, profile_dir=PROFILE_DIR, trace_memory=False):
+    """
+    Open a run: every stage and counter reached inside it is recorded, and the summary is appended to the run log
+    when it closes (also when it fails, with status 'error').
+    :param name: Name of the run (e.g. 'ingest')
+    :param log_path: JSON lines file to append the run summary to, nothing is written if None
+    :param profile: Stage names to run under cProfile, the PIRATES_PROFILE environment variable if None
+    :param profile_dir: Folder for the .prof files
+    :param trace_memory: Also record the peak of Python allocations per stage with tracemalloc (slower)
+    :return: Context manager yielding the Run
+    """
+    global _active
+    if _active is not None:
+        raise RuntimeError(f'Run {_active.name!r} is already open')
+
+    current = Run(name, profiled_stages() if profile is None else profile, profile_dir, trace_memory)
+    tracing = trace_memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    _active = current
+    status = 'error'
+    try:
+        yield current
+        status = 'ok'
+    finally:
+        _active = None
+        current.close(status)
+        if tracing:
+            tracemalloc.stop()
+        if log_path is not None:
+            log_path = Path(log_path)
+            log_path.parent.mkdir(parents=True, exist_ok=True)
+            with log_path.open('a', encoding='utf-8') as f:
+                f.write(json.dumps(current.to_dict()) + '\n')
+
+
+def active_run():
+    """ The open Run, or None. """
+    return _active
+
+
+def stage(name):
+    """
+    Time a stage of the open run; does nothing outside a run.
+    :param name: Stage name
+    :return: Context manager yielding an object with add_rows(n)
+    """
+    current = _active
+    if current is None:
+        return nullcontext(_OpenStage())
+    return current.stage(name)
+
+
+def count(name, n=1):
+    """ Add n to a counter of the open run; does nothing outside a run. """
+    current = _active
+    if current is not None:
+        current.count(name, n)
+
+
+def timed(name=None, rows=None):
+    """
+    Decorator that times every call of a function as a stage of the open run.
+    :param name: Stage name, the function name if None
+    :param rows: Optional function of the return value giving the number of rows handled (e.g. len)
+    :return: Decorator
+    """
+    def decorate(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            current = _active
+            if current is None:
+                return func(*args, **kwargs)
+            with current.stage(stage_name) as open_stage:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    open_stage.add_rows(rows(result))
+            return result
+
+        return wrapper
+
+    return decorate
+
+
+# Marks the end of the iterable in timed_iter
+_END = object()
+
+
+def timed_iter(items, name, rows=len):
+    """
+    Time the production of each item of an iterable (e.g. reading each chunk of a csv) as a stage.
+    :param items: Iterable
+    :param name: Stage name
+    :param rows: Function of an item giving the number of rows in it, or None
+    :return: Generator of the same items
+    """
+    iterator = iter(items)
+    while True:
+        with stage(name) as open_stage:
+            item = next(iterator, _END)
+            if item is not _END and rows is not None:
+                open_stage.add_rows(rows(item))
+        if item is _END:
+            return
+        yield item
+
+
+def load_runs(log_path=RUN_LOG_PATH, name=None):
+    """
+    Stage timings of the logged runs, one row per (run, stage).
+    :param log_path: Run log to read
+    :param name: Only keep the runs of this name
+    :return: Dataframe with run, run_id, started, status, stage and the stage totals
+    """
+    import pandas as pd
+
+    rows = []
+    with Path(log_path).open(encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if name is not None and entry['run'] != name:
+                continue
+            for stage_name, record in entry['stages'].items():
+                rows.append({'run': entry['run'], 'run_id': entry['run_id'], 'started': entry['started'],
+                             'status': entry['status'], 'stage': stage_name, **record})
+    return pd.DataFrame(rows)
+
+
+def stage_regressions(runs, factor=1.25, min_seconds=0.05, history=10):
+    """
+    Stages of the latest run that took longer per row (per call for stages without rows) than usual.
+    :param runs: Dataframe from load_runs, for one run name
+    :param factor: Ratio to the median of the earlier runs above which a stage counts as regressed
+    :param min_seconds: Ignore stages faster than this in the latest run
+    :param history: Number of earlier successful runs to take the median over
+    :return: Dataframe of the regressed stages with their latest and usual cost and the ratio, worst first
+    """
+    import numpy as np
+    import pandas as pd
+
+    columns = ['stage', 'seconds', 'latest', 'usual', 'ratio']
+    if runs.empty:
+        return pd.DataFrame(columns=columns)
+    runs = runs.assign(cost=runs['seconds'] / np.where(runs['rows'] > 0, runs['rows'], runs['calls']))
+    order = runs.drop_duplicates('run_id').sort_values('started')['run_id'].tolist()
+    latest = runs[runs['run_id'] == order[-1]].set_index('stage')
+    earlier = runs[runs['run_id'].isin(order[:-1]) & (runs['status'] == 'ok')]
+    earlier = earlier[earlier['run_id'].isin(earlier.drop_duplicates('run_id')['run_id'].tail(history))]
+    usual = earlier.groupby('stage')['cost'].median()
+
+    table = pd.DataFrame({'seconds': latest['seconds'], 'latest': latest['cost'], 'usual': usual}).dropna()
+    table['ratio'] = table['latest'] / table['usual']
+    table = table[(table['ratio'] > factor) & (table['seconds'] >= min_seconds)]
+    return table.rename_axis('stage').reset_index()[columns].sort_values('ratio', ascending=False)
@@ -0,0 +1,187 @@
+"""
+This file contains a persistent on-disk cache for the NLP labels of incident details strings.
+Labels are keyed by a hash of the text plus a fingerprint of the model or rule set that produced them, so
+re-running the labeling over a new IMO pull only sends new or changed strings through spaCy.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+import numpy as np
+
+from instrument_functions import count
+
+# SQLite caps the number of host parameters in a single statement, so lookups go in chunks
+_QUERY_CHUNK = 500
+
+
+def text_key(text):
+    """
+    Hash an incident details string into a compact cache key.
+    :param text: String to hash
+    :return: 16 byte digest
+    """
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+def model_fingerprint(model_path):
+    """
+    Fingerprint a trained spaCy model from its meta.json (version, pipeline, labels and scores), which
+    changes every time the model is retrained.
+    :param model_path: Path to the model folder, e.g. Spacy_Files/model/model-best
+    :return: Hex digest string
+    """
+    meta = Path(model_path) / 'meta.json'
+    return hashlib.sha256(b'spancat:' + meta.read_bytes()).hexdigest()
+
+
+def ruleset_fingerprint(patterns, *extra):
+    """
+    Fingerprint a rule set from its token patterns plus anything else the results depend on.
+    :param patterns: Dictionary of label -> list of token patterns (see spacy_functions.matcher_patterns)
+    :param extra: Other values to fold into the fingerprint, e.g. the name and version of the language model
+    :return: Hex digest string
+    """
+    blob = json.dumps([patterns, [str(x) for x in extra]], sort_keys=True)
+    return hashlib.sha256(b'matcher:' + blob.encode('utf-8')).hexdigest()
+
+
+def pack_labels(labels):
+    """
+    Pack a 2D array of binary labels into one integer bitmask per row (bit i is label column i).
+    :param labels: Array of shape (n, n_labels) of 0/1 flags
+    :return: int64 array of length n
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    return labels @ (1 << np.arange(labels.shape[1], dtype=np.int64))
+
+
+def unpack_labels(masks, n_labels):
+    """
+    Inverse of pack_labels.
+    :param masks: Integer bitmask per row
+    :param n_labels: Number of label columns
+    :return: int8 array of shape (len(masks), n_labels)
+    """
+    masks = np.asarray(masks, dtype=np.int64)
+    return ((masks[:, None] >> np.arange(n_labels, dtype=np.int64)) & 1).astype(np.int8)
+
+
+class LabelCache:
+    """
+    SQLite-backed cache of label bitmasks, keyed by (fingerprint, text hash).
+    The cache holds at most max_entries rows across all fingerprints; the least recently used rows are evicted
+    first once it grows past that.
+    """
+
+    def __init__(self, path, fingerprint, max_entries=1_000_000):
+        self.path = Path(path)
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS labels ('
+                          'fingerprint TEXT NOT NULL, '
+                          'text_hash BLOB NOT NULL, '
+                          'mask INTEGER NOT NULL, '
+                          'last_used INTEGER NOT NULL, '
+                          'PRIMARY KEY (fingerprint, text_hash)) WITHOUT ROWID')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS labels_last_used ON labels (last_used)')
+        self.conn.commit()
+
+    def get_many(self, keys):
+        """
+        Look up the bitmasks for a collection of text keys and mark the hits as recently used.
+        :param keys: Iterable of keys from text_key
+        :return: Dictionary of key -> bitmask for the keys found in the cache
+        """
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), _QUERY_CHUNK):
+            chunk = keys[i:i + _QUERY_CHUNK]
+            marks = ','.join('?' * len(chunk))
+            rows = self.conn.execute(f'SELECT text_hash, mask FROM labels '
+                                     f'WHERE fingerprint = ? AND text_hash IN ({marks})',
+                                     [self.fingerprint, *chunk])
+            found.update(rows)
+
+        if found:
+            now = time.time_ns()
+            self.conn.executemany('UPDATE labels SET last_used = ? WHERE fingerprint = ? AND text_hash = ?',
+                                  [(now, self.fingerprint, key) for key in found])
+            self.conn.commit()
+        return found
+
+    def put_many(self, items):
+        """
+        Store bitmasks for a collection of text keys, then evict down to max_entries.
+        :param items: Dictionary of key -> bitmask
+        """
+        now = time.time_ns()
+        self.conn.executemany('INSERT OR REPLACE INTO labels (fingerprint, text_hash, mask, last_used) '
+                              'VALUES (?, ?, ?, ?)',
+                              [(self.fingerprint, key, int(mask), now) for key, mask in items.items()])
+        self.evict()
+        self.conn.commit()
+
+    def evict(self):
+        """ Drop the least recently used rows until the cache holds at most max_entries rows. """
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            self.conn.execute('DELETE FROM labels WHERE (fingerprint, text_hash) IN '
+                              '(SELECT fingerprint, text_hash FROM labels ORDER BY last_used LIMIT ?)',
+                              (excess,))
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM labels').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+# end of class LabelCache
+
+
+def cached_labels(texts, cache, label_fn, n_labels):
+    """
+    Label a list of texts, only calling label_fn for the texts the cache hasn't seen.
+    Repeated texts are only labeled once.
+    :param texts: List of strings to label
+    :param cache: LabelCache opened with the fingerprint of whatever label_fn runs
+    :param label_fn: Function taking a list of strings and returning an (n, n_labels) array of 0/1 flags
+    :param n_labels: Number of label columns label_fn returns
+    :return: int8 array of shape (len(texts), n_labels)
+    """
+    keys = [text_key(text) for text in texts]
+    masks = cache.get_many(set(keys))
+
+    # Label each missing text once
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in masks and key not in missing:
+            missing[key] = text
+    count('label_cache_hits', len(keys) - len(missing))
+    count('label_cache_misses', len(missing))
+    if missing:
+        new_labels = label_fn(list(missing.values()))
+        new_masks = dict(zip(missing.keys(), pack_labels(new_labels).tolist()))
+        cache.put_many(new_masks)
+        masks.update(new_masks)
+
+    return unpack_labels([masks[key] for key in keys], n_labels)
@@ -0,0 +1,288 @@
+"""
+This file contains the record linkage between the clean (data.world) and dirty (IMO) incident sets.
+Instead of comparing every clean incident with every dirty one, candidate pairs come from two blocking keys: a
+date window plus a cell of a 3D grid over the unit sphere (so incidents within max_nm of each other are always in
+neighbouring cells, at any latitude and across the antimeridian), and a date window plus the start of the ship
+name (for incidents without usable coordinates). The candidates are scored on ship name similarity, distance and
+date gap, matched one to one, and the two sets are merged into one canonical incident table.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import difflib
+import itertools
+import re
+
+import numpy as np
+import pandas as pd
+
+from coord_functions import haversine_nm, sphere_cells
+from instrument_functions import timed
+
+# Ship names that don't identify a ship
+UNKNOWN_NAMES = {'', 'unknown', 'not reported', 'n/a', 'na', 'none', 'unnamed', 'not known'}
+
+# Weights of the name, distance and date scores; a score that can't be computed (no name or no coordinates on
+# one side) is left out and the other weights are scaled up
+SCORE_WEIGHTS = {'name': 0.5, 'distance': 0.3, 'date': 0.2}
+
+# Canonical column -> (clean column, dirty column); the clean value is kept when both sources have one
+CANONICAL_COLUMNS = {
+    'Incident Date': ('Incident Date', 'Date'),
+    'Ship Name': ('Ship Name', 'Ship Name'),
+    'Ship Type': ('Ship Type', 'Ship Type'),
+    'Ship Flag': ('Ship Flag', 'country'),
+    'IMO No.': (None, 'IMO No.'),
+    'Area': ('Area', 'Area'),
+    'Latitude': ('Latitude', 'Lat_Dec'),
+    'Longitude': ('Longitude', 'Lon_Dec'),
+    'Consequences to Crew': ('Consequences to Crew', None),
+    'Incident details': (None, 'Incident details'),
+}
+
+_NAME_PREFIX_REGEX = re.compile(r'^(?:m\s*/?\s*[vts]|mv|mt|ms)\b\.?\s*')
+_NAME_PUNCTUATION_REGEX = re.compile(r'[^\w\s]')
+_SPACES_REGEX = re.compile(r'\s+')
+
+
+def normalize_ship_name(name):
+    """
+    Ship name as compared for linkage: case-folded, without punctuation, vessel prefixes (MV, M/T, ...) or extra
+    spaces.
+    :param name: Ship name string, or None/NaN
+    :return: Normalized string, '' for missing or unknown names
+    """
+    if name is None or pd.isna(name):
+        return ''
+    key = _NAME_PREFIX_REGEX.sub('', str(name).casefold().strip())
+    key = _SPACES_REGEX.sub(' ', _NAME_PUNCTUATION_REGEX.sub(' ', key)).strip()
+    return '' if key in UNKNOWN_NAMES else key
+
+
+def linkage_records(data_df, date_column, name_column='Ship Name', lat_column='Latitude', lon_column='Longitude'):
+    """
+    The fields of a source the linkage uses, one row per incident in the order of the dataframe.
+    :param data_df: Dataframe of incidents
+    :param date_column: Column with the incident dates
+    :param name_column: Column with the ship names
+    :param lat_column: Column with decimal latitudes
+    :param lon_column: Column with decimal longitudes
+    :return: Dataframe with 'day' (days since 1970-01-01, -1 if missing), 'name', 'lat' and 'lon'
+    """
+    dates = pd.to_datetime(data_df[date_column], errors='coerce')
+    day = (dates.to_numpy(dtype='datetime64[D]').astype(np.int64))
+    day[dates.isna().to_numpy()] = -1
+    codes, uniques = pd.factorize(data_df[name_column])
+    names = np.array([*(normalize_ship_name(name) for name in uniques), ''], dtype=object)[codes]
+    return pd.DataFrame({'day': day, 'name': names,
+                         'lat': pd.to_numeric(data_df[lat_column], errors='coerce').to_numpy(dtype=np.float64),
+                         'lon': pd.to_numeric(data_df[lon_column], errors='coerce').to_numpy(dtype=np.float64)})
+
+
+def _block_join(left_keys, right_keys, offsets):
+    """
+    Pairs of rows whose keys are equal once an offset is added to the right keys.
+    :param left_keys: Dataframe of integer key columns, indexed by left row
+    :param right_keys: Dataframe of the same key columns, indexed by right row
+    :param offsets: List of tuples to add to the right key columns (one neighbourhood)
+    :return: Dataframe with 'left' and 'right' row positions
+    """
+    columns = list(left_keys.columns)
+    expanded = pd.concat([right_keys + np.array(offset) for offset in offsets])
+    pairs = left_keys.rename_axis('left').reset_index().merge(
+        expanded.rename_axis('right').reset_index(), on=columns)
+    return pairs[['left', 'right']]
+
+
+@timed(rows=len)
+def candidate_pairs(left, right, window_days=3, max_nm=60.0, name_prefix=4):
+    """
+    Blocked candidate pairs: incidents within window_days of each other that are either in neighbouring grid
+    cells (within reach of max_nm) or whose ship names start the same.
+    :param left: Records from linkage_records
+    :param right: Records from linkage_records
+    :param window_days: Largest date gap of a candidate pair, in days
+    :param max_nm: Largest distance of a candidate pair found through the grid, in nautical miles
+    :param name_prefix: Number of characters of the (space-free) ship name the name blocks are keyed on
+    :return: Dataframe with 'left' and 'right' row positions and the 'day_gap' of each pair
+    """
+    width = window_days + 1
+    day_offsets = [-1, 0, 1]
+    blocks = []
+
+    # Date window + grid cell, for the incidents with coordinates
+    keep_left = (left['day'] >= 0) & left['lat'].notna() & left['lon'].notna()
+    keep_right = (right['day'] >= 0) & right['lat'].notna() & right['lon'].notna()
+    if keep_left.any() and keep_right.any():
+        def place_keys(records, keep):
+            cells = sphere_cells(records.loc[keep, 'lat'].to_numpy(), records.loc[keep, 'lon'].to_numpy(), max_nm)
+            return pd.DataFrame({'bin': records.loc[keep, 'day'].to_numpy() // width, 'x': cells[:, 0],
+                                 'y': cells[:, 1], 'z': cells[:, 2]}, index=records.index[keep])
+
+        offsets = [(d, *cell) for d in day_offsets for cell in itertools.product([-1, 0, 1], repeat=3)]
+        blocks.append(_block_join(place_keys(left, keep_left), place_keys(right, keep_right), offsets))
+
+    # Date window + start of the ship name, for everything with a name
+    keep_left = (left['day'] >= 0) & (left['name'] != '')
+    keep_right = (right['day'] >= 0) & (right['name'] != '')
+    if keep_left.any() and keep_right.any():
+        def name_keys(records, keep):
+            prefixes = records.loc[keep, 'name'].str.replace(' ', '', regex=False).str[:name_prefix]
+            return pd.DataFrame({'bin': records.loc[keep, 'day'].to_numpy() // width,
+                                 'prefix': pd.factorize(prefixes)[0]}, index=records.index[keep]), prefixes
+
+        left_keys, left_prefixes = name_keys(left, keep_left)
+        right_keys, right_prefixes = name_keys(right, keep_right)
+        # Prefix codes have to agree across both sides
+        codes = {prefix: code for code, prefix in enumerate(pd.unique(pd.concat([left_prefixes, right_prefixes])))}
+        left_keys['prefix'] = left_prefixes.map(codes).to_numpy()
+        right_keys['prefix'] = right_prefixes.map(codes).to_numpy()
+        blocks.append(_block_join(left_keys, right_keys, [(d, 0) for d in day_offsets]))
+
+    if not blocks:
+        return pd.DataFrame({'left': [], 'right': [], 'day_gap': []}, dtype=np.int64)
+    pairs = pd.concat(blocks).drop_duplicates(ignore_index=True)
+    pairs['day_gap'] = np.abs(left['day'].to_numpy()[pairs['left']] - right['day'].to_numpy()[pairs['right']])
+    return pairs[pairs['day_gap'] <= window_days].reset_index(drop=True)
+
+
+def name_similarity(left_names, right_names):
+    """
+    Similarity (difflib ratio, 0 to 1) of each pair of normalized names, computed once per distinct pair.
+    :param left_names: Array of normalized names
+    :param right_names: Array of normalized names of the same length
+    :return: Float array, NaN where either name is missing
+    """
+    pairs = pd.MultiIndex.from_arrays([left_names, right_names])
+    codes, uniques = pd.factorize(pairs)
+    ratios = np.array([difflib.SequenceMatcher(None, a, b).ratio() if a and b else np.nan for a, b in uniques],
+                      dtype=np.float64)
+    return ratios[codes] if len(codes) else np.empty(0)
+
+
+@timed(rows=len)
+def score_pairs(pairs, left, right, window_days=3, max_nm=60.0, weights=SCORE_WEIGHTS):
+    """
+    Score each candidate pair on name similarity, distance and date gap.
+    :param pairs: Candidate pairs from candidate_pairs
+    :param left: Records the pairs' left rows refer to
+    :param right: Records the pairs' right rows refer to
+    :param window_days: Date gap at which the date score reaches 0 (it is 1 on the same day)
+    :param max_nm: Distance at which the distance score reaches 0
+    :param weights: Dictionary of 'name', 'distance' and 'date' weights
+    :return: The pairs with 'name_sim', 'distance_nm' and 'score' columns
+    """
+    li, ri = pairs['left'].to_numpy(), pairs['right'].to_numpy()
+    pairs = pairs.copy()
+    pairs['name_sim'] = name_similarity(left['name'].to_numpy()[li], right['name'].to_numpy()[ri])
+    pairs['distance_nm'] = haversine_nm(left['lat'].to_numpy()[li], left['lon'].to_numpy()[li],
+                                        right['lat'].to_numpy()[ri], right['lon'].to_numpy()[ri])
+
+    components = {'name': pairs['name_sim'].to_numpy(),
+                  'distance': np.clip(1 - pairs['distance_nm'].to_numpy() / max_nm, 0, 1),
+                  'date': 1 - pairs['day_gap'].to_numpy() / (window_days + 1)}
+    total = np.zeros(len(pairs))
+    weight = np.zeros(len(pairs))
+    for name, values in components.items():
+        known = ~np.isnan(values)
+        total[known] += weights[name] * values[known]
+        weight[known] += weights[name]
+
+    # Without a name or a distance, the date alone doesn't link two incidents
+    identifiable = ~(np.isnan(components['name']) & np.isnan(components['distance']))
+    pairs['score'] = np.where(identifiable & (weight > 0), total / np.maximum(weight, 1e-12), 0.0)
+    return pairs
+
+
+def match_pairs(scored, threshold=0.75):
+    """
+    One-to-one matches, best score first: a pair is kept if it scores at least threshold and neither of its
+    incidents is matched yet.
+    :param scored: Scored pairs from score_pairs
+    :param threshold: Lowest score of a match
+    :return: The kept pairs, best first
+    """
+    scored = scored[scored['score'] >= threshold].sort_values(['score', 'day_gap'], ascending=[False, True],
+                                                               kind='stable')
+    used_left, used_right, keep = set(), set(), []
+    for row, left_row, right_row in zip(range(len(scored)), scored['left'].to_numpy(), scored['right'].to_numpy()):
+        if left_row in used_left or right_row in used_right:
+            continue
+        used_left.add(left_row)
+        used_right.add(right_row)
+        keep.append(row)
+    return scored.iloc[keep].reset_index(drop=True)
+
+
+def link_incidents(clean_df, dirty_df, window_days=3, max_nm=60.0, threshold=0.75, weights=SCORE_WEIGHTS,
+                   clean_columns=('Incident Date', 'Ship Name', 'Latitude', 'Longitude'),
+                   dirty_columns=('Date', 'Ship Name', 'Lat_Dec', 'Lon_Dec')):
+    """
+    Match the incidents of the clean and dirty sets.
+    :param clean_df: Clean (data.world) incidents
+    :param dirty_df: Dirty (IMO) incidents, with decimal coordinates (see coord_functions.add_decimal_coordinates)
+    :param window_days: Largest date gap of a match, in days
+    :param max_nm: Distance at which the distance score reaches 0, in nautical miles
+    :param threshold: Lowest score of a match
+    :param weights: Dictionary of 'name', 'distance' and 'date' weights
+    :param clean_columns: Date, ship name, latitude and longitude columns of the clean set
+    :param dirty_columns: Date, ship name, latitude and longitude columns of the dirty set
+    :return: Dataframe of matches with 'clean_row' and 'dirty_row' positions, 'day_gap', 'name_sim', 'distance_nm'
+        and 'score'
+    """
+    left = linkage_records(clean_df, *clean_columns)
+    right = linkage_records(dirty_df, *dirty_columns)
+    pairs = candidate_pairs(left, right, window_days, max_nm)
+    matches = match_pairs(score_pairs(pairs, left, right, window_days, max_nm, weights), threshold)
+    return matches.rename(columns={'left': 'clean_row', 'right': 'dirty_row'})
+
+
+def canonical_incidents(clean_df, dirty_df, matches, columns=CANONICAL_COLUMNS):
+    """
+    Merge the two sets into one incident table: one row per match, plus the unmatched incidents of each set.
+    :param clean_df: Clean (data.world) incidents
+    :param dirty_df: Dirty (IMO) incidents
+    :param matches: Matches from link_incidents
+    :param columns: Dictionary of canonical column -> (clean column, dirty column), None where a set has none
+    :return: Dataframe with the canonical columns, 'source' ('both', 'clean' or 'dirty'), 'clean_row', 'dirty_row'
+        and 'match_score', sorted by date
+    """
+    matched_clean = np.zeros(len(clean_df), dtype=bool)
+    matched_dirty = np.zeros(len(dirty_df), dtype=bool)
+    matched_clean[matches['clean_row'].to_numpy()] = True
+    matched_dirty[matches['dirty_row'].to_numpy()] = True
+    clean_rows = np.concatenate([matches['clean_row'].to_numpy(), np.flatnonzero(~matched_clean),
+                                 np.full((~matched_dirty).sum(), -1)]).astype(np.int64)
+    dirty_rows = np.concatenate([matches['dirty_row'].to_numpy(), np.full((~matched_clean).sum(), -1),
+                                 np.flatnonzero(~matched_dirty)]).astype(np.int64)
+
+    def take(data_df, column, rows):
+        """ Values of a column at the row positions, NaN/NaT where the row is -1 or the column is missing. """
+        if column is None or column not in data_df:
+            return pd.Series(np.nan, index=range(len(rows)))
+        values = data_df[column].reset_index(drop=True).reindex(np.where(rows >= 0, rows, len(data_df)))
+        return values.reset_index(drop=True)
+
+    merged = pd.DataFrame(index=range(len(clean_rows)))
+    for name, (clean_column, dirty_column) in columns.items():
+        clean_values = take(clean_df, clean_column, clean_rows)
+        dirty_values = take(dirty_df, dirty_column, dirty_rows)
+        if name == 'Incident Date':
+            clean_values = pd.to_datetime(clean_values, errors='coerce')
+            dirty_values = pd.to_datetime(dirty_values, errors='coerce')
+        elif name in ('Latitude', 'Longitude'):
+            clean_values = pd.to_numeric(clean_values, errors='coerce')
+            dirty_values = pd.to_numeric(dirty_values, errors='coerce')
+        merged[name] = clean_values.where(clean_values.notna(), dirty_values)
+
+    merged['source'] = np.select([(clean_rows >= 0) & (dirty_rows >= 0), clean_rows >= 0], ['both', 'clean'],
+                                 'dirty')
+    merged['clean_row'] = clean_rows
+    merged['dirty_row'] = dirty_rows
+    merged['match_score'] = np.concatenate([matches['score'].to_numpy(), np.full(len(clean_rows) - len(matches),
+                                                                                 np.nan)])
+    return merged.sort_values('Incident Date', kind='stable').reset_index(drop=True)
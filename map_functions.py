@@ -0,0 +1,288 @@
+"""
+This file contains the clustered incident map.
+Instead of one Folium CircleMarker (and its popup HTML) per incident, incidents are aggregated server side into
+grid clusters for every zoom level and written as small GeoJSON tiles, one per zoom level and 256 px map tile. The
+page draws only the tiles in view at the current zoom on a canvas, and the popup details of an incident are loaded
+only when it is clicked, from row shards written next to the tiles. The page size no longer grows with the number of
+incidents, so the map stays usable with 100k+ incidents.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import html
+import json
+from pathlib import Path
+from string import Template
+
+import numpy as np
+import pandas as pd
+
+from instrument_functions import timed
+from region_functions import REGION_BOXES
+from severity_functions import SEVERITY_COLORS, SEVERITY_LEVELS
+
+# Popup label -> column, for the clean (data.world) and dirty (IMO) data
+CLEAN_DETAIL_COLUMNS = {'Vessel Type': 'Ship Type', 'Ship Status': 'Ship Status', 'Ship Origin': 'Ship Flag',
+                        'Latitude': 'Latitude', 'Longitude': 'Longitude'}
+DIRTY_DETAIL_COLUMNS = {'Vessel Type': 'Vessel_Type', 'Ship Name': 'Ship Name', 'Ship Origin': 'country',
+                        'Latitude': 'Lat_Dec', 'Longitude': 'Lon_Dec'}
+
+TILE_PX = 256
+MAX_MERCATOR_LAT = 85.0511
+
+# Draws the tiles in view and loads popup details on click. $map is the Leaflet map variable and $config the
+# JSON config from cluster_map (levels, colors, zoom range, cell size, data folder or embedded data)
+_LOADER_JS = Template("""
+<script>
+window.addEventListener('load', function () {
+    var map = $map;
+    var config = $config;
+    var renderer = L.canvas();
+    var layer = L.layerGroup().addTo(map);
+    var cache = {};
+
+    function getJSON(path, done) {
+        if (config.data) { done(config.data[path] || null); return; }
+        if (path in cache) { done(cache[path]); return; }
+        fetch(config.base + '/' + path + '.json')
+            .then(function (response) { return response.ok ? response.json() : null; })
+            .then(function (data) { cache[path] = data; done(data); }, function () { done(null); });
+    }
+
+    function radius(n) { return 4 + 2 * Math.log2(n); }
+
+    function drawTile(fc, bounds) {
+        fc.features.forEach(function (f) {
+            var p = f.properties, c = f.geometry.coordinates, latlng = L.latLng(c[1], c[0]);
+            if (!bounds.contains(latlng)) { return; }
+            var color = config.colors[p.s];
+            var marker = L.circleMarker(latlng, {renderer: renderer, radius: radius(p.n), color: color,
+                                                 fillColor: color, fillOpacity: 0.8, weight: 1});
+            marker.on('click', function () { showPopup(marker, p); });
+            layer.addLayer(marker);
+        });
+    }
+
+    function draw() {
+        var zoom = Math.round(map.getZoom());
+        var z = Math.max(0, Math.min(config.maxZoom, zoom));
+        var scale = Math.pow(2, z - zoom);
+        var pixels = map.getPixelBounds();
+        var n = Math.pow(2, z) - 1;
+        var x0 = Math.max(0, Math.floor(pixels.min.x * scale / 256));
+        var x1 = Math.min(n, Math.floor(pixels.max.x * scale / 256));
+        var y0 = Math.max(0, Math.floor(pixels.min.y * scale / 256));
+        var y1 = Math.min(n, Math.floor(pixels.max.y * scale / 256));
+        var bounds = map.getBounds().pad(0.1);
+        layer.clearLayers();
+        for (var x = x0; x <= x1; x++) {
+            for (var y = y0; y <= y1; y++) {
+                getJSON(z + '/' + x + '/' + y, function (fc) {
+                    if (fc && Math.round(map.getZoom()) === zoom) { drawTile(fc, bounds); }
+                });
+            }
+        }
+    }
+
+    function showPopup(marker, p) {
+        var lines = ['<b>' + p.n + (p.n === 1 ? ' incident' : ' incidents') + '</b>'];
+        if (p.n > 1) {
+            p.c.forEach(function (count, level) { if (count) { lines.push(config.levels[level] + ': ' + count); } });
+        } else {
+            lines.push('Severity: ' + config.levels[p.s]);
+        }
+        if (!p.i) {
+            lines.push('Zoom in for details');
+            marker.bindPopup(lines.join('<br>')).openPopup();
+            return;
+        }
+        var pending = p.i.length, rows = {};
+        p.i.forEach(function (id) {
+            var shard = Math.floor(id / config.shardSize);
+            getJSON('details/' + shard, function (details) {
+                rows[id] = details ? details[id - shard * config.shardSize] : null;
+                if (--pending) { return; }
+                p.i.forEach(function (id) {
+                    if (!rows[id]) { return; }
+                    lines.push(rows[id].map(function (value, col) {
+                        return config.columns[col] + ': ' + value;
+                    }).join('<br>'));
+                });
+                marker.bindPopup(lines.join('<hr>'), {maxHeight: 300}).openPopup();
+            });
+        });
+    }
+
+    map.on('moveend', draw);
+    draw();
+});
+</script>
+""")
+
+
+def mercator_xy(lat, lon):
+    """
+    Web Mercator position of points as fractions of the world map (0 to 1, y growing south).
+    :param lat: Array of latitudes
+    :param lon: Array of longitudes
+    :return: Tuple of (x, y) arrays
+    """
+    lat = np.radians(np.clip(np.asarray(lat, dtype=np.float64), -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT))
+    x = (np.asarray(lon, dtype=np.float64) + 180) / 360
+    y = (1 - np.log(np.tan(np.pi / 4 + lat / 2)) / np.pi) / 2
+    return np.clip(x, 0, np.nextafter(1, 0)), np.clip(y, 0, np.nextafter(1, 0))
+
+
+def cluster_tiles(x, y, codes, n_levels, zoom, cell_px=64, max_ids=10):
+    """
+    Cluster incidents on a grid of cell_px pixel squares at one zoom level.
+    :param x: Array of Web Mercator x fractions (see mercator_xy)
+    :param y: Array of Web Mercator y fractions
+    :param codes: Array of severity codes
+    :param n_levels: Number of severity levels
+    :param zoom: Zoom level
+    :param cell_px: Cell size in screen pixels, a divisor of 256 so cells nest in map tiles
+    :param max_ids: Clusters with at most this many incidents list their positions, for popup details
+    :return: Dictionary of (tile x, tile y) -> GeoJSON FeatureCollection of the clusters in the tile
+    """
+    cells_per_tile = TILE_PX // cell_px
+    n_cells = 2 ** zoom * cells_per_tile
+    cx = (x * n_cells).astype(np.int64)
+    cy = (y * n_cells).astype(np.int64)
+    keys, inverse = np.unique(cy * n_cells + cx, return_inverse=True)
+    inverse = inverse.ravel()
+
+    counts = np.bincount(inverse, minlength=len(keys))
+    mean_x = np.bincount(inverse, weights=x, minlength=len(keys)) / counts
+    mean_y = np.bincount(inverse, weights=y, minlength=len(keys)) / counts
+    lon = mean_x * 360 - 180
+    lat = np.degrees(2 * np.arctan(np.exp(np.pi * (1 - 2 * mean_y))) - np.pi / 2)
+    level_counts = np.bincount(inverse * n_levels + codes, minlength=len(keys) * n_levels).reshape(-1, n_levels)
+    worst = n_levels - 1 - np.argmax(level_counts[:, ::-1] > 0, axis=1)
+
+    # Incident positions of each cluster, grouped by cluster
+    members = np.argsort(inverse, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+
+    tile_x, tile_y = (keys % n_cells) // cells_per_tile, (keys // n_cells) // cells_per_tile
+    tiles = {}
+    for i in range(len(keys)):
+        properties = {'n': int(counts[i]), 's': int(worst[i]), 'c': level_counts[i].tolist()}
+        if counts[i] <= max_ids:
+            properties['i'] = members[bounds[i]:bounds[i + 1]].tolist()
+        feature = {'type': 'Feature', 'properties': properties,
+                   'geometry': {'type': 'Point', 'coordinates': [round(lon[i], 5), round(lat[i], 5)]}}
+        tile = tiles.setdefault((int(tile_x[i]), int(tile_y[i])), {'type': 'FeatureCollection', 'features': []})
+        tile['features'].append(feature)
+    return tiles
+
+
+def build_map_data(data_df, lat_column='Latitude', lon_column='Longitude', severity_column='severity',
+                   detail_columns=CLEAN_DETAIL_COLUMNS, max_zoom=10, cell_px=64, shard_size=1000, max_ids=10):
+    """
+    Build the map payload: cluster tiles for every zoom level and the popup details in shards.
+    Incidents without coordinates or severity are left off the map.
+    :param data_df: Dataframe of incidents
+    :param lat_column: Column with decimal latitudes ('Lat_Dec' in the dirty data)
+    :param lon_column: Column with decimal longitudes ('Lon_Dec' in the dirty data)
+    :param severity_column: Column with the severity levels (see severity_functions.add_severity)
+    :param detail_columns: Dictionary of popup label -> column
+    :param max_zoom: Highest zoom level clusters are computed for; deeper zooms reuse it
+    :param cell_px: Cluster cell size in pixels (16, 32, 64, 128 or 256)
+    :param shard_size: Number of incidents per details shard
+    :param max_ids: Clusters with at most this many incidents show their details
+    :return: Tuple of (dictionary of payload path -> JSON data, list of the severity levels present)
+    """
+    if TILE_PX % cell_px:
+        raise ValueError(f'cell_px must divide {TILE_PX}, got {cell_px}')
+    severity = data_df[severity_column].astype(pd.CategoricalDtype(SEVERITY_LEVELS, ordered=True))
+    keep = (data_df[lat_column].notna() & data_df[lon_column].notna() & severity.notna()).to_numpy()
+    data_df = data_df[keep]
+    codes = severity[keep].cat.codes.to_numpy(dtype=np.int64)
+    x, y = mercator_xy(data_df[lat_column], data_df[lon_column])
+
+    payload = {}
+    for zoom in range(max_zoom + 1):
+        for (tile_x, tile_y), tile in cluster_tiles(x, y, codes, len(SEVERITY_LEVELS), zoom, cell_px,
+                                                    max_ids).items():
+            payload[f'{zoom}/{tile_x}/{tile_y}'] = tile
+
+    details = np.column_stack([data_df[column].astype(str).map(html.escape).to_numpy(dtype=object)
+                               for column in detail_columns.values()])
+    for shard, start in enumerate(range(0, len(details), shard_size)):
+        payload[f'details/{shard}'] = details[start:start + shard_size].tolist()
+
+    present = [level for level, count in zip(SEVERITY_LEVELS, np.bincount(codes, minlength=len(SEVERITY_LEVELS)))
+               if count]
+    return payload, present
+
+
+def write_map_data(payload, folder):
+    """
+    Write the map payload as compact JSON files under a folder (<zoom>/<x>/<y>.json and details/<shard>.json).
+    :param payload: Dictionary of payload path -> JSON data from build_map_data
+    :param folder: Output folder
+    """
+    folder = Path(folder)
+    for path, data in payload.items():
+        file = folder / f'{path}.json'
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_text(json.dumps(data, separators=(',', ':')), encoding='utf-8')
+
+
+@timed()
+def cluster_map(data_df, out_path=None, lat_column='Latitude', lon_column='Longitude', severity_column='severity',
+                detail_columns=CLEAN_DETAIL_COLUMNS, regions=REGION_BOXES, zoom_start=4, max_zoom=10, cell_px=64,
+                shard_size=1000):
+    """
+    Folium map of the incidents, clustered by zoom level and colored by the worst severity in each cluster.
+    :param data_df: Dataframe of incidents
+    :param out_path: Path to save the map html to; the payload is written to a <name>_data folder next to it and
+        loaded as needed, so the page has to be served over http (e.g. python -m http.server). If None, the payload
+        is embedded in the page instead, for display in a notebook
+    :param lat_column: Column with decimal latitudes
+    :param lon_column: Column with decimal longitudes
+    :param severity_column: Column with the severity levels
+    :param detail_columns: Dictionary of popup label -> column
+    :param regions: Dictionary of name -> (min_lat, max_lat, min_lon, max_lon) boxes to outline
+    :param zoom_start: Initial zoom level
+    :param max_zoom: Highest zoom level clusters are computed for
+    :param cell_px: Cluster cell size in pixels
+    :param shard_size: Number of incidents per details shard
+    :return: folium.Map
+    """
+    import folium
+
+    payload, present = build_map_data(data_df, lat_column, lon_column, severity_column, detail_columns, max_zoom,
+                                      cell_px, shard_size)
+    m = folium.Map(location=[data_df[lat_column].mean(), data_df[lon_column].mean()], zoom_start=zoom_start)
+
+    for name, (min_lat, max_lat, min_lon, max_lon) in regions.items():
+        folium.Rectangle(bounds=[[max_lat, min_lon], [min_lat, max_lon]], color='black', fill=False,
+                         tooltip=name).add_to(m)
+
+    legend = ''.join(f'<p><i class="fa fa-circle fa-1x" style="color:{SEVERITY_COLORS[level]}"></i> {level}</p>'
+                     for level in reversed(present))
+    m.get_root().html.add_child(folium.Element(
+        '<div style="position: fixed; bottom: 50px; left: 50px; width: 200px; background-color: white; '
+        'border:2px solid grey; z-index:9999; font-size:14px; padding: 0 8px;">'
+        f'<p><strong>Legend</strong></p>{legend}</div>'))
+
+    config = {'levels': SEVERITY_LEVELS, 'colors': [SEVERITY_COLORS[level] for level in SEVERITY_LEVELS],
+              'columns': list(detail_columns), 'maxZoom': max_zoom, 'shardSize': shard_size}
+    if out_path is None:
+        config['data'] = payload
+    else:
+        out_path = Path(out_path)
+        folder = out_path.with_name(f'{out_path.stem}_data')
+        write_map_data(payload, folder)
+        config['base'] = folder.name
+    m.get_root().html.add_child(folium.Element(_LOADER_JS.substitute(map=m.get_name(),
+                                                                     config=json.dumps(config))))
+    if out_path is not None:
+        m.save(out_path)
+    return m
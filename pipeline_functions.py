@@ -0,0 +1,499 @@
+"""
+This file contains the pipeline steps as plain functions and the `pirates` command line entry point.
+Each step of the notebooks and the wave script is a function here (ingest, label, enrich, aggregate, render), and
+each subcommand runs one of them inside an instrumented run (see instrument_functions.py). Heavy dependencies
+(spaCy, xarray, copernicusmarine, folium, bokeh, and pandas itself) are only imported by the steps that need them,
+so `pirates --help` and the cheap subcommands start in milliseconds.
+
+Usage:
+    pirates ingest [--model Spacy_Files/model/model-best]   # dirty IMO csv -> Model_Output.csv
+    pirates label IN OUT [--engine model|matcher]           # NLP labels for a table of incident details
+    pirates enrich [--offline]                              # wave heights for the clean data
+    pirates aggregate clean|dirty OUT                       # count cube as a table
+    pirates render map|dashboard [--data clean|dirty]       # Folium map or Bokeh dashboard
+    pirates link                                            # clean + dirty sets -> one canonical incident table
+    pirates hotspots                                        # add new incidents to the hotspot index, rank hotspots
+    pirates serve [--port 8750]                             # route risk-scoring HTTP service
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import argparse
+import sys
+from pathlib import Path
+
+CLEAN_DATA_PATH = Path('Data_Files/[Clean] IMO Piracy - 2000 to 2022 (PDV 01-2023).csv')
+DIRTY_DATA_PATH = Path('Data_Files/[Dirty]_ListOfIncidents_IMO.csv')
+MODEL_OUTPUT_PATH = Path('Data_Files/Model_Output.csv')
+MODEL_PATH = Path('Spacy_Files/model/model-best')
+LABEL_CACHE_PATH = Path('Data_Files/label_cache.sqlite')
+WAVES_PATH = Path('Results/piracy_df_waves1.csv')
+MAP_PATH = Path('Results/piracy_map.html')
+DIRTY_MAP_PATH = Path('Results/dirty_piracy_map.html')
+DASHBOARD_PATH = Path('Results/dashboard.html')
+CANONICAL_PATH = Path('Results/canonical_incidents.csv')
+HOTSPOT_STATE_PATH = Path('Data_Files/hotspot_state.npz')
+HOTSPOTS_PATH = Path('Results/hotspots.csv')
+
+# Wave data from 30 Sep 2021 to 25 Mar 2024 is available for the GLOBAL_ANALYSISFORECAST_WAV_001_027 product
+WAVE_START = '2021-09-30'
+WAVE_END = '2024-03-25'
+
+
+def read_incidents(path, **read_csv_kwargs):
+    """
+    Read a table of incidents from a csv or a Parquet file (see storage_functions.py).
+    :param path: Path to the .csv or .parquet file
+    :param read_csv_kwargs: Extra arguments for pd.read_csv
+    :return: Dataframe
+    """
+    if Path(path).suffix == '.parquet':
+        from storage_functions import read_table
+        return read_table(path)
+
+    import pandas as pd
+    from instrument_functions import stage
+
+    read_csv_kwargs.setdefault('dtype', {'IMO No.': str})
+    with stage('read_csv') as open_stage:
+        data_df = pd.read_csv(path, **read_csv_kwargs)
+        open_stage.add_rows(len(data_df))
+    return data_df
+
+
+def write_incidents(data_df, path):
+    """
+    Write a table of incidents to a csv, or to typed Parquet for a .parquet path.
+    :param data_df: Dataframe
+    :param path: Output path
+    :return: Number of rows written
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix == '.parquet':
+        from storage_functions import prepare_types, write_table
+        write_table(prepare_types(data_df.copy()), path)
+    else:
+        from instrument_functions import stage
+        with stage('write_csv') as open_stage:
+            data_df.to_csv(path, index=False)
+            open_stage.add_rows(len(data_df))
+    return len(data_df)
+
+
+def prepare_clean(path=CLEAN_DATA_PATH, registry=None, vessel_types=None):
+    """
+    The clean (data.world) incidents with the columns the analysis adds: severity, Vessel Category and region.
+    :param path: Path to the clean csv
+    :param registry: RegionRegistry, the region boxes if None
+    :param vessel_types: VesselTypeNormalizer, the shared default one if None
+    :return: Dataframe
+    """
+    from region_functions import default_registry
+    from severity_functions import CLEAN_RULES, add_severity
+    from vessel_functions import add_vessel_category
+
+    data_df = read_incidents(path)
+    add_severity(data_df, CLEAN_RULES)
+    add_vessel_category(data_df, normalizer=vessel_types)
+    (registry or default_registry()).label(data_df, lat_column='Latitude', lon_column='Longitude')
+    return data_df
+
+
+def prepare_dirty(path=MODEL_OUTPUT_PATH, registry=None, vessel_types=None, flag_index=None):
+    """
+    The labeled IMO incidents (Model_Output) with the columns the analysis adds. Columns already written by the
+    ingest pipeline are kept, the missing ones are added: Vessel_Type, Lat_Dec/Lon_Dec, country, severity and region.
+    :param path: Path to Model_Output.csv (or a .parquet written by the ingest pipeline)
+    :param registry: RegionRegistry, the region boxes if None
+    :param vessel_types: VesselTypeNormalizer, the shared default one if None
+    :param flag_index: FlagIndex, loaded with flag_functions.load_flag_index if None
+    :return: Dataframe
+    """
+    import pandas as pd
+    from region_functions import default_registry
+    from severity_functions import NLP_RULES, add_severity
+
+    data_df = read_incidents(path)
+    data_df = data_df.loc[:, ~data_df.columns.str.match(r'^Unnamed: \d+$')]
+    data_df['Date'] = pd.to_datetime(data_df['Date'])
+    if 'Vessel_Type' not in data_df:
+        from vessel_functions import add_vessel_category
+        add_vessel_category(data_df, column='Vessel_Type', normalizer=vessel_types)
+    if 'Lat_Dec' not in data_df:
+        from coord_functions import add_decimal_coordinates
+        data_df, _ = add_decimal_coordinates(data_df)
+    if 'country' not in data_df:
+        from flag_functions import add_flags, load_flag_index
+        data_df = add_flags(data_df, flag_index or load_flag_index())
+    if 'severity' not in data_df:
+        missing = [column for _, columns in NLP_RULES['rules'] for column in columns if column not in data_df]
+        if missing:
+            raise ValueError(f'{path} has no NLP labels ({", ".join(missing)}); label it with `pirates ingest '
+                             f'--model ...` or `pirates label` first')
+        add_severity(data_df, NLP_RULES)
+    if 'region' not in data_df:
+        (registry or default_registry()).label(data_df)
+    return data_df
+
+
+def ingest(in_path=DIRTY_DATA_PATH, out_path=MODEL_OUTPUT_PATH, model_path=None, cache_path=LABEL_CACHE_PATH,
+           flags=True, regions=True, chunksize=1000, batch_size=256, n_process=1):
+    """
+    Run the streaming ingest pipeline (see ingest_functions.run_ingest) over the dirty IMO csv.
+    :param in_path: Path to the dirty IMO csv
+    :param out_path: Path to the output csv, or a .parquet path
+    :param model_path: Trained SpanCat model to label the incident details with, labeling is skipped if None
+    :param cache_path: Label cache file, no cache if None
+    :param flags: Attribute ship flags from the IMO numbers
+    :param regions: Label the region of each incident
+    :param chunksize: Number of rows per chunk
+    :param batch_size: Number of texts spaCy buffers per batch
+    :param n_process: Number of processes to label with (-1 uses every core)
+    :return: Number of rows written
+    """
+    from ingest_functions import run_ingest
+
+    nlp = cache = None
+    if model_path is not None:
+        import spacy
+        nlp = spacy.load(model_path)
+        if cache_path is not None:
+            from label_cache import LabelCache, model_fingerprint
+            cache = LabelCache(cache_path, model_fingerprint(model_path))
+    flag_index = registry = None
+    if flags:
+        from flag_functions import load_flag_index
+        flag_index = load_flag_index()
+    if regions:
+        from region_functions import default_registry
+        registry = default_registry()
+
+    Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+    try:
+        return run_ingest(in_path, out_path, nlp=nlp, flag_index=flag_index, chunksize=chunksize,
+                          batch_size=batch_size, n_process=n_process, cache=cache, registry=registry)
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def label(in_path, out_path, column='Incident details', engine='model', model_path=MODEL_PATH,
+          base_model='en_core_web_md', cache_path=LABEL_CACHE_PATH, batch_size=256, n_process=1):
+    """
+    Add the NLP label columns (see spacy_functions.LABELS) to a table of incidents.
+    :param in_path: Path to the input .csv or .parquet
+    :param out_path: Path to the output .csv or .parquet
+    :param column: Column with the incident details
+    :param engine: 'model' for the SpanCat model, 'matcher' for the rule-based matcher (behind a MatcherScreen)
+    :param model_path: Trained SpanCat model, for the model engine
+    :param base_model: Language model the matcher runs on, for the matcher engine
+    :param cache_path: Label cache file, no cache if None
+    :param batch_size: Number of texts spaCy buffers per batch
+    :param n_process: Number of processes to label with (-1 uses every core)
+    :return: Number of rows written
+    """
+    import spacy
+    from label_cache import LabelCache, model_fingerprint
+    from spacy_functions import (MatcherScreen, generate_matcher, matcher_fingerprint, matcher_interpreter,
+                                 model_interpreter)
+
+    data_df = read_incidents(in_path)
+    if engine == 'model':
+        nlp = spacy.load(model_path)
+        cache = LabelCache(cache_path, model_fingerprint(model_path)) if cache_path is not None else None
+        try:
+            model_interpreter(data_df, column, nlp, batch_size=batch_size, n_process=n_process, cache=cache)
+        finally:
+            if cache is not None:
+                cache.close()
+    elif engine == 'matcher':
+        nlp = spacy.load(base_model)
+        cache = LabelCache(cache_path, matcher_fingerprint(nlp)) if cache_path is not None else None
+        try:
+            matcher_interpreter(data_df, column, nlp, generate_matcher(nlp), batch_size=batch_size,
+                                n_process=n_process, cache=cache, screen=MatcherScreen())
+        finally:
+            if cache is not None:
+                cache.close()
+    else:
+        raise ValueError(f"Unknown labeling engine {engine!r}, expected 'model' or 'matcher'")
+    return write_incidents(data_df, out_path)
+
+
+def enrich(in_path=CLEAN_DATA_PATH, out_path=WAVES_PATH, offline=False, start=WAVE_START, end=WAVE_END,
+           tolerance='30min'):
+    """
+    Add the wave height, direction and max height at each incident (the 3_wave_height_analysis.py step) and write
+    the incidents that got a wave height.
+    :param in_path: Path to the clean csv
+    :param out_path: Path to the output .csv or .parquet
+    :param offline: Only use the tiles already in the local wave cache (see wave_cache.py)
+    :param start: Skip incidents before this date (start of the wave dataset)
+    :param end: Skip incidents after this date (end of the wave dataset)
+    :param tolerance: Largest gap between an incident and the nearest wave reading, e.g. '30min'
+    :return: Number of rows written
+    """
+    import pandas as pd
+    from wave_cache import WaveTileCache, open_copernicus
+    from wave_functions import WAVE_DATASET_ID, enrich_waves
+
+    # Tiles are cached under Data_Files/wave_cache and the dataset is only opened when a tile is missing
+    wave_cache = WaveTileCache(source=lambda: open_copernicus(WAVE_DATASET_ID), dataset_id=WAVE_DATASET_ID,
+                               offline=offline)
+
+    data_df = read_incidents(in_path)
+    data_df = data_df.dropna(subset=['Latitude', 'Longitude']).reset_index(drop=True)
+    data_df['Incident Date'] = pd.to_datetime(data_df['Incident Date'])
+
+    data_df, _ = enrich_waves(data_df, wave_cache, time_tolerance=pd.Timedelta(tolerance), start=start, end=end)
+    return write_incidents(data_df[data_df['Wave Height'].notna()], out_path)
+
+
+def aggregate(out_path, data='clean', in_path=None):
+    """
+    Count the incidents into a cube (see aggregate_functions.py) and write its cells as a table.
+    :param out_path: Path to the output .csv or .parquet
+    :param data: 'clean' (CLEAN_DIMENSIONS) or 'dirty' (DIRTY_DIMENSIONS)
+    :param in_path: Path to the input table, the clean csv or Model_Output.csv if None
+    :return: CountCube
+    """
+    from aggregate_functions import CLEAN_DIMENSIONS, DIRTY_DIMENSIONS, CountCube
+
+    if data == 'clean':
+        cube = CountCube.from_frame(prepare_clean(in_path or CLEAN_DATA_PATH), CLEAN_DIMENSIONS)
+    else:
+        cube = CountCube.from_frame(prepare_dirty(in_path or MODEL_OUTPUT_PATH), DIRTY_DIMENSIONS,
+                                    date_column='Date')
+    write_incidents(cube.to_frame(), out_path)
+    return cube
+
+
+def render(what='map', data='clean', in_path=None, out_path=None, resources='cdn'):
+    """
+    Render the incident map or the regional dashboard to html.
+    :param what: 'map' (Folium cluster map) or 'dashboard' (Bokeh charts, clean data only)
+    :param data: 'clean' or 'dirty'
+    :param in_path: Path to the input table, the clean csv or Model_Output.csv if None
+    :param out_path: Path to the html file, MAP_PATH/DIRTY_MAP_PATH/DASHBOARD_PATH if None
+    :param resources: For the dashboard, 'cdn' or 'inline' (works offline)
+    :return: Path of the html file
+    """
+    if what == 'dashboard':
+        if data != 'clean':
+            raise ValueError('The dashboard charts are defined for the clean data only')
+        from aggregate_functions import CLEAN_DIMENSIONS, CountCube
+        from plot_functions import save_dashboard
+
+        out_path = Path(out_path or DASHBOARD_PATH)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        cube = CountCube.from_frame(prepare_clean(in_path or CLEAN_DATA_PATH), CLEAN_DIMENSIONS)
+        save_dashboard(cube, out_path, resources=resources)
+        return out_path
+
+    from map_functions import DIRTY_DETAIL_COLUMNS, cluster_map
+
+    if data == 'clean':
+        data_df = prepare_clean(in_path or CLEAN_DATA_PATH).dropna(subset=['Latitude', 'Longitude'])
+        out_path = Path(out_path or MAP_PATH)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        cluster_map(data_df, out_path)
+    else:
+        data_df = prepare_dirty(in_path or MODEL_OUTPUT_PATH).dropna(subset=['Lat_Dec', 'Lon_Dec'])
+        out_path = Path(out_path or DIRTY_MAP_PATH)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        cluster_map(data_df, out_path, lat_column='Lat_Dec', lon_column='Lon_Dec',
+                    detail_columns=DIRTY_DETAIL_COLUMNS)
+    return out_path
+
+
+def link(out_path=CANONICAL_PATH, clean_path=CLEAN_DATA_PATH, dirty_path=MODEL_OUTPUT_PATH, window_days=3,
+         max_nm=60.0, threshold=0.75):
+    """
+    Match the clean and dirty incidents (see linkage_functions.py) and write the merged canonical incident table.
+    :param out_path: Path to the output .csv or .parquet
+    :param clean_path: Path to the clean csv
+    :param dirty_path: Path to Model_Output.csv, the dirty IMO csv or a .parquet written by the ingest pipeline
+    :param window_days: Largest date gap of a match, in days
+    :param max_nm: Distance at which the distance score reaches 0, in nautical miles
+    :param threshold: Lowest score of a match
+    :return: Number of rows written
+    """
+    import pandas as pd
+    from linkage_functions import canonical_incidents, link_incidents
+
+    clean_df = read_incidents(clean_path)
+    dirty_df = read_incidents(dirty_path)
+    dirty_df['Date'] = pd.to_datetime(dirty_df['Date'])
+    if 'Lat_Dec' not in dirty_df:
+        from coord_functions import add_decimal_coordinates
+        dirty_df, _ = add_decimal_coordinates(dirty_df)
+    if 'country' not in dirty_df:
+        from flag_functions import add_flags, load_flag_index
+        dirty_df = add_flags(dirty_df, load_flag_index())
+
+    matches = link_incidents(clean_df, dirty_df, window_days=window_days, max_nm=max_nm, threshold=threshold)
+    return write_incidents(canonical_incidents(clean_df, dirty_df, matches), out_path)
+
+
+def hotspots(in_path=MODEL_OUTPUT_PATH, out_path=HOTSPOTS_PATH, state_path=HOTSPOT_STATE_PATH, eps_nm=50.0,
+             eps_days=30, min_samples=5, recent_days=365):
+    """
+    Add the incidents not seen yet to the saved hotspot index (see hotspot_functions.py) and write the ranked
+    hotspots. Meant to be run after each daily ingest: only the new incidents are clustered.
+    :param in_path: Path to Model_Output.csv, the dirty IMO csv or a .parquet written by the ingest pipeline
+    :param out_path: Path to the output .csv or .parquet, the hulls as WKT
+    :param state_path: Path to the saved hotspot index, rebuilt from scratch if the parameters changed
+    :param eps_nm: Neighbourhood radius in nautical miles
+    :param eps_days: Neighbourhood half-width in days
+    :param min_samples: Number of incidents within the neighbourhood of a core incident
+    :param recent_days: Length of the recent window the hotspots are ranked by
+    :return: Summary of the update
+    """
+    from hotspot_functions import load_hotspot_index
+
+    data_df = read_incidents(in_path)
+    if 'Lat_Dec' not in data_df:
+        from coord_functions import add_decimal_coordinates
+        data_df, _ = add_decimal_coordinates(data_df)
+
+    index = load_hotspot_index(state_path, eps_nm, eps_days, min_samples)
+    added = index.update(data_df)
+    index.save(state_path)
+    table = index.hotspots(recent_days=recent_days)
+    table['polygon'] = table['polygon'].map(lambda polygon: polygon.wkt)
+    write_incidents(table, out_path)
+    return f'{len(added)} new incidents, {len(index)} indexed, {len(table)} hotspots'
+
+
+def serve(host='127.0.0.1', port=8750, data_path=CLEAN_DATA_PATH, radius_nm=50.0, half_life_days=730,
+          cache_size=100_000, max_batch=64, max_wait_ms=2.0):
+    """
+    Serve route risk scores over HTTP until interrupted (see risk_service.py).
+    :param host: Interface to listen on
+    :param port: Port to listen on
+    :param data_path: Path to the clean csv
+    :param radius_nm: Incidents further than this from a route segment don't count
+    :param half_life_days: Age at which an incident counts half
+    :param cache_size: Number of segment scores to keep
+    :param max_batch: Largest number of legs scored in one batch
+    :param max_wait_ms: Longest time the first leg of a batch waits for others
+    :return: Service counters when it stopped
+    """
+    from risk_service import serve as serve_risk
+    return serve_risk(host, port, data_path, radius_nm, half_life_days, cache_size, max_batch, max_wait_ms)
+
+
+def build_parser():
+    """ Argument parser of the `pirates` command. """
+    parser = argparse.ArgumentParser(prog='pirates', description='Pirates of Monterey piracy incident pipeline.')
+    parser.add_argument('--run-log', type=Path, default=Path('Results/run_log.jsonl'),
+                        help='JSON lines file the stage timings of each run are appended to')
+    parser.add_argument('--no-run-log', action='store_true', help="Don't log the stage timings")
+    parser.add_argument('--profile', default=None,
+                        help='Comma separated stages to run under cProfile (default: $PIRATES_PROFILE)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sub = subparsers.add_parser('ingest', help='Dirty IMO csv -> Model_Output (streamed in chunks)')
+    sub.add_argument('--in', dest='in_path', type=Path, default=DIRTY_DATA_PATH)
+    sub.add_argument('--out', dest='out_path', type=Path, default=MODEL_OUTPUT_PATH)
+    sub.add_argument('--model', dest='model_path', type=Path, default=None,
+                     help='SpanCat model to label with (e.g. Spacy_Files/model/model-best), no labels if omitted')
+    sub.add_argument('--cache', dest='cache_path', type=Path, default=LABEL_CACHE_PATH)
+    sub.add_argument('--no-cache', dest='cache_path', action='store_const', const=None)
+    sub.add_argument('--no-flags', dest='flags', action='store_false')
+    sub.add_argument('--no-regions', dest='regions', action='store_false')
+    sub.add_argument('--chunksize', type=int, default=1000)
+    sub.add_argument('--batch-size', type=int, default=256)
+    sub.add_argument('--n-process', type=int, default=1)
+
+    sub = subparsers.add_parser('label', help='Add the NLP label columns to a table of incidents')
+    sub.add_argument('in_path', type=Path)
+    sub.add_argument('out_path', type=Path)
+    sub.add_argument('--column', default='Incident details')
+    sub.add_argument('--engine', choices=['model', 'matcher'], default='model')
+    sub.add_argument('--model', dest='model_path', type=Path, default=MODEL_PATH)
+    sub.add_argument('--base-model', default='en_core_web_md')
+    sub.add_argument('--cache', dest='cache_path', type=Path, default=LABEL_CACHE_PATH)
+    sub.add_argument('--no-cache', dest='cache_path', action='store_const', const=None)
+    sub.add_argument('--batch-size', type=int, default=256)
+    sub.add_argument('--n-process', type=int, default=1)
+
+    sub = subparsers.add_parser('enrich', help='Add wave heights to the clean incidents')
+    sub.add_argument('--in', dest='in_path', type=Path, default=CLEAN_DATA_PATH)
+    sub.add_argument('--out', dest='out_path', type=Path, default=WAVES_PATH)
+    sub.add_argument('--offline', action='store_true', help='Only use the local wave tile cache')
+    sub.add_argument('--start', default=WAVE_START)
+    sub.add_argument('--end', default=WAVE_END)
+    sub.add_argument('--tolerance', default='30min')
+
+    sub = subparsers.add_parser('aggregate', help='Count cube of the incidents as a table')
+    sub.add_argument('data', choices=['clean', 'dirty'])
+    sub.add_argument('out_path', type=Path)
+    sub.add_argument('--in', dest='in_path', type=Path, default=None)
+
+    sub = subparsers.add_parser('render', help='Incident map or regional dashboard html')
+    sub.add_argument('what', choices=['map', 'dashboard'])
+    sub.add_argument('--data', choices=['clean', 'dirty'], default='clean')
+    sub.add_argument('--in', dest='in_path', type=Path, default=None)
+    sub.add_argument('--out', dest='out_path', type=Path, default=None)
+    sub.add_argument('--resources', choices=['cdn', 'inline'], default='cdn')
+
+    sub = subparsers.add_parser('link', help='Merge the clean and dirty sets into one canonical incident table')
+    sub.add_argument('--out', dest='out_path', type=Path, default=CANONICAL_PATH)
+    sub.add_argument('--clean', dest='clean_path', type=Path, default=CLEAN_DATA_PATH)
+    sub.add_argument('--dirty', dest='dirty_path', type=Path, default=MODEL_OUTPUT_PATH)
+    sub.add_argument('--window-days', type=int, default=3)
+    sub.add_argument('--max-nm', type=float, default=60.0)
+    sub.add_argument('--threshold', type=float, default=0.75)
+
+    sub = subparsers.add_parser('hotspots', help='Add new incidents to the hotspot index and rank the hotspots')
+    sub.add_argument('--in', dest='in_path', type=Path, default=MODEL_OUTPUT_PATH)
+    sub.add_argument('--out', dest='out_path', type=Path, default=HOTSPOTS_PATH)
+    sub.add_argument('--state', dest='state_path', type=Path, default=HOTSPOT_STATE_PATH)
+    sub.add_argument('--eps-nm', type=float, default=50.0)
+    sub.add_argument('--eps-days', type=int, default=30)
+    sub.add_argument('--min-samples', type=int, default=5)
+    sub.add_argument('--recent-days', type=int, default=365)
+
+    sub = subparsers.add_parser('serve', help='Route risk-scoring HTTP service')
+    sub.add_argument('--host', default='127.0.0.1')
+    sub.add_argument('--port', type=int, default=8750)
+    sub.add_argument('--data', dest='data_path', type=Path, default=CLEAN_DATA_PATH)
+    sub.add_argument('--radius-nm', type=float, default=50.0)
+    sub.add_argument('--half-life-days', type=float, default=730)
+    sub.add_argument('--cache-size', type=int, default=100_000)
+    sub.add_argument('--max-batch', type=int, default=64)
+    sub.add_argument('--max-wait-ms', type=float, default=2.0)
+    return parser
+
+
+STEPS = {'ingest': ingest, 'label': label, 'enrich': enrich, 'aggregate': aggregate, 'render': render, 'link': link,
+         'hotspots': hotspots, 'serve': serve}
+
+
+def main(argv=None):
+    """ Entry point of the `pirates` command; returns the exit status. """
+    args = vars(build_parser().parse_args(argv))
+    command = args.pop('command')
+    run_log = args.pop('run_log')
+    log_path = None if args.pop('no_run_log') else run_log
+    profile = args.pop('profile')
+    profile = None if profile is None else [name.strip() for name in profile.split(',') if name.strip()]
+
+    from instrument_functions import run
+
+    with run(command, log_path=log_path, profile=profile) as current:
+        result = STEPS[command](**args)
+    if command == 'aggregate':
+        result = f'{len(result.counts)} cells, {result.total()} incidents'
+    print(f'{command}: {result} ({current.seconds:.2f} s)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
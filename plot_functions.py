@@ -0,0 +1,140 @@
+"""
+This file contains the Bokeh dashboard generator for the regional stacked bar charts.
+Each chart is one roll-up of the count cube (see aggregate_functions.py) over region, bars and stacks, held in a
+single ColumnDataSource of NumPy columns that every region tab shares; a tab only filters the rows of its region
+with a CDSView. The stacks are whatever categories the data has, so a category missing from a region is just zero,
+and all charts are saved together as one html file.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+from pathlib import Path
+
+import numpy as np
+
+from instrument_functions import timed
+from severity_functions import SEVERITY_COLORS
+
+DASHBOARD_PATH = Path('Results/dashboard.html')
+
+# Region tabs, in display order
+DASHBOARD_REGIONS = ['Gulf of Guinea', 'Gulf of Aden', 'Strait of Malacca']
+
+# Charts for the clean data: bars from 'index', stacked by 'stack'
+CLEAN_CHARTS = [
+    {'title': 'Piracy Incidents by Consequences to Crew and Vessel Category', 'index': 'Consequences to Crew',
+     'stack': 'Vessel Category', 'height': 800, 'width': 800},
+    {'title': 'Piracy Incidents by Consequences to Crew and Weapons Used', 'index': 'Consequences to Crew',
+     'stack': 'Weapons Used', 'height': 800, 'width': 800},
+    {'title': 'Piracy Incidents by Ship Flag and Severity Level', 'index': 'Ship Flag', 'stack': 'severity',
+     'height': 350, 'width': 1000},
+]
+
+# Fixed colors for the stacks of a dimension; other dimensions use a categorical palette
+STACK_COLORS = {'severity': SEVERITY_COLORS}
+
+
+def chart_table(cube, index, stack, regions=DASHBOARD_REGIONS, region_dimension='region'):
+    """
+    Roll the cube up to one wide table for a chart: a row per (region, bar) and a column of counts per stack.
+    :param cube: CountCube with the region, index and stack dimensions
+    :param index: Dimension for the bars
+    :param stack: Dimension for the stacks
+    :param regions: Regions to keep
+    :param region_dimension: Name of the region dimension of the cube
+    :return: Tuple of (data dictionary of NumPy columns 'region', 'factor' and one per stack, list of stacks)
+    """
+    counts = cube.counts_by([region_dimension, index, stack], {region_dimension: list(regions)})
+    table = counts.unstack(fill_value=0)
+    stacks = [str(label) for label in table.columns]
+    data = {'region': table.index.get_level_values(0).astype(str).to_numpy(dtype=object),
+            'factor': table.index.get_level_values(1).astype(str).to_numpy(dtype=object)}
+    for label, column in zip(stacks, table.columns):
+        data[label] = table[column].to_numpy(dtype=np.int32)
+    return data, stacks
+
+
+def stack_colors(stack, labels):
+    """ Colors for the stacks of a dimension. """
+    if stack in STACK_COLORS:
+        return [STACK_COLORS[stack].get(label, 'gray') for label in labels]
+    from bokeh.palettes import Category10, Category20, turbo
+    if len(labels) <= 10:
+        return list(Category10[10][:len(labels)])
+    if len(labels) <= 20:
+        return list(Category20[20][:len(labels)])
+    return list(turbo(len(labels)))
+
+
+@timed()
+def chart_tabs(cube, chart, regions=DASHBOARD_REGIONS, region_dimension='region'):
+    """
+    One chart as a tab per region, all drawn from one shared data source.
+    :param cube: CountCube
+    :param chart: Dictionary with 'title', 'index', 'stack' and optionally 'height' and 'width' (see CLEAN_CHARTS)
+    :param regions: Regions to make tabs for; regions without incidents are skipped
+    :param region_dimension: Name of the region dimension of the cube
+    :return: bokeh Tabs
+    """
+    from bokeh.models import CDSView, ColumnDataSource, GroupFilter, TabPanel, Tabs
+    from bokeh.plotting import figure
+
+    data, stacks = chart_table(cube, chart['index'], chart['stack'], regions, region_dimension)
+    source = ColumnDataSource(data=data)
+    colors = stack_colors(chart['stack'], stacks)
+
+    panels = []
+    for region in regions:
+        rows = data['region'] == region
+        if not rows.any():
+            continue
+        plot = figure(x_range=list(data['factor'][rows]), title=f"{chart['title']} in the {region}",
+                      height=chart.get('height', 600), width=chart.get('width', 800),
+                      tooltips=f"{chart['index']}: @factor<br>$name: @$name")
+        plot.vbar_stack(stacks, x='factor', width=0.5, color=colors, source=source, legend_label=stacks,
+                        view=CDSView(filter=GroupFilter(column_name='region', group=region)))
+        plot.xaxis.major_label_orientation = 'vertical'
+        plot.legend.click_policy = 'hide'
+        panels.append(TabPanel(child=plot, title=region))
+    return Tabs(tabs=panels)
+
+
+def build_dashboard(cube, charts=CLEAN_CHARTS, regions=DASHBOARD_REGIONS, region_dimension='region'):
+    """
+    All charts as tabs of region tabs.
+    :param cube: CountCube
+    :param charts: List of chart dictionaries
+    :param regions: Regions to make tabs for
+    :param region_dimension: Name of the region dimension of the cube
+    :return: bokeh Tabs
+    """
+    from bokeh.models import TabPanel, Tabs
+
+    return Tabs(tabs=[TabPanel(child=chart_tabs(cube, chart, regions, region_dimension),
+                               title=f"{chart['index']} / {chart['stack']}") for chart in charts])
+
+
+@timed()
+def save_dashboard(cube, out_path=DASHBOARD_PATH, charts=CLEAN_CHARTS, regions=DASHBOARD_REGIONS,
+                   region_dimension='region', title='Piracy Incidents by Region', resources='cdn'):
+    """
+    Build the dashboard and save it as one html file.
+    :param cube: CountCube
+    :param out_path: Path to the html file
+    :param charts: List of chart dictionaries
+    :param regions: Regions to make tabs for
+    :param region_dimension: Name of the region dimension of the cube
+    :param title: Page title
+    :param resources: 'cdn' to load BokehJS from the CDN, 'inline' to embed it so the file works offline
+    :return: bokeh Tabs
+    """
+    from bokeh.io import save
+    from bokeh.resources import CDN, INLINE
+
+    dashboard = build_dashboard(cube, charts, regions, region_dimension)
+    save(dashboard, filename=out_path, title=title, resources=INLINE if resources == 'inline' else CDN)
+    return dashboard
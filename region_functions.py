@@ -0,0 +1,168 @@
+"""
+This file contains the region registry used to tag piracy incidents with the operational areas they fall in.
+Regions are polygons (lat/lon boxes or shapes from a shapefile such as the GOaS ocean shapes) kept in an STRtree,
+so every incident is tagged with all of its containing regions in one query instead of one set of boolean masks
+per region and per dataframe.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from instrument_functions import timed
+
+OCEANS_PATH = Path('Map_Files/Oceans_shpfile_GOaS_v1_20211214/goas_v01.shp')
+
+# Areas of interest as (min_lat, max_lat, min_lon, max_lon), boundaries included
+REGION_BOXES = {
+    'Strait of Malacca': (-10, 10, 93, 150.0),
+    'Gulf of Aden': (10, 20, 40, 55.17),
+    'Gulf of Guinea': (-2, 7, -1, 10),
+}
+
+
+class RegionRegistry:
+    """
+    Named polygons in lon/lat (EPSG:4326) with a spatial index over them.
+    The STRtree is built the first time the registry is queried and rebuilt after regions are added.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.geometries = []
+        self._tree = None
+
+    def add(self, name, geometry):
+        """
+        Register a region.
+        :param name: Region name, used as the column name in membership
+        :param geometry: Shapely polygon in lon/lat
+        """
+        if name in self.names:
+            raise ValueError(f'Region {name!r} is already registered')
+        self.names.append(name)
+        self.geometries.append(geometry)
+        self._tree = None
+
+    def add_box(self, name, min_lat, max_lat, min_lon, max_lon):
+        """
+        Register a lat/lon box.
+        :param name: Region name
+        :param min_lat: Southern edge
+        :param max_lat: Northern edge
+        :param min_lon: Western edge
+        :param max_lon: Eastern edge
+        """
+        from shapely.geometry import box
+        self.add(name, box(min_lon, min_lat, max_lon, max_lat))
+
+    def add_shapefile(self, path=OCEANS_PATH, name_column='name'):
+        """
+        Register every shape in a shapefile, e.g. the GOaS ocean shapes.
+        :param path: Path to the .shp file
+        :param name_column: Column holding the region names
+        """
+        import geopandas as gpd
+        shapes = gpd.read_file(path)
+        if shapes.crs is not None:
+            shapes = shapes.to_crs(epsg=4326)
+        for name, geometry in zip(shapes[name_column].str.strip(), shapes.geometry):
+            self.add(name, geometry)
+
+    @property
+    def tree(self):
+        """ STRtree over the registered regions. """
+        if self._tree is None:
+            from shapely import STRtree
+            self._tree = STRtree(self.geometries)
+        return self._tree
+
+    def query(self, lat, lon):
+        """
+        Find every (incident, region) pair where the incident lies inside or on the edge of the region.
+        Incidents with a missing coordinate are in no region.
+        :param lat: Array of latitudes
+        :param lon: Array of longitudes
+        :return: Tuple of (incident positions, region positions) arrays
+        """
+        import shapely
+
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        valid = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+        if not self.names or not len(valid):
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+        points = shapely.points(lon[valid], lat[valid])
+        point_idx, region_idx = self.tree.query(points, predicate='intersects')
+        return valid[point_idx], region_idx
+
+    def membership(self, data_df, lat_column='Lat_Dec', lon_column='Lon_Dec'):
+        """
+        One boolean column per region telling whether each incident is inside it.
+        :param data_df: Dataframe of incidents
+        :param lat_column: Column with decimal latitudes ('Latitude' in the clean data)
+        :param lon_column: Column with decimal longitudes ('Longitude' in the clean data)
+        :return: Boolean dataframe with the same index as data_df and a column per region
+        """
+        point_idx, region_idx = self.query(data_df[lat_column], data_df[lon_column])
+        member = np.zeros((len(data_df), len(self.names)), dtype=bool)
+        member[point_idx, region_idx] = True
+        return pd.DataFrame(member, index=data_df.index, columns=self.names)
+
+    def tag(self, data_df, lat_column='Lat_Dec', lon_column='Lon_Dec', column='regions'):
+        """
+        Add a column listing the regions each incident falls in, in registration order.
+        :param data_df: Dataframe of incidents
+        :param lat_column: Column with decimal latitudes
+        :param lon_column: Column with decimal longitudes
+        :param column: Name of the new column
+        :return: Dataframe with the regions column (tuples of region names, empty if none)
+        """
+        point_idx, region_idx = self.query(data_df[lat_column], data_df[lon_column])
+        order = np.lexsort((region_idx, point_idx))
+        point_idx, region_idx = point_idx[order], region_idx[order]
+
+        names = np.array(self.names, dtype=object)
+        bounds = np.searchsorted(point_idx, np.arange(len(data_df) + 1))
+        data_df[column] = [tuple(names[region_idx[start:stop]]) for start, stop in zip(bounds[:-1], bounds[1:])]
+        return data_df
+
+    @timed('region_label', rows=len)
+    def label(self, data_df, lat_column='Lat_Dec', lon_column='Lon_Dec', column='region', default=None):
+        """
+        Add a column with the first region (in registration order) each incident falls in, for grouping.
+        :param data_df: Dataframe of incidents
+        :param lat_column: Column with decimal latitudes
+        :param lon_column: Column with decimal longitudes
+        :param column: Name of the new column
+        :param default: Value for incidents in no region
+        :return: Dataframe with the region column
+        """
+        point_idx, region_idx = self.query(data_df[lat_column], data_df[lon_column])
+        first = np.full(len(data_df), len(self.names))
+        np.minimum.at(first, point_idx, region_idx)
+        data_df[column] = np.array([*self.names, default], dtype=object)[first]
+        return data_df
+# end of class RegionRegistry
+
+
+def default_registry(oceans=False):
+    """
+    Registry with the areas of interest from REGION_BOXES and, optionally, the GOaS ocean shapes.
+    :param oceans: Also register the ocean shapes from OCEANS_PATH
+    :return: RegionRegistry
+    """
+    registry = RegionRegistry()
+    for name, bounds in REGION_BOXES.items():
+        registry.add_box(name, *bounds)
+    if oceans:
+        registry.add_shapefile(OCEANS_PATH)
+    return registry
@@ -0,0 +1,594 @@
+"""
+This file contains the route risk-scoring service: an asyncio HTTP server that scores voyage legs against the
+incident history kept in memory.
+A leg is a vessel type, a flag and a route polyline. Each segment of the route is scored from the historical incidents
+within radius_nm of it, weighted by severity, by how long ago they happened (exponential decay) and by whether the
+attacked vessel had the same vessel category and flag. The route score is the sum of its segment scores.
+
+Segment vertices are snapped to a QUANTUM_DEG grid, so legs that share (nearly) the same segments share cache entries.
+Concurrent requests are gathered into small batches and each distinct uncached segment in a batch is scored once.
+The load-test harness (python risk_service.py) reports the throughput and latency percentiles under concurrent load.
+
+Usage:
+    pirates serve [--port 8750]                             # start the service
+    python risk_service.py [--port 8750]                    # load test it (an in-process server if no --port)
+
+    POST /score  {"vessel_type": "Bulk Carrier", "flag": "Panama", "route": [[lat, lon], [lat, lon], ...]}
+                 or {"legs": [{...}, {...}]} for several legs in one request
+    GET /stats   request, batch, cache and latency counters
+    GET /health
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from coord_functions import NM_PER_RADIAN, haversine_nm, sphere_cells
+from instrument_functions import count, timed
+
+CLEAN_DATA_PATH = Path('Data_Files/[Clean] IMO Piracy - 2000 to 2022 (PDV 01-2023).csv')
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8750
+
+# Weight of an incident of each severity level (see severity_functions.SEVERITY_LEVELS)
+SEVERITY_WEIGHTS = {'Unsuccessful Attempt': 0.5, 'low': 1.0, 'medium': 2.0, 'high': 4.0}
+
+# Route vertices are snapped to this grid (in degrees, about 3 nm) before scoring and caching
+QUANTUM_DEG = 0.05
+
+# Latency percentiles reported by the service and the load test
+PERCENTILES = (50, 90, 99)
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+_CELL_OFFSETS = list(itertools.product((-1, 0, 1), repeat=3))
+
+
+def normalize_flag(flag):
+    """ Flag state as compared by the index (case and surrounding spaces ignored). """
+    return flag.strip().lower() if isinstance(flag, str) else None
+
+
+def quantize(route, quantum=QUANTUM_DEG):
+    """
+    Snap route vertices to the quantum grid.
+    :param route: Sequence of at least two (lat, lon) vertices
+    :param quantum: Grid step in degrees
+    :return: List of (lat, lon) grid coordinates as integers, repeated vertices dropped
+    """
+    if not isinstance(route, (list, tuple)) or len(route) < 2:
+        raise ValueError('route must be a list of at least two [lat, lon] vertices')
+    vertices = []
+    for vertex in route:
+        try:
+            lat, lon = (float(value) for value in vertex)
+        except (TypeError, ValueError):
+            raise ValueError(f'invalid route vertex {vertex!r}') from None
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError(f'route vertex {vertex!r} is out of range')
+        vertex = (round(lat / quantum), round(lon / quantum))
+        if not vertices or vertices[-1] != vertex:
+            vertices.append(vertex)
+    return vertices
+
+
+class RiskIndex:
+    """
+    The incidents held in memory for scoring: positions, decayed severity weights, vessel category and flag codes,
+    and a grid index of sphere cells of side radius_nm for the neighbour queries.
+    """
+
+    def __init__(self, data_df, radius_nm=50.0, half_life_days=730, vessel_weight=1.0, flag_weight=0.5, as_of=None,
+                 lat_column='Latitude', lon_column='Longitude', date_column='Incident Date', normalizer=None):
+        """
+        :param data_df: Dataframe of incidents with severity and Vessel Category columns (see
+            pipeline_functions.prepare_clean)
+        :param radius_nm: Incidents further than this from a segment don't count
+        :param half_life_days: Age at which an incident counts half
+        :param vessel_weight: Extra weight of incidents on vessels of the same category (1.0 counts them double)
+        :param flag_weight: Extra weight of incidents on vessels under the same flag
+        :param as_of: Date the incident ages are taken at, the latest incident if None
+        :param lat_column: Column with decimal latitudes
+        :param lon_column: Column with decimal longitudes
+        :param date_column: Column with the incident dates
+        :param normalizer: VesselTypeNormalizer mapping the requested vessel types, a new one if None
+        """
+        from vessel_functions import VesselTypeNormalizer
+
+        dates = pd.to_datetime(data_df[date_column], errors='coerce')
+        lat = pd.to_numeric(data_df[lat_column], errors='coerce').to_numpy(dtype=np.float64)
+        lon = pd.to_numeric(data_df[lon_column], errors='coerce').to_numpy(dtype=np.float64)
+        keep = dates.notna().to_numpy() & ~np.isnan(lat) & ~np.isnan(lon)
+        data_df, dates = data_df[keep], dates[keep]
+
+        self.radius_nm = float(radius_nm)
+        self.vessel_weight = float(vessel_weight)
+        self.flag_weight = float(flag_weight)
+        self.as_of = pd.Timestamp(as_of) if as_of is not None else dates.max()
+        self.normalizer = normalizer or VesselTypeNormalizer()
+        self.lat, self.lon = lat[keep], lon[keep]
+
+        age_days = ((self.as_of - dates).dt.days.to_numpy()).clip(min=0)
+        severity = data_df['severity'].astype(str).map(SEVERITY_WEIGHTS).fillna(1.0).to_numpy(dtype=np.float64)
+        self.weight = severity * 0.5 ** (age_days / half_life_days)
+
+        self.category_codes, categories = pd.factorize(data_df['Vessel Category'])
+        self.flag_codes, flags = pd.factorize(data_df['Ship Flag'].map(normalize_flag))
+        self.categories = {category: code for code, category in enumerate(categories)}
+        self.flags = {flag: code for code, flag in enumerate(flags)}
+
+        # Grid index: incidents sorted by cell, and each cell's slice of that order
+        cells = sphere_cells(self.lat, self.lon, self.radius_nm)
+        unique, inverse = np.unique(cells, axis=0, return_inverse=True)
+        order = np.argsort(inverse.ravel(), kind='stable')
+        bounds = np.searchsorted(inverse.ravel()[order], np.arange(len(unique) + 1))
+        self._cells = {tuple(cell): order[bounds[i]:bounds[i + 1]] for i, cell in enumerate(unique.tolist())}
+
+    def __len__(self):
+        return len(self.lat)
+
+    @classmethod
+    def from_clean(cls, path=CLEAN_DATA_PATH, **kwargs):
+        """
+        Index of the clean (data.world) incidents.
+        :param path: Path to the clean csv
+        :param kwargs: Passed on to RiskIndex
+        :return: RiskIndex
+        """
+        from pipeline_functions import prepare_clean
+        return cls(prepare_clean(path), **kwargs)
+
+    def profile_codes(self, vessel_type, flag):
+        """ Vessel category and flag codes of a requested vessel, -1 where no incident has them. """
+        category = self.normalizer.category(vessel_type) if vessel_type else None
+        return self.categories.get(category, -1), self.flags.get(normalize_flag(flag), -1)
+
+    def _candidates(self, points):
+        """ Incidents in the grid cells around the given (n, 3) cell coordinates. """
+        cells = {(x + dx, y + dy, z + dz) for x, y, z in points.tolist() for dx, dy, dz in _CELL_OFFSETS}
+        found = [self._cells[cell] for cell in cells if cell in self._cells]
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+    def segment_score(self, start, end, category_code=-1, flag_code=-1):
+        """
+        Risk of one route segment.
+        :param start: (lat, lon) of the segment start
+        :param end: (lat, lon) of the segment end
+        :param category_code: Vessel category code from profile_codes
+        :param flag_code: Flag code from profile_codes
+        :return: (score, number of incidents within radius_nm)
+        """
+        # Points along the great circle, at most a quarter radius apart
+        lat, lon = np.radians([start[0], end[0]]), np.radians([start[1], end[1]])
+        xyz = np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+        length_nm = NM_PER_RADIAN * np.arccos(np.clip(xyz[0] @ xyz[1], -1, 1))
+        steps = np.linspace(0, 1, int(np.ceil(4 * length_nm / self.radius_nm)) + 1)[:, None]
+        points = xyz[0] * (1 - steps) + xyz[1] * steps
+        points /= np.linalg.norm(points, axis=1, keepdims=True)
+        points_lat = np.degrees(np.arcsin(np.clip(points[:, 2], -1, 1)))
+        points_lon = np.degrees(np.arctan2(points[:, 1], points[:, 0]))
+
+        candidates = self._candidates(sphere_cells(points_lat, points_lon, self.radius_nm))
+        if not len(candidates):
+            return 0.0, 0
+        distance = haversine_nm(self.lat[candidates, None], self.lon[candidates, None], points_lat, points_lon)
+        distance = distance.min(axis=1)
+        near = distance <= self.radius_nm
+        candidates, distance = candidates[near], distance[near]
+        weight = self.weight[candidates] * (1 - distance / self.radius_nm)
+        weight *= 1 + self.vessel_weight * (self.category_codes[candidates] == category_code)
+        weight *= 1 + self.flag_weight * (self.flag_codes[candidates] == flag_code)
+        return float(weight.sum()), int(len(candidates))
+# end of class RiskIndex
+
+
+class RiskScorer:
+    """
+    Scores batches of legs with an LRU cache of segment scores keyed on the quantized segment and vessel profile.
+    """
+
+    def __init__(self, index, cache_size=100_000, quantum=QUANTUM_DEG):
+        """
+        :param index: RiskIndex
+        :param cache_size: Number of segment scores to keep
+        :param quantum: Grid step route vertices are snapped to, in degrees
+        """
+        self.index = index
+        self.cache_size = cache_size
+        self.quantum = quantum
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @timed('risk_batch', rows=len)
+    def score_batch(self, legs):
+        """
+        Score several legs, computing each distinct uncached segment once.
+        :param legs: List of dictionaries with route, and optionally vessel_type and flag
+        :return: List with, for each leg, a dictionary with score, peak (highest segment score) and segments (score
+            and incidents of each segment), or a ValueError for an invalid leg
+        """
+        keyed = []
+        for leg in legs:
+            try:
+                if not isinstance(leg, dict):
+                    raise ValueError('each leg must be a JSON object')
+                codes = self.index.profile_codes(leg.get('vessel_type'), leg.get('flag'))
+                vertices = quantize(leg.get('route'), self.quantum)
+                keyed.append([(*start, *end, *codes) for start, end in zip(vertices, vertices[1:])])
+            except ValueError as error:
+                keyed.append(error)
+
+        hits = 0
+        scores = {}
+        for keys in keyed:
+            if isinstance(keys, ValueError):
+                continue
+            for key in keys:
+                if key in scores:
+                    continue
+                cached = self.cache.get(key)
+                if cached is not None:
+                    self.cache.move_to_end(key)
+                    hits += 1
+                    scores[key] = cached
+                else:
+                    q = self.quantum
+                    scores[key] = self.cache[key] = self.index.segment_score((key[0] * q, key[1] * q),
+                                                                             (key[2] * q, key[3] * q), *key[4:])
+        misses = len(scores) - hits
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        self.hits += hits
+        self.misses += misses
+        count('risk_cache_hits', hits)
+        count('risk_cache_misses', misses)
+
+        results = []
+        for keys in keyed:
+            if isinstance(keys, ValueError):
+                results.append(keys)
+                continue
+            segments = [scores[key] for key in keys]
+            results.append({'score': sum(score for score, _ in segments),
+                            'peak': max((score for score, _ in segments), default=0.0),
+                            'segments': [{'score': score, 'incidents': incidents} for score, incidents in segments]})
+        return results
+# end of class RiskScorer
+
+
+def _percentiles(latencies):
+    """ Latency percentiles in milliseconds. """
+    if not len(latencies):
+        return {f'p{q}_ms': None for q in PERCENTILES}
+    values = np.percentile(np.asarray(latencies) * 1000, PERCENTILES)
+    return {f'p{q}_ms': round(float(value), 3) for q, value in zip(PERCENTILES, values)}
+
+
+class RiskService:
+    """
+    asyncio HTTP/1.1 server (keep-alive, JSON bodies) in front of a RiskScorer. Legs of concurrent requests wait
+    at most max_wait_ms to be scored together in batches of up to max_batch legs.
+    """
+
+    def __init__(self, scorer, max_batch=64, max_wait_ms=2.0, max_body=1 << 20):
+        """
+        :param scorer: RiskScorer
+        :param max_batch: Largest number of legs scored in one batch
+        :param max_wait_ms: Longest time the first leg of a batch waits for others
+        :param max_body: Largest accepted request body, in bytes
+        """
+        self.scorer = scorer
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.max_body = max_body
+        self.requests = 0
+        self.batches = 0
+        self.batched_legs = 0
+        self.latencies = collections.deque(maxlen=10_000)
+        self._queue = None
+        self._batcher = None
+
+    async def _batch_loop(self):
+        """ Take the queued legs in batches and resolve their futures. """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            try:
+                results = self.scorer.score_batch([leg for leg, _ in batch])
+            except Exception as error:
+                results = [error] * len(batch)
+            self.batches += 1
+            self.batched_legs += len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    async def score(self, legs):
+        """
+        Score legs through the batcher.
+        :param legs: List of leg dictionaries
+        :return: List of results (see RiskScorer.score_batch)
+        """
+        loop = asyncio.get_running_loop()
+        futures = []
+        for leg in legs:
+            future = loop.create_future()
+            self._queue.put_nowait((leg, future))
+            futures.append(future)
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def stats(self):
+        """ Counters of the service since it started. """
+        scorer = self.scorer
+        lookups = scorer.hits + scorer.misses
+        return {'requests': self.requests, 'batches': self.batches,
+                'mean_batch': round(self.batched_legs / self.batches, 2) if self.batches else None,
+                'cache_size': len(scorer.cache), 'cache_hits': scorer.hits, 'cache_misses': scorer.misses,
+                'cache_hit_rate': round(scorer.hits / lookups, 4) if lookups else None,
+                'incidents': len(scorer.index), **_percentiles(self.latencies)}
+
+    async def _respond(self, body):
+        """ Status and JSON payload of a POST /score body. """
+        try:
+            payload = json.loads(body)
+        except (UnicodeDecodeError, json.JSONDecodeError) as error:
+            return 400, {'error': f'invalid JSON: {error}'}
+        if not isinstance(payload, dict):
+            return 400, {'error': 'the request body must be a JSON object'}
+        legs = payload['legs'] if 'legs' in payload else [payload]
+        if not isinstance(legs, list) or not legs:
+            return 400, {'error': 'legs must be a non-empty list'}
+        try:
+            results = await self.score(legs)
+        except ValueError as error:
+            return 400, {'error': str(error)}
+        except Exception as error:
+            return 500, {'error': f'{type(error).__name__}: {error}'}
+        return 200, (results[0] if 'legs' not in payload else {'legs': results})
+
+    async def _handle(self, reader, writer):
+        """ Serve the requests of one connection until the client closes it. """
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                start = time.perf_counter()
+                lines = head.decode('latin-1').split('\r\n')
+                method, target, version = (lines[0].split(' ', 2) + ['', ''])[:3]
+                headers = dict(line.lower().split(':', 1) for line in lines[1:] if ':' in line)
+                path = target.split('?', 1)[0]
+                try:
+                    length = int(headers.get('content-length', '0').strip() or 0)
+                except ValueError:
+                    length = self.max_body + 1
+                if length > self.max_body:
+                    status, payload = 400, {'error': 'invalid or too large Content-Length'}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    keep_alive = (headers.get('connection', '').strip() != 'close'
+                                  and version.strip() == 'HTTP/1.1')
+                    if path == '/score':
+                        if method == 'POST':
+                            status, payload = await self._respond(body)
+                        else:
+                            status, payload = 405, {'error': 'use POST'}
+                    elif path == '/stats':
+                        status, payload = 200, self.stats()
+                    elif path == '/health':
+                        status, payload = 200, {'status': 'ok'}
+                    else:
+                        status, payload = 404, {'error': f'no route {path}'}
+
+                data = json.dumps(payload).encode()
+                writer.write(f'HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Type: application/json\r\n'
+                             f'Content-Length: {len(data)}\r\nConnection: {"keep-alive" if keep_alive else "close"}'
+                             f'\r\n\r\n'.encode() + data)
+                await writer.drain()
+                if path == '/score':
+                    self.requests += 1
+                    self.latencies.append(time.perf_counter() - start)
+                if not keep_alive:
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+        finally:
+            writer.close()
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """
+        Start listening and batching.
+        :param host: Interface to listen on
+        :param port: Port to listen on, 0 for any free port
+        :return: asyncio Server (its sockets give the actual port)
+        """
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._batch_loop())
+        return await asyncio.start_server(self._handle, host, port)
+
+    async def stop(self, server):
+        """ Stop a server started with start. """
+        server.close()
+        await server.wait_closed()
+        self._batcher.cancel()
+# end of class RiskService
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, data_path=CLEAN_DATA_PATH, radius_nm=50.0, half_life_days=730,
+          cache_size=100_000, max_batch=64, max_wait_ms=2.0):
+    """
+    Load the incidents and serve risk scores until interrupted.
+    :param host: Interface to listen on
+    :param port: Port to listen on
+    :param data_path: Path to the clean csv
+    :param radius_nm: Incidents further than this from a segment don't count
+    :param half_life_days: Age at which an incident counts half
+    :param cache_size: Number of segment scores to keep
+    :param max_batch: Largest number of legs scored in one batch
+    :param max_wait_ms: Longest time the first leg of a batch waits for others
+    :return: Service counters when it stopped
+    """
+    index = RiskIndex.from_clean(data_path, radius_nm=radius_nm, half_life_days=half_life_days)
+    service = RiskService(RiskScorer(index, cache_size), max_batch, max_wait_ms)
+
+    async def main():
+        server = await service.start(host, port)
+        print(f'Scoring routes against {len(index)} incidents on http://{host}:{port}/score', flush=True)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    return service.stats()
+
+
+def sample_legs(index, n_routes=200, vertices=(2, 6), step_deg=1.0, seed=0):
+    """
+    Random voyage legs through the incident areas, for the load test.
+    :param index: RiskIndex whose incidents the routes start from
+    :param n_routes: Number of distinct legs
+    :param vertices: Smallest and largest number of route vertices
+    :param step_deg: Largest step between vertices, in degrees of latitude and longitude
+    :param seed: Random seed
+    :return: List of leg dictionaries
+    """
+    rng = np.random.default_rng(seed)
+    categories = list(index.categories) or [None]
+    flags = list(index.flags) or [None]
+    legs = []
+    for start in rng.integers(len(index), size=n_routes):
+        n = rng.integers(vertices[0], vertices[1] + 1)
+        steps = rng.uniform(-step_deg, step_deg, size=(n - 1, 2))
+        route = np.vstack([[index.lat[start], index.lon[start]], steps]).cumsum(axis=0)
+        route[:, 0] = route[:, 0].clip(-90, 90)
+        route[:, 1] = (route[:, 1] + 180) % 360 - 180
+        legs.append({'vessel_type': categories[rng.integers(len(categories))],
+                     'flag': flags[rng.integers(len(flags))], 'route': route.round(4).tolist()})
+    return legs
+
+
+async def load_test(legs, host=DEFAULT_HOST, port=DEFAULT_PORT, n_requests=5000, concurrency=32, seed=0):
+    """
+    Send POST /score requests from concurrent keep-alive connections and measure their latencies.
+    :param legs: Leg dictionaries the requests are drawn from (with replacement, so repeated legs hit the cache)
+    :param host: Server host
+    :param port: Server port
+    :param n_requests: Number of requests
+    :param concurrency: Number of connections, each with one request in flight
+    :param seed: Random seed of the request order
+    :return: Dictionary with requests, errors, seconds, requests_per_sec and latency percentiles
+    """
+    rng = np.random.default_rng(seed)
+    bodies = [json.dumps(leg).encode() for leg in legs]
+    requests = iter([bodies[i] for i in rng.integers(len(bodies), size=n_requests)])
+    latencies = []
+    errors = collections.Counter()
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for body in requests:
+                start = time.perf_counter()
+                writer.write(f'POST /score HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+                             f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+                await writer.drain()
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head.decode('latin-1').split('\r\n')
+                headers = dict(line.lower().split(':', 1) for line in lines[1:] if ':' in line)
+                await reader.readexactly(int(headers['content-length']))
+                latencies.append(time.perf_counter() - start)
+                status = lines[0].split(' ')[1]
+                if status != '200':
+                    errors[status] += 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    return {'requests': len(latencies), 'errors': dict(errors), 'concurrency': concurrency,
+            'seconds': round(seconds, 3), 'requests_per_sec': round(len(latencies) / seconds, 1),
+            **_percentiles(latencies)}
+
+
+def main(argv=None):
+    """ Load-test harness; returns the exit status (1 if any request failed). """
+    parser = argparse.ArgumentParser(description='Load test the route risk-scoring service.')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=None,
+                        help='Port of a running service (pirates serve); an in-process one is started if omitted')
+    parser.add_argument('--data', type=Path, default=CLEAN_DATA_PATH, help='Incidents the routes are sampled from')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--routes', type=int, default=500, help='Number of distinct legs the requests repeat')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    parser.add_argument('--output', type=Path, help='Also write the report to this JSON file')
+    args = parser.parse_args(argv)
+
+    index = RiskIndex.from_clean(args.data)
+    legs = sample_legs(index, args.routes)
+
+    async def run_test():
+        if args.port is not None:
+            return await load_test(legs, args.host, args.port, args.requests, args.concurrency), None
+        service = RiskService(RiskScorer(index), args.max_batch, args.max_wait_ms)
+        server = await service.start(args.host, 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            report = await load_test(legs, args.host, port, args.requests, args.concurrency)
+        finally:
+            await service.stop(server)
+        return report, service.stats()
+
+    report, stats = asyncio.run(run_test())
+    if stats is not None:
+        report['service'] = stats
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        args.output.write_text(text + '\n')
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
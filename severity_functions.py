@@ -0,0 +1,78 @@
+"""
+This file contains the severity classification of piracy incidents.
+Severity is decided by a rule table: an ordered list of (severity, columns) rules where the first rule with any
+of its columns set wins, and a default for incidents no rule matches. Rules are evaluated with np.select over
+the flag columns and written to the dataframe as one categorical column.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import numpy as np
+import pandas as pd
+
+from instrument_functions import timed
+
+# Severity levels from least to most severe
+SEVERITY_LEVELS = ['Unsuccessful Attempt', 'low', 'medium', 'high']
+
+# Colors used for each severity level in the maps and plots
+SEVERITY_COLORS = {'Unsuccessful Attempt': 'green', 'low': 'yellow', 'medium': 'red', 'high': 'black'}
+
+# Clean (data.world) data: crew deaths or missing crew are high; assaults, injuries or hostages are medium;
+# anything else is low
+CLEAN_RULES = {
+    'rules': [('high', ['Flag - Crew Deaths', 'Flag - Crew Missing']),
+              ('medium', ['Flag - Crew Assaulted', 'Flag - Crew Injuries', 'Flag - Crew Held Hostage'])],
+    'default': 'low',
+}
+
+# Dirty (IMO) data labeled by the NLP: hostages are high, assaults are medium, boarded or hijacked is low and
+# no label at all is an unsuccessful attempt
+NLP_RULES = {
+    'rules': [('high', ['HOSTAGES_TAKEN']),
+              ('medium', ['CREW_ASSAULTED']),
+              ('low', ['BOARDED', 'HIJACKED'])],
+    'default': 'Unsuccessful Attempt',
+}
+
+
+def _flag(data_df, column):
+    """ A flag column as a boolean array, with missing values counted as False. """
+    return data_df[column].to_numpy(dtype=bool, na_value=False)
+
+
+def severity_codes(data_df, rule_table):
+    """
+    Evaluate a rule table.
+    :param data_df: Dataframe with the flag columns the rules use
+    :param rule_table: Dictionary with 'rules' (list of (severity, columns) in order of precedence) and 'default'
+    :return: Tuple of (int8 array of codes, list of the severity levels the codes index)
+    """
+    levels = {level for level, _ in rule_table['rules']} | {rule_table['default']}
+    categories = [level for level in SEVERITY_LEVELS if level in levels]
+    categories += sorted(levels - set(categories))
+
+    conditions = [np.logical_or.reduce([_flag(data_df, column) for column in columns])
+                  for _, columns in rule_table['rules']]
+
+    choices = [categories.index(level) for level, _ in rule_table['rules']]
+    codes = np.select(conditions, choices, default=categories.index(rule_table['default'])).astype(np.int8)
+    return codes, categories
+
+
+@timed(rows=len)
+def add_severity(data_df, rule_table=CLEAN_RULES, column='severity'):
+    """
+    Adds an ordered categorical severity column to the dataframe, in place. Every row gets exactly one severity.
+    :param data_df: Dataframe with the flag columns the rules use
+    :param rule_table: CLEAN_RULES, NLP_RULES or a dictionary of the same form
+    :param column: Name of the severity column
+    :return: The same dataframe
+    """
+    codes, categories = severity_codes(data_df, rule_table)
+    data_df[column] = pd.Categorical.from_codes(codes, categories=categories, ordered=True)
+    return data_df
@@ -9,21 +9,25 @@ __email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@np
 __status__ = "Production"
 
 # Import modules
+from functools import lru_cache
+
 import numpy as np
-from spacy.matcher import Matcher
 
+from instrument_functions import timed
+from label_cache import cached_labels, ruleset_fingerprint, unpack_labels
 
-def generate_matcher(nlp):
+# Labels found by the Matcher and the SpanCat model, in the order of the dataframe columns
+LABELS = ['BOARDED', 'HIJACKED', 'HOSTAGES_TAKEN', 'CREW_ASSAULTED']
+LABEL_INDEX = {label: i for i, label in enumerate(LABELS)}
+
+
+def matcher_patterns():
     """
-    This function creates a matcher based on rules painstakingly trained by trial and error.
+    Token patterns for each label, based on rules painstakingly trained by trial and error.
     Reference: https://www.youtube.com/watch?v=4V0JDdohxAk
-    :param nlp: Initialized spaCy Natural Language Processing model
-    :return: Rule-based Matcher object with pre-built rules
+    :return: Dictionary of label -> list of token patterns
     """
 
-    # Create matcher object
-    matcher = Matcher(nlp.vocab)
-
     # Create boarded patterns
     boarded_pattern = [
         {"LOWER": {"NOT_IN": ["police", "guard", "officers", "authority", "personnel", "attempting", "alongside"]}},
@@ -84,40 +88,258 @@ def generate_matcher(nlp):
     hostage_pattern = [{'LEMMA': {'IN': ['abduct', 'kidnap', 'hostage']}}]  # Lemmas: abduct, kidnap, hostage
     crew_assault_pattern = [{'LEMMA': 'assault'}]
 
+    # Group patterns with associated categories
+    return {'BOARDED': [boarded_pattern, boarded_pattern2, boarded_pattern3, boarded_pattern4, boarded_pattern5,
+                        boarded_pattern6, boarded_pattern7, boarded_pattern8, boarded_pattern9,
+                        boarded_pattern10, boarded_pattern11, boarded_pattern12, boarded_pattern13,
+                        boarded_pattern14, boarded_pattern15, boarded_pattern16, boarded_pattern17,
+                        hijack_pattern, hijack_pattern2, hostage_pattern],
+            'HIJACKED': [hijack_pattern, hijack_pattern2],
+            'HOSTAGES_TAKEN': [hostage_pattern],
+            'CREW_ASSAULTED': [crew_assault_pattern]}
+
+
+def generate_matcher(nlp):
+    """
+    This function creates a matcher based on rules painstakingly trained by trial and error.
+    Reference: https://www.youtube.com/watch?v=4V0JDdohxAk
+    :param nlp: Initialized spaCy Natural Language Processing model
+    :return: Rule-based Matcher object with pre-built rules
+    """
+
+    # spaCy is imported here so callers that don't build a matcher (e.g. html_generator, MatcherScreen) don't load it
+    from spacy.matcher import Matcher
+
+    # Create matcher object
+    matcher = Matcher(nlp.vocab)
+
     # Add patterns to matcher with associated categories
-    matcher.add('BOARDED', [boarded_pattern, boarded_pattern2, boarded_pattern3, boarded_pattern4, boarded_pattern5,
-                            boarded_pattern6, boarded_pattern7, boarded_pattern8, boarded_pattern9,
-                            boarded_pattern10, boarded_pattern11, boarded_pattern12, boarded_pattern13,
-                            boarded_pattern14, boarded_pattern15, boarded_pattern16, boarded_pattern17,
-                            hijack_pattern, hijack_pattern2, hostage_pattern])
-    matcher.add('HIJACKED', [hijack_pattern, hijack_pattern2])
-    matcher.add('HOSTAGES_TAKEN', [hostage_pattern])
-    matcher.add('CREW_ASSAULTED', [crew_assault_pattern])
+    for label, patterns in matcher_patterns().items():
+        matcher.add(label, patterns)
 
     # Return resulting matcher object
     return matcher
 
 
+def matcher_fingerprint(nlp):
+    """
+    Fingerprint of the rule set for the label cache. Changes whenever a pattern is edited or the
+    language model that supplies the POS/LEMMA attributes is swapped out.
+    :param nlp: Initialized spaCy Natural Language Processing model the matcher runs on
+    :return: Hex digest string
+    """
+    return ruleset_fingerprint(matcher_patterns(), nlp.meta.get('name'), nlp.meta.get('version'))
+
+
+# Inflected forms the English lemmatizer maps to a pattern lemma without containing the lemma's stem
+# (from the irregular verb exceptions in spacy-lookups-data; 'broken' and 'stolen' contain these)
+IRREGULAR_FORMS = {'break': ['broke'], 'steal': ['stole']}
+
+
+def _lemma_keys(lemma):
+    """ Substrings that any token with this lemma must contain (in lowercase). """
+    lemma = lemma.lower()
+    if lemma.endswith('man'):  # men -> man
+        stem = lemma[:-2]
+    elif lemma[-1:] in ('e', 'y', 'f'):  # seizing -> seize, tries -> try, thieves -> thief
+        stem = lemma[:-1]
+    else:
+        stem = lemma
+    return [stem, *IRREGULAR_FORMS.get(lemma, [])]
+
+
+@lru_cache(maxsize=None)
+def _deletion_variants(word, max_edits):
+    """ The word with up to max_edits characters deleted (containing any of them is within max_edits edits). """
+    variants = {word}
+    for _ in range(max_edits):
+        variants |= {variant[:i] + variant[i + 1:] for variant in variants for i in range(len(variant))}
+    return sorted(variant for variant in variants if variant)
+
+
+def _fuzzy_contains(text, word, max_edits):
+    """ Whether some substring of text is within max_edits edits (Levenshtein) of word. """
+    if any(variant in text for variant in _deletion_variants(word, max_edits)):
+        return True
+    for chunk in text.split():
+        if len(chunk) < len(word) - max_edits:
+            continue
+        # Sellers' algorithm: edit distance from word to the best matching substring ending at each position
+        row = list(range(len(word) + 1))
+        for char in chunk:
+            prev_diag, row[0] = row[0], 0
+            for i, word_char in enumerate(word, 1):
+                prev_diag, row[i] = row[i], min(row[i] + 1, row[i - 1] + 1, prev_diag + (char != word_char))
+            if row[-1] <= max_edits:
+                return True
+    return False
+
+
+def _token_requirements(spec):
+    """
+    Text that must appear in a doc for a token to match spec: a list of groups, each a list of alternatives
+    (a lowercase substring, or a (word, max_edits) pair for FUZZY). Attributes that can't be screened on the raw
+    text (POS, NOT_IN, LIKE_NUM, ...) add no group.
+    """
+    groups = []
+    for attr in ('ORTH', 'TEXT', 'LOWER', 'LEMMA'):
+        value = spec.get(attr)
+        if isinstance(value, str):
+            values, fuzzy = [value], None
+        elif isinstance(value, dict) and 'IN' in value and len(value) == 1:
+            values, fuzzy = value['IN'], None
+        elif isinstance(value, dict) and len(value) == 1 and next(iter(value)).startswith('FUZZY') \
+                and attr != 'LEMMA':
+            (operator, values), = value.items()
+            values = values['IN'] if isinstance(values, dict) else [values]
+            fuzzy = [int(operator[len('FUZZY'):]) if operator != 'FUZZY' else max(2, round(0.3 * len(v)))
+                     for v in values]
+        else:
+            continue
+
+        if fuzzy is not None:
+            groups.append([(v.lower(), k) for v, k in zip(values, fuzzy)])
+        elif attr == 'LEMMA':
+            groups.append([key for v in values for key in _lemma_keys(v)])
+        else:
+            groups.append([v.lower() for v in values])
+    return groups
+
+
+class MatcherScreen:
+    """
+    Cheap first stage in front of the rule-based Matcher.
+    Each pattern is reduced to the words its required tokens need (lowercase keywords, lemma stems, fuzzy words),
+    and a text only goes through the spaCy parse if every one of those is in the text for at least one pattern.
+    The screen only rules out texts no pattern can match, so screened labels are identical to matching every doc.
+    """
+
+    def __init__(self, patterns=None):
+        """
+        :param patterns: Dictionary of label -> list of token patterns (matcher_patterns() by default)
+        """
+        patterns = matcher_patterns() if patterns is None else patterns
+        self.requirements = []
+        for label, label_patterns in patterns.items():
+            for pattern in label_patterns:
+                groups = [group for spec in pattern if spec.get('OP') in (None, '+', '1')
+                          for group in _token_requirements(spec)]
+                self.requirements.append((label, groups))
+        # Patterns with only plain keywords are checked first, the fuzzy ones only if none of those can match
+        self.requirements.sort(key=lambda requirement: any(not isinstance(key, str) for group in requirement[1]
+                                                           for key in group))
+        self.keys = sorted({key for _, groups in self.requirements for group in groups for key in group
+                            if isinstance(key, str)})
+
+    def needs_parse(self, text):
+        """ Whether any pattern could match the text. """
+        lower = text.lower()
+        present = {key for key in self.keys if key in lower}
+        for _, groups in self.requirements:
+            if all(any(key in present if isinstance(key, str) else _fuzzy_contains(lower, *key) for key in group)
+                   for group in groups):
+                return True
+        return False
+
+    def __call__(self, texts):
+        """
+        Screen a list of texts.
+        :param texts: List of strings
+        :return: Boolean array, True for the texts that need the full parse
+        """
+        return np.fromiter((self.needs_parse(text) for text in texts), dtype=bool, count=len(texts))
+# end of class MatcherScreen
+
+
+def match_masks(docs, matcher):
+    """
+    Run the matcher over a sequence of docs and fold each doc's matches into a bitmask,
+    one bit per label in LABELS (bit 0 is BOARDED, bit 1 is HIJACKED, ...).
+    :param docs: Iterable of Doc objects
+    :param matcher: Matcher object initialized with preset rules (see generate_matcher)
+    :return: uint8 array with one bitmask per doc
+    """
+    # Look up bits by match ID so no strings are built per match
+    label_bits = {matcher.vocab.strings[label]: 1 << i for i, label in enumerate(LABELS)}
+
+    def doc_mask(doc):
+        mask = 0
+        for match_id, start, end in matcher(doc):
+            mask |= label_bits.get(match_id, 0)
+        return mask
+
+    return np.fromiter((doc_mask(doc) for doc in docs), dtype=np.uint8)
+
+
+@timed(rows=len)
 def custom_matcher(data_df, docs, matcher):
     """
     Takes the dataframe, Doc objects, and matcher, and puts all the data into the dataframe.
+    Docs are matched to rows by position, so a filtered dataframe (non-sequential index) works too.
     :param data_df: Dataframe to store all the match data
-    :param docs: Doc objects for all the strings in a column of the dataframe
+    :param docs: Doc objects for all the strings in a column of the dataframe, in row order
     :param matcher: Matcher object initialized with preset rules (see generate_matcher)
     :return: Completed dataframe with all matches places into the columns as binary
     """
-    for ix, doc in enumerate(docs):
-        # Get matches in the doc and extract the found tags' strings
-        matches = matcher(doc)
-        matches_str = [doc.vocab.strings[x[0]] for x in matches]
+    masks = match_masks(docs, matcher)
+    if len(masks) != len(data_df):
+        raise ValueError(f'Got {len(masks)} docs for a dataframe with {len(data_df)} rows')
+
+    # Unpack each label's bit into its column in one go
+    # (HOSTAGES_TAKEN and CREW_ASSAULTED tags are not fully vetted yet, but mildly work)
+    for col, label in enumerate(LABELS):
+        data_df[label] = ((masks >> col) & 1).astype(np.int8)
+
+    return data_df
+
+
+def matcher_labels(texts, nlp, matcher, batch_size=256, n_process=1, screen=None):
+    """
+    Parse a list of texts in batches and run the rule-based matcher over them.
+    :param texts: List of strings to label
+    :param nlp: Initialized spaCy Natural Language Processing model
+    :param matcher: Matcher object initialized with preset rules (see generate_matcher)
+    :param batch_size: Number of texts spaCy buffers per batch
+    :param n_process: Number of processes to parse with (-1 uses every core)
+    :param screen: Optional MatcherScreen; texts it rules out get all-zero labels without being parsed
+    :return: int8 array of shape (len(texts), len(LABELS)) with a 1 wherever the label was matched
+    """
+    if screen is None:
+        masks = match_masks(nlp.pipe(texts, batch_size=batch_size, n_process=n_process), matcher)
+        return unpack_labels(masks, len(LABELS))
+
+    labels = np.zeros((len(texts), len(LABELS)), dtype=np.int8)
+    rows = np.flatnonzero(screen(texts))
+    if len(rows):
+        masks = match_masks(nlp.pipe([texts[row] for row in rows], batch_size=batch_size, n_process=n_process),
+                            matcher)
+        labels[rows] = unpack_labels(masks, len(LABELS))
+    return labels
+
+
+@timed(rows=len)
+def matcher_interpreter(data_df, column_name, nlp, matcher, batch_size=256, n_process=1, cache=None, screen=None):
+    """
+    Function to apply the rule-based matcher to the specified column straight from the text.
+    Puts the results in new columns in the Dataframe
+    :param data_df: Dataframe with data to test
+    :param column_name: (String) Column name that you'd like to test
+    :param nlp: Initialized spaCy Natural Language Processing model
+    :param matcher: Matcher object initialized with preset rules (see generate_matcher)
+    :param batch_size: Number of texts spaCy buffers per batch
+    :param n_process: Number of processes to parse with (-1 uses every core)
+    :param cache: Optional LabelCache opened with matcher_fingerprint(nlp); only uncached texts are parsed
+    :param screen: Optional MatcherScreen; only texts some pattern could match are parsed
+    :return: Dataframe with a binary column for each label the matcher found
+    """
+    texts = data_df[column_name].fillna('').astype(str).tolist()
 
-        # Add all matches found into matched_df
-        data_df.at[ix, 'BOARDED'] = np.where('BOARDED' in matches_str, 1, 0)
-        data_df.at[ix, 'HIJACKED'] = np.where('HIJACKED' in matches_str, 1, 0)
+    def label_fn(batch):
+        return matcher_labels(batch, nlp, matcher, batch_size=batch_size, n_process=n_process, screen=screen)
 
-        # Below tags are not fully vetted yet, but mildly work
-        data_df.at[ix,'HOSTAGES_TAKEN'] = np.where('HOSTAGES_TAKEN' in matches_str, 1, 0)
-        data_df.at[ix,'CREW_ASSAULTED'] = np.where('CREW_ASSAULTED' in matches_str, 1, 0)
+    labels = label_fn(texts) if cache is None else cached_labels(texts, cache, label_fn, len(LABELS))
+    for col, label in enumerate(LABELS):
+        data_df[label] = labels[:, col]
 
     return data_df
 
@@ -131,41 +353,96 @@ def apply_nlp(text, nlp):
     """
     doc = nlp(text)
 
-    boarded = hijacked = hostages = assault = 0
+    labels = np.zeros(len(LABELS), dtype=np.int8)
+    _span_labels(doc, labels)
+
+    return tuple(int(x) for x in labels)
+
 
-    for span in doc.spans['sc']:
-        if span.label_ == 'BOARDED':
-            boarded = 1
-        if span.label_ == 'HIJACKED':
-            hijacked = 1
-        if span.label_ == 'HOSTAGES_TAKEN':
-            hostages = 1
-        if span.label_ == 'CREW_ASSAULTED':
-            assault = 1
+def _span_labels(doc, out, spans_key='sc'):
+    """
+    Flag every label found by the SpanCat model in the doc.
+    :param doc: Doc object that has been through the SpanCat pipeline
+    :param out: Row of the label array (one slot per entry in LABELS) to write the flags into
+    :param spans_key: Key of the span group the SpanCat component writes to
+    """
+    for span in doc.spans.get(spans_key, []):
+        col = LABEL_INDEX.get(span.label_)
+        if col is not None:
+            out[col] = 1
+
+
+def spancat_disable(nlp):
+    """
+    Names of the pipeline components the SpanCat model does not need.
+    Only the spancat component and the tok2vec layer it listens to are kept, everything else (tagger,
+    parser, ner, etc. when the model is built on a full pipeline) is skipped while labeling.
+    :param nlp: Trained NLP with a spancat component
+    :return: List of component names to pass to nlp.pipe(disable=...)
+    """
+    keep_factories = {'spancat', 'spancat_singlelabel', 'tok2vec', 'transformer'}
+    return [name for name in nlp.pipe_names if nlp.get_pipe_meta(name).factory not in keep_factories]
 
-    return boarded, hijacked, hostages, assault
+
+def model_labels(texts, nlp, batch_size=256, n_process=1):
+    """
+    Run the SpanCat model over a list of texts in batches and collect the labels it finds.
+    :param texts: List of strings to label
+    :param nlp: Trained NLP to categorize the data
+    :param batch_size: Number of texts spaCy buffers per batch
+    :param n_process: Number of processes to label with (-1 uses every core)
+    :return: int8 array of shape (len(texts), len(LABELS)) with a 1 wherever the label was found
+    """
+    labels = np.zeros((len(texts), len(LABELS)), dtype=np.int8)
+
+    docs = nlp.pipe(texts, batch_size=batch_size, n_process=n_process, disable=spancat_disable(nlp))
+    for row, doc in enumerate(docs):
+        _span_labels(doc, labels[row])
+
+    return labels
+
+
+def model_label_stream(items, nlp, batch_size=256, n_process=1):
+    """
+    Run the SpanCat model over a stream of (text, context) pairs through one nlp.pipe, so a long feed is labeled
+    by a single pool of worker processes instead of one pool per batch of texts.
+    :param items: Iterable of (string, context) pairs, consumed lazily
+    :param nlp: Trained NLP to categorize the data
+    :param batch_size: Number of texts spaCy buffers per batch
+    :param n_process: Number of processes to label with (-1 uses every core)
+    :return: Generator of (int8 array of len(LABELS) flags, context), in the order of the items
+    """
+    docs = nlp.pipe(items, as_tuples=True, batch_size=batch_size, n_process=n_process,
+                    disable=spancat_disable(nlp))
+    for doc, context in docs:
+        labels = np.zeros(len(LABELS), dtype=np.int8)
+        _span_labels(doc, labels)
+        yield labels, context
 
 
-def model_interpreter(data_df, column_name, nlp):
+@timed(rows=len)
+def model_interpreter(data_df, column_name, nlp, batch_size=256, n_process=1, cache=None):
     """
     Function to apply the NLP model to the specified column.
     Puts the results in new columns in the Dataframe
     :param data_df: Dataframe with data to test
     :param column_name: (String) Column name that you'd like to test
     :param nlp: Trained NLP to categorize the data
+    :param batch_size: Number of texts spaCy buffers per batch
+    :param n_process: Number of processes to label with (-1 uses every core)
+    :param cache: Optional LabelCache opened with model_fingerprint(model path); only uncached texts are labeled
     :return: Dataframe with hijacked and boarded columns based on what the model found.
     """
-    # Apply passed nlp to specified column, put resulting tuple in result column
-    data_df['RESULT'] = data_df[column_name].apply(apply_nlp, args=[nlp])
+    # Null strings have nothing to label, so they go through as empty docs
+    texts = data_df[column_name].fillna('').astype(str).tolist()
 
-    # Split results into their associated columns
-    data_df['BOARDED'] = np.where(data_df['RESULT'].str[0] == 1, 1, 0)
-    data_df['HIJACKED'] = np.where(data_df['RESULT'].str[1] == 1, 1, 0)
-    data_df['HOSTAGES_TAKEN'] = np.where(data_df['RESULT'].str[2] == 1, 1, 0)
-    data_df['CREW_ASSAULTED'] = np.where(data_df['RESULT'].str[3] == 1, 1, 0)
+    def label_fn(batch):
+        return model_labels(batch, nlp, batch_size=batch_size, n_process=n_process)
 
-    # Drop results column
-    data_df.drop(columns=['RESULT'], axis=1, inplace=True)
+    # Label all the texts in batches, then write each label column in one go
+    labels = label_fn(texts) if cache is None else cached_labels(texts, cache, label_fn, len(LABELS))
+    for col, label in enumerate(LABELS):
+        data_df[label] = labels[:, col]
 
     # Return resulting df
     return data_df
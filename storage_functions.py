@@ -0,0 +1,208 @@
+"""
+This file contains the functions to store the pipeline outputs (Model_Output and the wave height dataset) as
+typed, compressed Parquet files instead of csv.
+Dates, coordinates and labels are stored with their real types and the text columns with few distinct values
+are dictionary encoded, so readers don't have to re-parse anything. Reads can select only the columns they need
+and filter on date, area and lat/lon box before the data is loaded.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from instrument_functions import stage, timed
+
+# Text columns with a small set of values, stored dictionary encoded and read back as pandas categoricals
+CATEGORICAL_COLUMNS = ['Ship Type', 'Ship Flag', 'Area', 'Weapons Used', 'Consequences to Crew',
+                       'Part of Ship Raided', 'Ship Status', 'Vessel Category', 'Vessel_Type', 'severity',
+                       'country', 'Reporting State']
+
+# Date columns in the clean (data.world) and dirty (IMO) data
+DATE_COLUMNS = ['Date', 'Incident Date']
+
+# Decimal lat/lon columns in the dirty and clean data
+COORD_COLUMNS = [('Lat_Dec', 'Lon_Dec'), ('Latitude', 'Longitude')]
+
+LABEL_COLUMNS = ['BOARDED', 'HIJACKED', 'HOSTAGES_TAKEN', 'CREW_ASSAULTED']
+
+# Rows per row group; each row group keeps min/max statistics that filters use to skip it entirely
+ROW_GROUP_SIZE = 2048
+
+_NUMBER = re.compile(r'-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?')
+
+
+def _first_number(value):
+    """
+    Pull the first number out of a cell such as '[0.93       0.91999996]' (the way the wave script wrote arrays).
+    :param value: Cell value
+    :return: Float, or NaN if there is no number
+    """
+    if isinstance(value, (int, float, np.number)):
+        return float(value)
+    match = _NUMBER.search(str(value))
+    return float(match.group()) if match else np.nan
+
+
+def prepare_types(data_df):
+    """
+    Give the columns of a Model_Output or wave dataframe their real types, in place.
+    :param data_df: Dataframe read from csv
+    :return: The same dataframe
+    """
+    for col in DATE_COLUMNS:
+        if col in data_df and not pd.api.types.is_datetime64_any_dtype(data_df[col]):
+            data_df[col] = pd.to_datetime(data_df[col], format='mixed')
+
+    for col in CATEGORICAL_COLUMNS:
+        if col in data_df and not isinstance(data_df[col].dtype, pd.CategoricalDtype):
+            data_df[col] = data_df[col].astype('category')
+
+    for col in LABEL_COLUMNS:
+        if col in data_df:
+            data_df[col] = data_df[col].fillna(0).astype(np.int8)
+
+    if 'Wave Height' in data_df and data_df['Wave Height'].dtype == object:
+        data_df['Wave Height'] = data_df['Wave Height'].map(_first_number, na_action='ignore').astype(np.float64)
+
+    if 'IMO No.' in data_df:
+        data_df['IMO No.'] = data_df['IMO No.'].astype('string')
+
+    return data_df
+
+
+def _date_column(names):
+    """ Name of the date column in a list of column names, or None. """
+    return next((col for col in DATE_COLUMNS if col in names), None)
+
+
+@timed()
+def write_table(data_df, path, compression='zstd', row_group_size=ROW_GROUP_SIZE):
+    """
+    Write a dataframe to a Parquet file, sorted by date so date filters can skip whole row groups.
+    :param data_df: Dataframe to write (see prepare_types)
+    :param path: Output path
+    :param compression: Parquet compression codec
+    :param row_group_size: Rows per row group
+    """
+    date_col = _date_column(data_df.columns)
+    if date_col is not None:
+        data_df = data_df.sort_values(date_col, kind='stable')
+    data_df.to_parquet(path, engine='pyarrow', compression=compression, row_group_size=row_group_size,
+                       index=False)
+
+
+def convert_csv(csv_path, parquet_path, **read_csv_kwargs):
+    """
+    Convert one of the csv outputs (e.g. Data_Files/Model_Output.csv or Results/piracy_df_waves.csv) to Parquet.
+    :param csv_path: Path to the csv
+    :param parquet_path: Output path
+    :param read_csv_kwargs: Extra arguments for pd.read_csv
+    :return: The typed dataframe that was written
+    """
+    read_csv_kwargs.setdefault('dtype', {'IMO No.': str})
+    data_df = pd.read_csv(csv_path, **read_csv_kwargs)
+
+    # Drop the leftover index columns from earlier to_csv calls
+    data_df = data_df.loc[:, ~data_df.columns.str.match(r'^(Unnamed: \d+|#)$')]
+
+    prepare_types(data_df)
+    write_table(data_df, parquet_path)
+    return data_df
+
+
+@timed(rows=len)
+def read_table(path, columns=None, start=None, end=None, areas=None, bbox=None, filters=None):
+    """
+    Read a Parquet file written by write_table. The date, area and bbox filters are pushed down to the
+    Parquet reader, so row groups that can't match are never decoded.
+    :param path: Path to the Parquet file
+    :param columns: List of columns to read (all if None)
+    :param start: Keep incidents on or after this date
+    :param end: Keep incidents on or before this date
+    :param areas: List of 'Area' values to keep
+    :param bbox: (min_lat, max_lat, min_lon, max_lon) box to keep, on Lat_Dec/Lon_Dec or Latitude/Longitude
+    :param filters: Extra pyarrow filter tuples, e.g. [('severity', '==', 'high')]
+    :return: Dataframe
+    """
+    schema = pq.read_schema(path)
+    names = schema.names
+    predicates = list(filters or [])
+
+    date_col = _date_column(names)
+    if date_col is not None and start is not None:
+        predicates.append((date_col, '>=', pd.Timestamp(start)))
+    if date_col is not None and end is not None:
+        predicates.append((date_col, '<=', pd.Timestamp(end)))
+    if areas is not None:
+        predicates.append(('Area', 'in', list(areas)))
+    if bbox is not None:
+        lat_col, lon_col = next(pair for pair in COORD_COLUMNS if pair[0] in names)
+        min_lat, max_lat, min_lon, max_lon = bbox
+        predicates += [(lat_col, '>=', min_lat), (lat_col, '<=', max_lat),
+                       (lon_col, '>=', min_lon), (lon_col, '<=', max_lon)]
+
+    # Text columns come back as categoricals
+    categorical = [col for col in CATEGORICAL_COLUMNS if col in names and (columns is None or col in columns)]
+    table = pq.read_table(path, columns=columns, filters=predicates or None, read_dictionary=categorical)
+    return table.to_pandas()
+
+
+def _arrow_schema(data_df):
+    """
+    Fixed Arrow schema for a typed chunk. Anything that isn't a date, number or bool is stored as a string, so a
+    column that happens to be all null in the first chunk doesn't lock the file into a null type.
+    :param data_df: Dataframe chunk (see prepare_types)
+    :return: pyarrow.Schema
+    """
+    fields = []
+    for col, dtype in data_df.dtypes.items():
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            fields.append(pa.field(col, pa.timestamp('ns')))
+        elif pd.api.types.is_bool_dtype(dtype):
+            fields.append(pa.field(col, pa.bool_()))
+        elif pd.api.types.is_integer_dtype(dtype):
+            fields.append(pa.field(col, pa.from_numpy_dtype(np.dtype(dtype.name.lower()))))
+        elif pd.api.types.is_float_dtype(dtype):
+            fields.append(pa.field(col, pa.float64()))
+        else:
+            fields.append(pa.field(col, pa.string()))
+    return pa.schema(fields)
+
+
+def write_parquet_chunks(chunks, out_path, compression='zstd'):
+    """
+    Streaming counterpart of write_table for the ingest pipeline: each chunk is appended as its own row group.
+    Text columns are written as strings and dictionary encoded by Parquet, so chunks with different category sets
+    still share one schema.
+    :param chunks: Iterable of dataframe chunks
+    :param out_path: Path to the output Parquet file
+    :param compression: Parquet compression codec
+    :return: Number of rows written
+    """
+    writer = None
+    schema = None
+    rows = 0
+    try:
+        for chunk in chunks:
+            chunk = prepare_types(chunk.copy())
+            if writer is None:
+                schema = _arrow_schema(chunk)
+                writer = pq.ParquetWriter(out_path, schema, compression=compression)
+            with stage('write_parquet') as open_stage:
+                table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+                writer.write_table(table)
+                open_stage.add_rows(len(chunk))
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
@@ -0,0 +1,32 @@
+"""
+Tests for the correctness gate in benchmark_functions.py.
+"""
+
+# Import modules
+import numpy as np
+
+from benchmark_functions import LABELS, check_results, load_baseline, save_baseline
+
+
+def make_run(precision=1.0):
+    """
+    Results and labels of a run of the matcher over two test docs.
+    :param precision: Precision of every label
+    :return: Tuple of (results, labels) shaped like run_benchmark's
+    """
+    scores = {label: {'precision': precision, 'recall': 1.0, 'f1': 1.0, 'support': 1} for label in LABELS}
+    return {'test': {'matcher': {'scores': scores}}}, {('test', 'matcher'): np.zeros((2, len(LABELS)), np.int8)}
+
+
+def test_gate_bootstraps_with_update_baseline(tmp_path):
+    path = tmp_path / 'label_baseline.json'
+    results, labels = make_run()
+    assert load_baseline(path) is None
+    assert check_results(results, labels, load_baseline(path))
+
+    save_baseline(results, path)
+    assert check_results(results, labels, load_baseline(path)) == []
+
+    results, labels = make_run(precision=0.5)
+    assert sorted(check_results(results, labels, load_baseline(path))) == \
+        sorted(f'test/matcher/{label}: precision 0.5 != baseline 1.0' for label in LABELS)
@@ -0,0 +1,32 @@
+"""
+Tests for the hotspot detection in hotspot_functions.py.
+"""
+
+# Import modules
+import numpy as np
+import pandas as pd
+
+from hotspot_functions import incident_keys
+from storage_functions import prepare_types, read_table, write_table
+
+
+def test_incident_keys_match_across_formats(tmp_path):
+    data_df = pd.DataFrame({
+        'Date': pd.to_datetime(['2019-03-01', '2019-03-01', '2020-07-15', '2021-11-30']),
+        'Ship Name': ['SEA STAR', 'Ocean Pearl ', None, 'MV Kota'],
+        'Lat_Dec': [1.2345678, -0.00001, np.nan, 12.5],
+        'Lon_Dec': [103.8765432, 45.1, 50.0, -0.00004],
+        'Area': ['Straits', 'Gulf of Aden', 'Gulf of Aden', 'Gulf of Aden'],
+    })
+    parquet_path = tmp_path / 'incidents.parquet'
+    csv_path = tmp_path / 'incidents.csv'
+    write_table(prepare_types(data_df.copy()), parquet_path)
+    data_df.to_csv(csv_path, index=False)
+
+    from_parquet = read_table(parquet_path)
+    from_csv = pd.read_csv(csv_path)
+
+    keys = incident_keys(data_df)
+    assert len(set(keys)) == len(data_df)
+    np.testing.assert_array_equal(incident_keys(from_parquet), keys)
+    np.testing.assert_array_equal(incident_keys(from_csv), keys)
@@ -0,0 +1,64 @@
+"""
+Tests for the streaming ingest stages in ingest_functions.py.
+"""
+
+# Import modules
+import pandas as pd
+import pytest
+
+from ingest_functions import label_chunks
+from label_cache import LabelCache, text_key
+
+spacy = pytest.importorskip('spacy')
+
+
+def make_chunks(n_chunks, rows=3):
+    """
+    Build small cleaned chunks with distinct incident details.
+    :param n_chunks: Number of chunks
+    :param rows: Rows per chunk
+    :return: List of dataframe chunks
+    """
+    return [pd.DataFrame({'Incident details': [f'Incident {i} row {j}' for j in range(rows)]},
+                         index=range(i * rows, (i + 1) * rows))
+            for i in range(n_chunks)]
+
+
+def test_label_chunks_warm_cache_streams(tmp_path):
+    chunks = make_chunks(5)
+    cache = LabelCache(tmp_path / 'labels.sqlite', 'test')
+    # BOARDED for every text, which the blank pipeline below could never find itself
+    cache.put_many({text_key(text): 1 for chunk in chunks for text in chunk['Incident details']})
+
+    reads = []
+
+    def feed():
+        for number, chunk in enumerate(chunks):
+            reads.append(number)
+            yield chunk
+
+    out = label_chunks(feed(), spacy.blank('en'), batch_size=8, cache=cache)
+    first = next(out)
+    assert reads == [0]
+    assert first.index.equals(chunks[0].index)
+    assert first['BOARDED'].tolist() == [1, 1, 1]
+
+    rest = list(out)
+    assert reads == [0, 1, 2, 3, 4]
+    assert [len(chunk) for chunk in rest] == [3, 3, 3, 3]
+    assert all(chunk['BOARDED'].eq(1).all() and chunk['HIJACKED'].eq(0).all() for chunk in rest)
+
+
+def test_label_chunks_bounds_read_ahead(tmp_path):
+    chunks = make_chunks(10)
+    reads = []
+
+    def feed():
+        for number, chunk in enumerate(chunks):
+            reads.append(number)
+            yield chunk
+
+    out = label_chunks(feed(), spacy.blank('en'), batch_size=64, max_pending=3)
+    next(out)
+    assert len(reads) <= 3
+    assert sum(len(chunk) for chunk in out) == 27
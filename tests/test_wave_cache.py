@@ -0,0 +1,56 @@
+"""
+Tests for the wave tile cache in wave_cache.py.
+"""
+
+# Import modules
+import numpy as np
+import pandas as pd
+import pytest
+
+xr = pytest.importorskip('xarray')
+pytest.importorskip('netCDF4')
+
+from wave_cache import WaveTileCache, synthetic_wave_dataset  # noqa: E402
+
+TIMES = pd.DatetimeIndex(['2021-10-20 12:00', '2021-11-25 06:00'])
+
+
+def test_tile_fetched_before_window_closed_is_refetched(tmp_path):
+    source = synthetic_wave_dataset()
+    cache = WaveTileCache(root=tmp_path, source=source, dataset_id='synthetic')
+    window_start = pd.Timestamp(0) + (TIMES[0] - pd.Timestamp(0)) // cache.window * cache.window
+
+    # A tile written while its window was still open holds only its first days
+    cutoff = window_start + pd.Timedelta(3, unit='D')
+    early = cache._fetch_tile('VHM0', 0.0, 40.0, window_start).sel(time=slice(None, cutoff))
+    early.attrs['fetched_at'] = cutoff.isoformat()
+    cache._write(early, cache.tile_path('VHM0', 0.0, 40.0, window_start))
+
+    offline = WaveTileCache(root=tmp_path, dataset_id='synthetic', offline=True)
+    assert offline.get_tile('VHM0', 0.0, 40.0, window_start).sizes['time'] == early.sizes['time']
+
+    tile = cache.get_tile('VHM0', 0.0, 40.0, window_start)
+    assert cache.refreshes == 1
+    assert tile.sizes['time'] == 240
+    assert cache.get_tile('VHM0', 0.0, 40.0, window_start).sizes['time'] == 240
+    assert cache.hits == 1
+
+
+def test_partial_cache_combines_without_hypercube(tmp_path):
+    cache = WaveTileCache(root=tmp_path, source=synthetic_wave_dataset(), dataset_id='synthetic')
+    tolerance = pd.Timedelta(90, unit='min')
+    # Two tiles are cached for the first window and only one of them for the second
+    cache(['VHM0'], 1.0, 4.0, 36.0, 44.0, TIMES[:1], tolerance)
+    cache(['VHM0'], 1.0, 4.0, 36.0, 39.0, TIMES[1:], tolerance)
+
+    offline = WaveTileCache(root=tmp_path, dataset_id='synthetic', offline=True)
+    block = offline(['VHM0'], 1.0, 4.0, 36.0, 44.0, TIMES, tolerance)
+    assert block.sizes['time'] == 2
+    first = block['VHM0'].sel(time=TIMES[0], method='nearest')
+    second = block['VHM0'].sel(time=TIMES[1], method='nearest')
+    assert first.notnull().all()
+    assert second.sel(longitude=slice(36, 39)).notnull().all()
+    assert second.sel(longitude=slice(41, 44)).isnull().all()
+    np.testing.assert_allclose(second.sel(latitude=2.0, longitude=37.0),
+                               synthetic_wave_dataset()['VHM0'].sel(time=TIMES[1], latitude=2.0, longitude=37.0),
+                               rtol=1e-6)
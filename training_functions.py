@@ -0,0 +1,266 @@
+"""
+This file contains the SpanCat training data builder and the training time/accuracy tradeoff report.
+The hand labeled training data is split into train/dev/test, parsed in batches (optionally over several processes),
+tagged with the rule-based matcher's spans and saved as DocBins. The DocBins are cached under a key hashed from the
+texts, the split, the matcher rules and the language model, so retraining on unchanged data skips the parse.
+
+The tradeoff report trains each profile (the original sc_config.cfg, the CPU profile sc_config_cpu.cfg, ...) on the
+same corpus and reports its training time next to its dev and test scores.
+
+Usage:
+    python training_functions.py corpus                         # build (or reuse) the cached train/dev/test DocBins
+    python training_functions.py train [--profile cpu]          # train one profile on the cached corpus
+    python training_functions.py tradeoffs [--profiles full cpu] # train several profiles and compare them
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import argparse
+import hashlib
+import json
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from instrument_functions import timed
+
+TRAINING_DATA_PATH = Path('Data_Files/training_data.csv')
+CORPUS_CACHE_DIR = Path('Spacy_Files/corpus_cache')
+CONFIG_PATH = Path('Spacy_Files/sc_config.cfg')
+CPU_CONFIG_PATH = Path('Spacy_Files/sc_config_cpu.cfg')
+TRAINING_OUTPUT_DIR = Path('Spacy_Files/profiles')
+TRADEOFF_PATH = Path('Results/training_tradeoffs.json')
+
+# Share of the shuffled training data in each split (75/15/10, as in 1_nlp_creation_testing.ipynb)
+SPLITS = {'train': 0.75, 'dev': 0.15, 'test': 0.10}
+
+# Training profile -> (config file, config overrides)
+PROFILES = {
+    'full': (CONFIG_PATH, {}),
+    'cpu': (CPU_CONFIG_PATH, {}),
+    # No static vectors: no en_core_web_md needed and a smaller model, at some cost in recall
+    'cpu_no_vectors': (CPU_CONFIG_PATH, {'paths.vectors': None,
+                                         'components.tok2vec.model.embed.include_static_vectors': False}),
+}
+
+
+def split_rows(n, seed=0, splits=SPLITS):
+    """
+    Shuffle n rows and cut them into the splits.
+    :param n: Number of rows
+    :param seed: Random seed of the shuffle
+    :param splits: Dictionary of split name -> share of the rows
+    :return: Dictionary of split name -> array of row numbers
+    """
+    order = np.random.default_rng(seed).permutation(n)
+    bounds = np.round(np.cumsum([0, *splits.values()]) * n).astype(int)
+    return {name: order[start:end] for name, start, end in zip(splits, bounds[:-1], bounds[1:])}
+
+
+def _model_version(base_model):
+    """ Name and version of a spaCy package or model folder, without loading it. """
+    import spacy
+
+    if Path(base_model).exists():
+        meta = spacy.util.get_model_meta(base_model)
+        return f"{meta.get('name')}-{meta.get('version')}"
+    return f'{base_model}-{spacy.util.get_package_version(base_model)}'
+
+
+def corpus_key(texts, seed=0, base_model='en_core_web_md', splits=SPLITS):
+    """
+    Cache key of a corpus: changes whenever the texts, the split, the matcher rules, the language model or the
+    spaCy version do.
+    :param texts: List of training texts
+    :param seed: Random seed of the split
+    :param base_model: Language model the texts are parsed with
+    :param splits: Dictionary of split name -> share of the rows
+    :return: Hex digest string
+    """
+    import spacy
+    from label_cache import ruleset_fingerprint
+    from spacy_functions import matcher_patterns
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps([seed, splits, spacy.__version__, _model_version(base_model),
+                              ruleset_fingerprint(matcher_patterns())]).encode('utf-8'))
+    for text in texts:
+        digest.update(text.encode('utf-8') + b'\x00')
+    return digest.hexdigest()[:16]
+
+
+@timed(rows=lambda docbins: sum(len(docbin) for docbin in docbins.values()))
+def build_docbins(texts, nlp, seed=0, batch_size=256, n_process=1, splits=SPLITS):
+    """
+    Parse the texts in batches and tag each doc with the matcher's spans, as the notebook's convert() did.
+    :param texts: List of training texts
+    :param nlp: Language model the matcher runs on (its named entity recognizer is not needed)
+    :param seed: Random seed of the split
+    :param batch_size: Number of texts spaCy buffers per batch
+    :param n_process: Number of processes to parse with (-1 uses every core)
+    :param splits: Dictionary of split name -> share of the rows
+    :return: Dictionary of split name -> DocBin
+    """
+    from spacy.tokens import DocBin, Span
+    from spacy_functions import generate_matcher
+
+    matcher = generate_matcher(nlp)
+    rows = split_rows(len(texts), seed, splits)
+    order = np.concatenate(list(rows.values()))
+    split_of = np.repeat(list(rows), [len(split) for split in rows.values()])
+
+    # Only the tokens and the spans are kept, which is all the SpanCat training reads
+    docbins = {name: DocBin(attrs=['ORTH', 'SPACY']) for name in splits}
+    docs = nlp.pipe((texts[row] for row in order), batch_size=batch_size, n_process=n_process, disable=['ner'])
+    for name, doc in zip(split_of, docs):
+        doc.spans['sc'] = [Span(doc, start, end, label=match_id) for match_id, start, end in matcher(doc)]
+        docbins[name].add(doc)
+    return docbins
+
+
+@timed()
+def build_corpus(data_path=TRAINING_DATA_PATH, base_model='en_core_web_md', cache_dir=CORPUS_CACHE_DIR, seed=0,
+                 batch_size=256, n_process=1, out_dir=None, text_column='Incident_details'):
+    """
+    The train/dev/test DocBins of the training data, parsed only if they are not cached yet.
+    :param data_path: Path to training_data.csv
+    :param base_model: Language model the matcher runs on
+    :param cache_dir: Folder of the cached corpora, one subfolder per corpus key
+    :param seed: Random seed of the split
+    :param batch_size: Number of texts spaCy buffers per batch
+    :param n_process: Number of processes to parse with (-1 uses every core)
+    :param out_dir: Optional folder the .spacy files are also copied to (e.g. Spacy_Files)
+    :param text_column: Column with the incident texts
+    :return: Tuple of (dictionary of split name -> path of its .spacy file, True if it came from the cache)
+    """
+    texts = pd.read_csv(data_path)[text_column].fillna('').astype(str).tolist()
+    folder = Path(cache_dir) / corpus_key(texts, seed, base_model)
+    paths = {name: folder / f'{name}.spacy' for name in SPLITS}
+    cached = all(path.exists() for path in paths.values())
+
+    if not cached:
+        import spacy
+
+        nlp = spacy.load(base_model)
+        docbins = build_docbins(texts, nlp, seed, batch_size, n_process)
+        folder.mkdir(parents=True, exist_ok=True)
+        for name, docbin in docbins.items():
+            docbin.to_disk(paths[name])
+
+    if out_dir is not None:
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+        for name, path in paths.items():
+            shutil.copyfile(path, Path(out_dir) / path.name)
+    return paths, cached
+
+
+def _span_scores(scores):
+    """ Overall and per-label span precision/recall/F of a spaCy scores dictionary. """
+    result = {key: scores.get(key) for key in ('spans_sc_p', 'spans_sc_r', 'spans_sc_f')}
+    per_type = scores.get('spans_sc_per_type') or {}
+    result['per_label_f'] = {label: values.get('f') for label, values in per_type.items()}
+    return result
+
+
+@timed()
+def train_profile(profile, corpus, output_dir=TRAINING_OUTPUT_DIR, overrides=None):
+    """
+    Train one profile on a corpus and score the best model on the test split.
+    :param profile: Name of a PROFILES entry
+    :param corpus: Dictionary of split name -> .spacy path (see build_corpus)
+    :param output_dir: Folder the models are written to, one subfolder per profile
+    :param overrides: Extra config overrides, e.g. {'training.max_steps': 500}
+    :return: Dictionary with profile, config, train_seconds, dev and test scores, model_mb and model path
+    """
+    from spacy.cli.evaluate import evaluate
+    from spacy.cli.train import train
+
+    config_path, profile_overrides = PROFILES[profile]
+    model_dir = Path(output_dir) / profile
+    settings = {**profile_overrides, **(overrides or {}), 'paths.train': str(corpus['train']),
+                'paths.dev': str(corpus['dev'])}
+
+    start = time.perf_counter()
+    train(config_path, model_dir, use_gpu=-1, overrides=settings)
+    seconds = time.perf_counter() - start
+
+    best = model_dir / 'model-best'
+    meta = json.loads((best / 'meta.json').read_text())
+    test = evaluate(str(best), corpus['test'], use_gpu=-1, silent=True)
+    model_mb = sum(path.stat().st_size for path in best.rglob('*') if path.is_file()) / 2 ** 20
+    return {'profile': profile, 'config': str(config_path), 'train_seconds': round(seconds, 1),
+            'dev': _span_scores(meta.get('performance', {})), 'test': _span_scores(test),
+            'model_mb': round(model_mb, 1), 'model': str(best)}
+
+
+def tradeoff_report(profiles, corpus, output_dir=TRAINING_OUTPUT_DIR, overrides=None):
+    """
+    Train several profiles on the same corpus.
+    :param profiles: Names of PROFILES entries
+    :param corpus: Dictionary of split name -> .spacy path (see build_corpus)
+    :param output_dir: Folder the models are written to
+    :param overrides: Extra config overrides applied to every profile
+    :return: List of train_profile results, fastest first
+    """
+    results = [train_profile(profile, corpus, output_dir, overrides) for profile in profiles]
+    return sorted(results, key=lambda result: result['train_seconds'])
+
+
+def tradeoff_table(results):
+    """ The tradeoff report as a printable table. """
+    rows = [{'profile': result['profile'], 'train_s': result['train_seconds'], 'model_mb': result['model_mb'],
+             'dev_f': result['dev']['spans_sc_f'], 'test_p': result['test']['spans_sc_p'],
+             'test_r': result['test']['spans_sc_r'], 'test_f': result['test']['spans_sc_f']} for result in results]
+    return pd.DataFrame(rows).to_string(index=False, float_format=lambda value: f'{value:.3f}')
+
+
+def main(argv=None):
+    """ Command line entry point; returns the exit status. """
+    parser = argparse.ArgumentParser(description='Build the SpanCat training corpus and train the model profiles.')
+    parser.add_argument('command', choices=['corpus', 'train', 'tradeoffs'])
+    parser.add_argument('--data', type=Path, default=TRAINING_DATA_PATH)
+    parser.add_argument('--base-model', default='en_core_web_md', help='Language model the matcher runs on')
+    parser.add_argument('--cache-dir', type=Path, default=CORPUS_CACHE_DIR)
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the train/dev/test split')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--n-process', type=int, default=1, help='Processes to parse with (-1 uses every core)')
+    parser.add_argument('--out-dir', type=Path, default=None, help='Also copy the .spacy files to this folder')
+    parser.add_argument('--profile', choices=list(PROFILES), default='cpu', help='Profile to train')
+    parser.add_argument('--profiles', nargs='+', choices=list(PROFILES), default=['full', 'cpu'],
+                        help='Profiles to compare')
+    parser.add_argument('--models-dir', type=Path, default=TRAINING_OUTPUT_DIR)
+    parser.add_argument('--max-steps', type=int, default=None, help='Override training.max_steps of every profile')
+    parser.add_argument('--output', type=Path, default=TRADEOFF_PATH, help='JSON file the tradeoff report is written to')
+    args = parser.parse_args(argv)
+
+    from instrument_functions import run
+
+    with run(f'training_{args.command}'):
+        corpus, cached = build_corpus(args.data, args.base_model, args.cache_dir, args.seed, args.batch_size,
+                                      args.n_process, args.out_dir)
+        print(f"Corpus {'reused from' if cached else 'built in'} {corpus['train'].parent}")
+        if args.command == 'corpus':
+            return 0
+
+        overrides = {'training.max_steps': args.max_steps} if args.max_steps is not None else None
+        profiles = [args.profile] if args.command == 'train' else args.profiles
+        results = tradeoff_report(profiles, corpus, args.models_dir, overrides)
+
+    print(json.dumps(results, indent=2))
+    print(tradeoff_table(results))
+    if args.command == 'tradeoffs':
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(results, indent=2) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""
+This file contains the normalization of free-text ship types into the vessel categories used in the analysis.
+The category mapping is compiled once into an inverted dictionary keyed on a case-folded, whitespace-normalized
+form of each ship type, and a column is mapped through its unique values only. Ship types the mapping doesn't know
+are matched to the closest known one (memoized, so each variant is matched once), and every such new mapping is
+logged so it can be reviewed and added to VESSEL_TYPE_MAPPING.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import difflib
+import logging
+import re
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from instrument_functions import timed
+
+logger = logging.getLogger(__name__)
+
+# Vessel category -> ship types in it. Each ship type belongs to one category; case, spacing around '/' and '-'
+# and repeated spaces don't matter
+VESSEL_TYPE_MAPPING = {
+    # Ore/bulk/oil (OBO) carriers are combination carriers, so every spelling of them is a Cargo Ship like
+    # 'Combination carrier'. The notebook mapping also listed 'Ore/Bulk/oil carrier' and 'Ore/Bulk/Oil carrier' under
+    # Tanker, which sent those two spellings (2 dirty incidents) to Tanker and the others to Cargo Ship.
+    'Cargo Ship': ['General cargo ship', 'Container ship', 'Container', 'General dry cargo ship', 'Bulk carrier',
+                   'Vehicle carrier', 'Ro-ro-cargo ship', 'Refrigerated cargo carrier', 'Livestock carrier', 'Reefer',
+                   'Cable-Layer', 'Ore/bulk/oil carrier', 'Cellular Container ship', 'Cargo ship', 'Ro-Ro cargo ship',
+                   'Log carrier', 'Unitised vessel', 'Cement carrier', 'Heavy load carrier', 'Barge carrier',
+                   'Supply ship', 'Offshore tug/Supply ship', 'Wood chip carrier', 'Bulk and container carrier',
+                   'Multipurpose cargo ship', 'Feeder container', 'Combination carrier', 'Steel-Bulk Carrier',
+                   'Flush-tween/3 decker', 'Dry bulk carrier', 'Freighter/Log carrier', 'Dry cargo ship',
+                   'Refrigerated cargo ship', 'Container/General cargo ship', 'Multipurpose tweendecker',
+                   'Reefer/Container ship', 'Log/Bulk carrier', 'General cargo', 'Car carrier', 'Flat-top cargo barge',
+                   'Ro-ro ship', 'Offshore Supply ship'],
+
+    'Fishing': ['Fishing vessel', 'Fishing trawler', 'Fishing vessels', 'Fishing boat'],
+
+    'Non Commercial Ship': ['Research ship', 'Rescue/standby ship', 'Factory ship'],
+
+    'Passenger Ship': ['Dhow', 'Ro-ro passenger vessel', 'Ferry', 'Passenger ship', 'Yacht',
+                       'Ro-Ro ferry passenger ship'],
+
+    'Service Ship': ['Salvage tug', 'Tug', 'Tug/lighter', 'Towing tug', 'Offshore Support Vessel'],
+
+    'Tanker': ['Tanker', 'Tanker ship', 'Chemical tanker', 'Oil product tanker', 'Product tanker', 'LPG tanker',
+               'Oil tanker', 'Gas carrier-LPG', 'LPG', 'Gas carrier - LNG', 'Gas carrier - non-specified',
+               'Crude Oil tanker', 'Gas carrier', 'Liquefied gas carrier', 'Gas carrier/tanker', 'Chemical carrier',
+               'Gas/Oil tanker', 'Barge oil', 'Motor tanker', 'Liquefied Gas/Oil tanker', 'Oil/Chemical tanker',
+               'Product/Motor tanker', 'Chemical/oil tanker', 'VLCC', 'Tanker VLCC', 'Tanker (VLCC)',
+               'Oil Products Tanker'],
+
+    'Other': ['Cutter/dredger', 'Barge', 'Mobile offshore drilling unit', 'Refrigerated ship', 'Boat',
+              'Barter Trade Boat', 'Multi purpose ship', 'Multipurpose', 'Special purpose ship', 'Landing craft',
+              'Motor yacht', 'Hopper/Dregger', 'Dredger', 'Navy ship', 'Coast Guard ship', 'Coaster', 'Trading ship',
+              'Warship', 'Speedboat', 'Catamaran', 'Offshore Barge carrier'],
+
+    'Unknown': ['Not Reported', 'Unknown', 'Panama'],
+}
+
+# Category for missing ship types
+MISSING_CATEGORY = 'Unknown'
+
+_SPACES_REGEX = re.compile(r'\s+')
+_SEPARATOR_REGEX = re.compile(r'\s*([/\-])\s*')
+
+
+def normalize_ship_type(ship_type):
+    """
+    Key a ship type is looked up by: case-folded, with single spaces and no spaces around '/' or '-'.
+    :param ship_type: Ship type string
+    :return: Normalized string
+    """
+    key = _SPACES_REGEX.sub(' ', str(ship_type).casefold()).strip()
+    return _SEPARATOR_REGEX.sub(r'\1', key)
+
+
+class VesselTypeNormalizer:
+    """
+    Maps ship types to vessel categories: exact (normalized) matches first, then the closest known ship type.
+    Ship types with no close match are left uncategorized (None).
+    """
+
+    def __init__(self, mapping=VESSEL_TYPE_MAPPING, cutoff=0.85, cache_size=4096):
+        """
+        :param mapping: Dictionary of category -> list of ship types; a ship type listed under several categories
+            stays in the first one
+        :param cutoff: Lowest difflib similarity ratio (0 to 1) accepted for a fuzzy match
+        :param cache_size: Number of fuzzy lookups to memoize
+        """
+        self.categories = list(mapping)
+        self.cutoff = cutoff
+        self.lookup = {}
+        for category, ship_types in mapping.items():
+            for ship_type in ship_types:
+                key = normalize_ship_type(ship_type)
+                if self.lookup.setdefault(key, category) != category:
+                    logger.warning('Ship type %r is listed under %r and %r, keeping %r', ship_type,
+                                   self.lookup[key], category, self.lookup[key])
+        self._keys = list(self.lookup)
+        self.learned = {}  # normalized ship type -> (closest known ship type, category) found by fuzzy matching
+        self._closest = lru_cache(maxsize=cache_size)(self._match)
+
+    def _match(self, key):
+        """ Category of the closest known ship type to an unseen (normalized) one, or None. """
+        matches = difflib.get_close_matches(key, self._keys, n=1, cutoff=self.cutoff)
+        if not matches:
+            logger.info('No vessel category for ship type %r', key)
+            return None
+        category = self.lookup[matches[0]]
+        self.learned[key] = (matches[0], category)
+        logger.info('Mapped ship type %r to %r (closest to %r)', key, category, matches[0])
+        return category
+
+    def category(self, ship_type):
+        """
+        Vessel category of one ship type.
+        :param ship_type: Ship type string, or None/NaN
+        :return: Category name, or None if there is no close match
+        """
+        if ship_type is None or pd.isna(ship_type):
+            return MISSING_CATEGORY
+        key = normalize_ship_type(ship_type)
+        category = self.lookup.get(key)
+        return category if category is not None else self._closest(key)
+
+    def map(self, ship_types):
+        """
+        Vessel categories of a column of ship types, looking up each distinct ship type once.
+        :param ship_types: Series of ship types
+        :return: Series of category names with the same index
+        """
+        codes, uniques = pd.factorize(ship_types)
+        # Code -1 (missing) indexes the missing category at the end
+        categories = np.array([*(self.category(ship_type) for ship_type in uniques), MISSING_CATEGORY], dtype=object)
+        return pd.Series(categories[codes], index=ship_types.index, name=ship_types.name)
+# end of class VesselTypeNormalizer
+
+
+_default_normalizer = None
+
+
+@timed(rows=len)
+def add_vessel_category(data_df, ship_type_column='Ship Type', column='Vessel Category', normalizer=None):
+    """
+    Adds the vessel category of each incident to the dataframe, in place.
+    :param data_df: Dataframe of incidents
+    :param ship_type_column: Column with the free-text ship types
+    :param column: Name of the new column
+    :param normalizer: VesselTypeNormalizer to use (a shared one over VESSEL_TYPE_MAPPING by default, so the fuzzy
+        matches are remembered across calls)
+    :return: The same dataframe
+    """
+    global _default_normalizer
+    if normalizer is None:
+        if _default_normalizer is None:
+            _default_normalizer = VesselTypeNormalizer()
+        normalizer = _default_normalizer
+    data_df[column] = normalizer.map(data_df[ship_type_column])
+    return data_df
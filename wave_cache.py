@@ -0,0 +1,223 @@
+"""
+This file contains a local on-disk cache of the Copernicus wave data.
+Wave data is fetched in tiles (one variable, one lat/lon square, one time window) and kept as compressed NetCDF
+files, so re-runs and backfills read the cells they already fetched from disk, and an offline run can enrich
+incidents without reaching the Copernicus service at all.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from wave_functions import WAVE_DATASET_ID
+
+WAVE_CACHE_PATH = Path('Data_Files/wave_cache')
+
+
+def open_copernicus(dataset_id=WAVE_DATASET_ID, credentials_file=Path('Data_Files/.copernicusmarine-credentials')):
+    """
+    Open a Copernicus Marine dataset lazily (nothing is downloaded until values are read).
+    :param dataset_id: Copernicus dataset ID
+    :param credentials_file: Path to the copernicusmarine credentials file
+    :return: xarray.Dataset
+    """
+    import copernicusmarine as copernicus_marine
+    return copernicus_marine.open_dataset(dataset_id=dataset_id, credentials_file=credentials_file)
+
+
+class WaveTileCache:
+    """
+    Tile cache in front of a wave dataset, usable as the fetch_block function of wave_functions.enrich_waves.
+    Tiles are keyed by dataset ID, variable, lat/lon tile and time window and stored under
+    root/<dataset_id>/<variable>/<lat>_<lon>/<window start>.nc. Each tile records when it was fetched, and a tile
+    fetched before its window had closed (plus settle, for late data) is fetched again on the next online read.
+    Once the files add up to more than max_bytes, the least recently used tiles are deleted.
+    """
+
+    def __init__(self, root=WAVE_CACHE_PATH, source=None, dataset_id=WAVE_DATASET_ID, tile_deg=5.0, window='30D',
+                 max_bytes=2 * 1024 ** 3, offline=False, settle='1D'):
+        """
+        :param root: Cache folder
+        :param source: xarray.Dataset to fetch missing tiles from, or a function returning one (called on the first
+            miss, e.g. open_copernicus)
+        :param dataset_id: ID of the source dataset, part of the tile key
+        :param tile_deg: Size of the lat/lon tiles in degrees
+        :param window: Length of the time windows
+        :param max_bytes: Size cap for the cache folder
+        :param offline: Only serve tiles already in the cache; missing tiles come back empty (NaN in enrichment)
+        :param settle: How long after a window closes its data can still change; tiles fetched earlier are refetched
+        """
+        self.root = Path(root) / dataset_id
+        self.source = source
+        self.tile_deg = tile_deg
+        self.window = pd.Timedelta(window)
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.settle = pd.Timedelta(settle)
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _dataset(self):
+        """ The source dataset, opened on first use. """
+        if self.source is None:
+            raise RuntimeError('WaveTileCache has no source to fetch missing tiles from')
+        if callable(self.source) and not isinstance(self.source, xr.Dataset):
+            self.source = self.source()
+        return self.source
+
+    def tile_path(self, variable, tile_lat, tile_lon, window_start):
+        """ Path of the file holding one tile. """
+        return self.root / variable / f'{tile_lat:+g}_{tile_lon:+g}' / f'{window_start:%Y%m%dT%H%M}.nc'
+
+    def _fetch_tile(self, variable, tile_lat, tile_lon, window_start):
+        """ Read one whole tile from the source dataset (bounds are half-open so tiles don't overlap). """
+        lat_max = tile_lat + self.tile_deg
+        lon_max = tile_lon + self.tile_deg
+        window_end = window_start + self.window
+        tile = self._dataset()[[variable]].sel(latitude=slice(tile_lat, lat_max), longitude=slice(tile_lon, lon_max),
+                                               time=slice(window_start, window_end))
+        tile = tile.isel(latitude=(tile['latitude'] < lat_max).values,
+                         longitude=(tile['longitude'] < lon_max).values,
+                         time=(tile['time'] < np.datetime64(window_end)).values)
+        tile = tile.load()
+        tile.attrs['fetched_at'] = pd.Timestamp.now(tz='UTC').tz_localize(None).isoformat()
+        return tile
+
+    def is_complete(self, tile, window_start):
+        """ Whether a cached tile was fetched after its window (plus settle) had closed. """
+        fetched_at = tile.attrs.get('fetched_at')
+        # Tiles written before fetch times were recorded may be truncated too
+        return fetched_at is not None and pd.Timestamp(fetched_at) >= window_start + self.window + self.settle
+
+    def _write(self, tile, path):
+        """ Write a tile atomically, so a killed run never leaves half a file in the cache. """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        encoding = {var: {'zlib': True, 'complevel': 4} for var in tile.data_vars}
+        tmp = path.with_suffix('.tmp')
+        tile.to_netcdf(tmp, encoding=encoding)
+        os.replace(tmp, path)
+
+    def get_tile(self, variable, tile_lat, tile_lon, window_start):
+        """
+        One tile, from disk if cached, otherwise from the source (unless offline).
+        Cached tiles fetched while their window was still open are fetched again, except offline.
+        :return: xarray.Dataset, or None if offline and not cached
+        """
+        path = self.tile_path(variable, tile_lat, tile_lon, window_start)
+        if path.exists():
+            os.utime(path)  # mark as recently used
+            with xr.open_dataset(path) as tile:
+                tile = tile.load()
+            if self.offline or self.is_complete(tile, window_start):
+                self.hits += 1
+                return tile
+            self.refreshes += 1
+        else:
+            self.misses += 1
+            if self.offline:
+                return None
+        tile = self._fetch_tile(variable, tile_lat, tile_lon, window_start)
+        self._write(tile, path)
+        self.evict()
+        return tile
+
+    def __call__(self, variables, lat_min, lat_max, lon_min, lon_max, times, time_tolerance):
+        """
+        fetch_block for enrich_waves: assemble the block from the tiles it overlaps.
+        :return: xarray.Dataset with the requested box and the time steps nearest to times
+        """
+        times = pd.DatetimeIndex(times)
+        lats = np.arange(np.floor(lat_min / self.tile_deg), np.floor(lat_max / self.tile_deg) + 1) * self.tile_deg
+        lons = np.arange(np.floor(lon_min / self.tile_deg), np.floor(lon_max / self.tile_deg) + 1) * self.tile_deg
+
+        # Windows are counted from the epoch so every run cuts them the same way; only the windows holding a time
+        # step within time_tolerance of an incident are needed
+        epoch = pd.Timestamp(0)
+        numbers = np.unique(np.concatenate([(times - time_tolerance - epoch) // self.window,
+                                            (times + time_tolerance - epoch) // self.window]))
+        windows = [epoch + number * self.window for number in numbers]
+
+        # The tiles of a window are merged side by side and the windows stacked in time, so missing tiles (offline,
+        # or past the end of the dataset) and windows of different lengths just leave NaN gaps
+        parts = []
+        for variable in variables:
+            window_parts = []
+            for window_start in windows:
+                tiles = [self.get_tile(variable, float(tile_lat), float(tile_lon), window_start)
+                         for tile_lat in lats for tile_lon in lons]
+                tiles = [tile for tile in tiles if tile is not None and all(tile.sizes.values())]
+                if tiles:
+                    window_parts.append(xr.merge(tiles, join='outer', compat='no_conflicts', combine_attrs='drop'))
+            if window_parts:
+                parts.append(xr.concat(window_parts, dim='time', join='outer', combine_attrs='drop'))
+        if not parts:
+            return xr.Dataset(coords={'time': np.array([], dtype='datetime64[ns]'), 'latitude': [], 'longitude': []})
+
+        block = xr.merge(parts, join='outer', compat='no_conflicts').sortby(['time', 'latitude', 'longitude'])
+        block = block.sel(latitude=slice(lat_min, lat_max), longitude=slice(lon_min, lon_max))
+        steps = block.indexes['time'].get_indexer(times, method='nearest', tolerance=time_tolerance)
+        return block.isel(time=np.unique(steps[steps >= 0]))
+
+    def size(self):
+        """ Total size of the cached tiles in bytes. """
+        return sum(path.stat().st_size for path in self.root.rglob('*.nc'))
+
+    def evict(self):
+        """ Delete the least recently used tiles until the cache is under max_bytes. """
+        files = [(path.stat().st_mtime_ns, path.stat().st_size, path) for path in self.root.rglob('*.nc')]
+        excess = sum(size for _, size, _ in files) - self.max_bytes
+        for _, size, path in sorted(files):
+            if excess <= 0:
+                break
+            path.unlink()
+            excess -= size
+# end of class WaveTileCache
+
+
+def synthetic_wave_dataset(start='2021-09-30', end='2021-12-31', lat_range=(-15.0, 25.0), lon_range=(-20.0, 120.0),
+                           step_deg=0.25, freq='3h', seed=0):
+    """
+    Build a small wave dataset shaped like the Copernicus product, to stand in for the service in tests and
+    offline demos. Wave height varies smoothly in space and time, and a block of cells is left as land (NaN).
+    :param start: First time step
+    :param end: Last time step
+    :param lat_range: (min, max) latitude
+    :param lon_range: (min, max) longitude
+    :param step_deg: Grid spacing in degrees
+    :param freq: Time step
+    :param seed: Random seed for the noise
+    :return: xarray.Dataset with VHM0, VMDR and VCMX on (time, latitude, longitude)
+    """
+    rng = np.random.default_rng(seed)
+    time = pd.date_range(start, end, freq=freq)
+    lat = np.arange(lat_range[0], lat_range[1] + step_deg / 2, step_deg)
+    lon = np.arange(lon_range[0], lon_range[1] + step_deg / 2, step_deg)
+
+    days = ((time - time[0]) / pd.Timedelta(1, unit='D')).to_numpy()[:, None, None]
+    height = (1.5 + 0.8 * np.sin(np.radians(lat))[None, :, None] * np.cos(np.radians(lon))[None, None, :]
+              + 0.5 * np.sin(2 * np.pi * days / 7) + 0.05 * rng.standard_normal((len(time), len(lat), len(lon))))
+    height = np.clip(height, 0, None).astype(np.float32)
+    direction = ((90 + 45 * np.sin(2 * np.pi * days / 3) + 10 * lon[None, None, :] / 180)
+                 * np.ones_like(height)) % 360
+
+    # A patch of land
+    land = (np.abs(lat - np.mean(lat_range)) < 2)[:, None] & (np.abs(lon - np.mean(lon_range)) < 2)[None, :]
+    height[:, land] = np.nan
+    direction[:, land] = np.nan
+
+    dims = ('time', 'latitude', 'longitude')
+    return xr.Dataset({'VHM0': (dims, height, {'units': 'm'}),
+                       'VMDR': (dims, direction.astype(np.float32), {'units': 'degree'}),
+                       'VCMX': (dims, (1.8 * height).astype(np.float32), {'units': 'm'})},
+                      coords={'time': time, 'latitude': lat, 'longitude': lon})
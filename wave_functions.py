@@ -0,0 +1,188 @@
+"""
+This file contains the functions to add wave data from the Copernicus Marine Data Store to the piracy incidents.
+Incidents are sorted by time and grouped into spatial tiles; each tile is read from the dataset with one bulk
+request for just the time steps it needs, and all of its incidents are interpolated at once with vectorized indexing.
+It replaces the per-row get_wave_height in 3_wave_height_analysis.py.
+"""
+
+__author__ = "Deryk Clary, Julia MacDonald, Michael Galvan, and MaryGrace Burke"
+__credits__ = ["Deryk Clary", "Julia Macdonald", "Michael Galvan", "Mary Grace Burke"]
+__email__ = ["deryk.clary@nps.edu", "julia.macdonald@np.edu", "michael.galvan@nps.edu", "mary.burke@nps.edu"]
+__status__ = "Production"
+
+# Import modules
+import numpy as np
+import pandas as pd
+
+from instrument_functions import count, timed
+
+# Product's parameter for GLOBAL_ANALYSISFORECAST_WAV_001_027 wave heights
+WAVE_DATASET_ID = 'cmems_mod_glo_wav_anfc_0.083deg_PT3H-i'
+
+# Dataset variables and the columns they are written to
+WAVE_COLUMNS = {
+    'VHM0': 'Wave Height',  # spectral significant wave height [m]
+    'VMDR': 'Wave Direction',  # mean wave direction from [deg]
+    'VCMX': 'Max Wave Height',  # maximum crest trough wave height [m]
+}
+
+# Variables in degrees, interpolated as unit vectors so 359 and 1 average to 0 and not 180
+CIRCULAR_VARIABLES = {'VMDR'}
+
+
+def dataset_fetcher(dataset):
+    """
+    Wrap an xarray dataset (e.g. from copernicusmarine.open_dataset) in the fetch_block interface.
+    :param dataset: xarray.Dataset with time, latitude and longitude coordinates
+    :return: fetch_block function for enrich_waves
+    """
+    def fetch_block(variables, lat_min, lat_max, lon_min, lon_max, times, time_tolerance):
+        """ Read the time steps nearest to times, inside one lat/lon box, into memory. """
+        steps = dataset.indexes['time'].get_indexer(pd.DatetimeIndex(times), method='nearest',
+                                                    tolerance=time_tolerance)
+        steps = np.unique(steps[steps >= 0])
+        return dataset[list(variables)].isel(time=steps).sel(latitude=slice(lat_min, lat_max),
+                                                             longitude=slice(lon_min, lon_max)).load()
+    return fetch_block
+
+
+def _bracket(grid, x):
+    """
+    Position of each x on an ascending grid.
+    :return: Tuple of (lower grid index, fraction of the way to the next grid point, inside-the-grid flag)
+    """
+    if len(grid) == 1:
+        return np.zeros(len(x), dtype=np.intp), np.zeros(len(x)), np.isclose(x, grid[0])
+    i0 = np.clip(np.searchsorted(grid, x, side='right') - 1, 0, len(grid) - 2)
+    frac = (x - grid[i0]) / (grid[i0 + 1] - grid[i0])
+    inside = (x >= grid[0]) & (x <= grid[-1])
+    return i0, frac, inside
+
+
+def _interpolate(values, ti, lat0, lat_frac, lon0, lon_frac, method):
+    """
+    Interpolate a (time, latitude, longitude) array at the given positions.
+    Missing grid values (land) are left out of the bilinear weights; a point with no valid neighbour is NaN.
+    """
+    if method == 'nearest':
+        return values[ti, lat0 + (lat_frac >= 0.5), lon0 + (lon_frac >= 0.5)]
+
+    lat1 = np.minimum(lat0 + 1, values.shape[1] - 1)
+    lon1 = np.minimum(lon0 + 1, values.shape[2] - 1)
+    corners = np.stack([values[ti, lat0, lon0], values[ti, lat0, lon1], values[ti, lat1, lon0],
+                        values[ti, lat1, lon1]])
+    weights = np.stack([(1 - lat_frac) * (1 - lon_frac), (1 - lat_frac) * lon_frac, lat_frac * (1 - lon_frac),
+                        lat_frac * lon_frac])
+
+    valid = ~np.isnan(corners)
+    weights = np.where(valid, weights, 0.0)
+    total = weights.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = (np.where(valid, corners, 0.0) * weights).sum(axis=0) / total
+    return np.where(total > 0, out, np.nan)
+
+
+def sample_block(block, lat, lon, times, variables, method='linear', time_tolerance=pd.Timedelta(90, unit='min')):
+    """
+    Sample the variables of one block at a set of positions and times: nearest time step, then nearest or bilinear
+    in space.
+    :param block: xarray.Dataset with time, latitude and longitude coordinates
+    :param lat: Array of latitudes
+    :param lon: Array of longitudes
+    :param times: Array of datetime64 times
+    :param variables: Variables to sample
+    :param method: 'linear' (bilinear) or 'nearest'
+    :param time_tolerance: Largest gap allowed between an incident and the nearest time step
+    :return: Dictionary of variable -> float array, NaN where the block has no data for a point or variable
+    """
+    out = {var: np.full(len(lat), np.nan) for var in variables}
+    if not len(lat) or any(block.sizes.get(dim, 0) == 0 for dim in ('time', 'latitude', 'longitude')):
+        return out
+    block = block.sortby(['time', 'latitude', 'longitude'])
+
+    # Nearest time step
+    grid_times = block['time'].values.astype('datetime64[ns]')
+    times = np.asarray(times, dtype='datetime64[ns]')
+    t0, t_frac, _ = _bracket(grid_times.astype(np.int64).astype(np.float64),
+                             times.astype(np.int64).astype(np.float64))
+    ti = np.minimum(t0 + (t_frac >= 0.5), len(grid_times) - 1)
+    on_time = np.abs(grid_times[ti] - times) <= np.timedelta64(time_tolerance)
+
+    lat0, lat_frac, lat_in = _bracket(block['latitude'].values, lat)
+    lon0, lon_frac, lon_in = _bracket(block['longitude'].values, lon)
+    ok = on_time & lat_in & lon_in
+    if not ok.any():
+        return out
+    ti, lat0, lat_frac, lon0, lon_frac = ti[ok], lat0[ok], lat_frac[ok], lon0[ok], lon_frac[ok]
+
+    for var in variables:
+        if var not in block:
+            continue
+        values = block[var].transpose('time', 'latitude', 'longitude').values.astype(np.float64)
+        if var in CIRCULAR_VARIABLES:
+            rad = np.radians(values)
+            sin = _interpolate(np.sin(rad), ti, lat0, lat_frac, lon0, lon_frac, method)
+            cos = _interpolate(np.cos(rad), ti, lat0, lat_frac, lon0, lon_frac, method)
+            out[var][ok] = np.degrees(np.arctan2(sin, cos)) % 360
+        else:
+            out[var][ok] = _interpolate(values, ti, lat0, lat_frac, lon0, lon_frac, method)
+    return out
+
+
+@timed(rows=lambda result: len(result[0]))
+def enrich_waves(data_df, fetch_block, variables=tuple(WAVE_COLUMNS), lat_column='Latitude',
+                 lon_column='Longitude', time_column='Incident Date', method='linear', tile_deg=10.0, window=None,
+                 pad_deg=0.1, time_tolerance=pd.Timedelta(90, unit='min'), start=None, end=None):
+    """
+    Add wave columns (see WAVE_COLUMNS) to the incidents with a handful of bulk reads.
+    Incidents are grouped by spatial tile (and time window, if given), and each group is read with a single
+    fetch_block call covering the box of its incidents and only the time steps they need.
+    :param data_df: Dataframe of incidents
+    :param fetch_block: Function (variables, lat_min, lat_max, lon_min, lon_max, times, time_tolerance) returning
+        an xarray.Dataset, e.g. dataset_fetcher(DS)
+    :param variables: Dataset variables to add
+    :param lat_column: Column with decimal latitudes ('Lat_Dec' in the dirty data)
+    :param lon_column: Column with decimal longitudes ('Lon_Dec' in the dirty data)
+    :param time_column: Column with the incident times
+    :param method: 'linear' (bilinear) or 'nearest'
+    :param tile_deg: Size of the spatial tiles incidents are grouped into, in degrees
+    :param window: Optional length of the time windows incidents are grouped into, e.g. '365D', to bound the
+        size of each read
+    :param pad_deg: Margin read around each group's box, at least one grid step so every incident has neighbours
+    :param time_tolerance: Largest gap allowed between an incident and the nearest time step
+    :param start: Skip incidents before this date (e.g. the start of the dataset)
+    :param end: Skip incidents after this date
+    :return: Tuple of (dataframe with the wave columns, number of blocks read)
+    """
+    variables = list(variables)
+    for var in variables:
+        data_df[WAVE_COLUMNS.get(var, var)] = np.nan
+
+    points = pd.DataFrame({'lat': pd.to_numeric(data_df[lat_column], errors='coerce').to_numpy(),
+                           'lon': pd.to_numeric(data_df[lon_column], errors='coerce').to_numpy(),
+                           'time': pd.to_datetime(data_df[time_column]).to_numpy()})
+    keep = points.notna().all(axis=1)
+    if start is not None:
+        keep &= points['time'] >= pd.Timestamp(start)
+    if end is not None:
+        keep &= points['time'] <= pd.Timestamp(end)
+    points = points[keep].sort_values('time', kind='stable')
+
+    keys = [np.floor(points['lat'] / tile_deg), np.floor(points['lon'] / tile_deg)]
+    if window is not None:
+        keys.append(points['time'].dt.floor(window))
+
+    reads = 0
+    for _, group in points.groupby(keys, sort=False):
+        times = group['time'].unique()
+        block = fetch_block(variables, group['lat'].min() - pad_deg, group['lat'].max() + pad_deg,
+                            group['lon'].min() - pad_deg, group['lon'].max() + pad_deg, times, time_tolerance)
+        reads += 1
+        count('wave_blocks_read')
+        sampled = sample_block(block, group['lat'].to_numpy(), group['lon'].to_numpy(), group['time'].to_numpy(),
+                               variables, method=method, time_tolerance=time_tolerance)
+
+        # group.index is the row position in data_df
+        for var in variables:
+            data_df.iloc[group.index, data_df.columns.get_loc(WAVE_COLUMNS.get(var, var))] = sampled[var]
+    return data_df, reads